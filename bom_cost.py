@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+#===============================================================================
+#
+#  Copyright 2017 VIDAS SIMKUS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#===============================================================================
+
+
+#===============================================================================
+#
+# This script computes the cost of a BOM at a number of build quantities.  Every
+# part is looked up once (through the dkapia parts cache) and the whole cost
+# curve is worked out from the price tiers in one pass.
+#
+#===============================================================================
+
+import sys
+import os
+import bisect
+import argparse
+
+import dkapia
+import check_bom
+
+DEFAULT_QUANTITIES = "1,5,10,25,100,250,1000"
+
+class PriceTiers(object):
+	"""
+	The standard pricing of a part, sorted by break quantity, with the bits needed to answer "what does it cost to buy N" with a binary search.
+	"""
+
+	def __init__(self, _pricing):
+		tiers = sorted([(int(p["BreakQuantity"]), float(p["UnitPrice"])) for p in _pricing])
+
+		self.breaks = [t[0] for t in tiers]
+		self.units = [t[1] for t in tiers]
+
+		#
+		# Cheapest way of buying at a break at or above each tier: (cost, tier index).
+		# Lets us spot when buying up to a higher break is cheaper than buying exactly what's needed.
+		#
+		self.best_above = [None] * len(tiers)
+		best = None
+
+		for i in range(len(tiers) - 1, -1, -1):
+			c = (self.breaks[i] * self.units[i], i)
+			if best is None or c[0] < best[0]:
+				best = c
+			self.best_above[i] = best
+
+		return
+
+	def cost(self, _needed):
+		"""
+		@param _needed: Number of parts needed.
+		@return: Tuple of (extended cost, quantity to buy, break quantity that applies, unit price)
+		"""
+
+		i = bisect.bisect_right(self.breaks, _needed) - 1
+
+		if i < 0:
+			# Below the minimum order quantity; we have to buy the first break
+			c, j = self.best_above[0]
+			return (c, self.breaks[j], self.breaks[j], self.units[j])
+
+		ret = (_needed * self.units[i], _needed, self.breaks[i], self.units[i])
+
+		if i + 1 < len(self.breaks):
+			c, j = self.best_above[i + 1]
+			if c < ret[0]:
+				ret = (c, self.breaks[j], self.breaks[j], self.units[j])
+
+		return ret
+
+def search_result_part(_d, _dkpn):
+	"""
+	Picks the BOM part out of a part search result.  A search can come back with several parts; only the one with the BOM's part number is priced.
+	@param _d: Part search result.
+	@param _dkpn: DigiKey part number from the BOM.
+	@return: Tuple of (part JSON or None, error or None)
+	"""
+
+	parts = _d.get("Parts", [])
+
+	if len(parts) == 1:
+		return (parts[0], None)
+
+	for p in parts:
+		if dkapia.part_number_key(p.get("DigiKeyPartNumber", "")) == dkapia.part_number_key(_dkpn):
+			return (p, None)
+
+	return (None, "The search result has %d parts and none of them is %s." % (len(parts), _dkpn))
+
+def load_bom_pricing(_file_name):
+	"""
+	Looks up every part in the BOM once.
+	@param _file_name: KiBOM generated "CSV" file.
+	@return: Tuple of (list of (DKPN, count per board, PriceTiers), list of (DKPN, reason) for parts without pricing)
+	"""
+
+	parts = []
+	missing = []
+
+	for l in check_bom.read_bom(_file_name):
+		dkpn = l[check_bom.COL_IDX_DKPN].strip()
+
+		try:
+			count = int(l[check_bom.COL_IDX_COUNT])
+		except ValueError:
+			missing.append((dkpn, "Bad component count: " + l[check_bom.COL_IDX_COUNT]))
+			continue
+
+		try:
+			d = dkapia.get_cached_part_data(dkpn, 1)
+		except RuntimeError, e:
+			missing.append((dkpn, str(e)))
+			continue
+
+		p, err = search_result_part(d, dkpn)
+
+		if p is None:
+			missing.append((dkpn, err))
+			continue
+
+		pricing = p.get("StandardPricing", [])
+
+		if len(pricing) < 1:
+			missing.append((dkpn, "No pricing in search result."))
+			continue
+
+		parts.append((dkpn, count, PriceTiers(pricing)))
+
+	return (parts, missing)
+
+def cost_curve(_parts, _quantities):
+	"""
+	Works out the BOM cost at every build quantity.
+	@param _parts: List of (DKPN, count per board, PriceTiers)
+	@param _quantities: Build quantities.
+	@return: List, one per build quantity, of (boards, extended BOM cost, per-part list of (DKPN, needed, buy quantity, break, unit price, extended cost))
+	"""
+
+	ret = []
+
+	for q in _quantities:
+		total = 0.0
+		lines = []
+
+		for dkpn, count, tiers in _parts:
+			needed = count * q
+			c, buy, brk, unit = tiers.cost(needed)
+			total = total + c
+			lines.append((dkpn, needed, buy, brk, unit, c))
+
+		ret.append((q, total, lines))
+
+	return ret
+
+def print_table(_curve, _verbose):
+	"""
+	Prints the cost curve as a compact table, optionally with the per-part breakdown.
+	"""
+
+	print "%8s %14s %14s" % ("Boards", "Extended", "Per board")
+
+	for q, total, lines in _curve:
+		print "%8d %14.2f %14.4f" % (q, total, total / q)
+
+		if _verbose:
+			for dkpn, needed, buy, brk, unit, c in lines:
+				print "	%-24s need %6d buy %6d at break %6d @ %.4f = %.2f" % (dkpn, needed, buy, brk, unit, c)
+
+	return
+
+def print_csv(_curve):
+	"""
+	Prints the cost curve as CSV with a line per part and build quantity followed by a TOTAL line.
+	"""
+
+	print "boards,dkpn,needed,buy,break,unit_price,extended"
+
+	for q, total, lines in _curve:
+		for dkpn, needed, buy, brk, unit, c in lines:
+			print "%d,%s,%d,%d,%d,%.5f,%.5f" % (q, dkpn, needed, buy, brk, unit, c)
+		print "%d,TOTAL,,,,,%.5f" % (q, total)
+
+	return
+
+def setup_argparse():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("-i", help="BOM file to cost.  Defaults to the INFILE configured in check_bom.py.", default=check_bom.INFILE)
+	parser.add_argument("-q", help="Comma separated build quantities.  Defaults to %s." % DEFAULT_QUANTITIES, default=DEFAULT_QUANTITIES)
+	parser.add_argument("-csv", action="store_true", help="Output CSV with a line per part and build quantity instead of the table.")
+	parser.add_argument("-v", action="store_true", help="Show the per-part breakdown in the table.")
+	parser.add_argument("-locale", help="Language to look parts up in.  Overrides LOCALE_LANGUAGE in the dkapia state/config file.")
+	parser.add_argument("-currency", help="Currency to price the BOM in, e.g. eur.  Overrides LOCALE_CURRENCY in the dkapia state/config file.")
+
+	return parser
+
+def main():
+	args = setup_argparse().parse_args()
+
+	try:
+		quantities = sorted(set([int(q) for q in args.q.split(",") if len(q.strip()) > 0]))
+	except ValueError, e:
+		print >>sys.stderr, "Build quantities must be integers: " + str(e)
+		sys.exit(-1)
+
+	if len(quantities) > 0 and quantities[0] < 1:
+		print >>sys.stderr, "Build quantities must be at least 1: " + str(quantities[0])
+		sys.exit(-1)
+
+	try:
+		dkapia.load_global_context()
+	except ValueError, e:
+		print >>sys.stderr, "Failed to load state/config file: " + str(e)
+		sys.exit(-1)
+
+	if args.locale or args.currency:
+		dkapia.LOCALE = dkapia.normalize_locale((args.locale or dkapia.LOCALE[0], args.currency or dkapia.LOCALE[1]))
+
+	dkapia.load_zdict()
+	dkapia.load_parts_cache()
+	dkapia.load_negative_cache()
+
+	if os.environ.get(dkapia.SNAPSHOT_ENV):
+		dkapia.mount_cache_snapshot(os.environ[dkapia.SNAPSHOT_ENV])
+
+	parts, missing = load_bom_pricing(args.i)
+
+	dkapia.save_global_context()
+	dkapia.save_parts_cache()
+	dkapia.save_negative_cache()
+	dkapia.save_part_index()
+	dkapia.save_price_history()
+
+	curve = cost_curve(parts, quantities)
+
+	if args.csv:
+		print_csv(curve)
+	else:
+		print_table(curve, args.v)
+
+	for dkpn, reason in missing:
+		print >>sys.stderr, "No pricing for [%s]; left out of the totals: %s" % (dkpn, reason)
+
+	return
+
+if __name__ == '__main__':
+	main()
@@ -29,7 +29,21 @@ import subprocess
 import json
 import sys
 import os
+import time
+import hashlib
+import argparse
+import Queue
+import multiprocessing
 import package_types
+import phase_profile
+import dkapia
+
+from multiprocessing.pool import ThreadPool
+
+try:
+	import xml.etree.cElementTree as ElementTree
+except ImportError:
+	import xml.etree.ElementTree as ElementTree
 
 #
 # The "CSV" files I use are generated by KiBOM:
@@ -73,9 +87,65 @@ COL_IDX_MFGPN = 10
 # DigiKey part number
 COL_IDX_DKPN = 12
 
+#
+# KiCad XML BOM/netlist files (the intermediate netlist eeschema hands to BOM plugins) are read directly.
+# These are the component field names, compared case insensitively, that the various columns above are taken from.
+#
+XML_DKPN_FIELDS = ("digikey", "digi-key", "dkpn", "digikey_pn", "digi-key_pn", "digi-key part number")
+XML_MFG_FIELDS = ("mfg", "manufacturer", "mf")
+XML_MFGPN_FIELDS = ("mfgpn", "mpn", "mfn", "manufacturer_part_number", "manufacturer part number")
+
 
 DEBUG = False
 
+#
+# Verdicts from previous runs are kept here so that unchanged rows are not re-queried.
+#
+VERDICT_FILE = ".digi-key_api_bom_verdicts.json"
+
+# How long a verdict is trusted before the part is looked up again.
+VERDICT_TTL_HOURS = 24
+
+VK_TS = "TS"
+VK_DK_MOUNT = "DK_MOUNT"
+VK_DK_PACKAGE = "DK_PACKAGE"
+VK_SC_MOUNT = "SC_MOUNT"
+VK_SC_PACKAGE = "SC_PACKAGE"
+
+# Number of rows looked up at once
+CHECK_JOBS = 4
+
+# Rows that may be in flight or held back for -ordered output at once, per job.  Keeps memory bounded when one slow row holds up the rest.
+CHECK_WINDOW_PER_JOB = 4
+
+# Seconds between updates of the progress line
+PROGRESS_INTERVAL = 1.0
+
+#
+# Alternates mode.  Rows with a package mismatch, or whose part has fewer than ALT_LOW_STOCK available, get a keyword search for replacements.
+#
+
+ALT_LOW_STOCK = 100
+
+# Number of results asked for per keyword search
+ALT_RECORD_COUNT = 25
+
+# Number of keyword searches in flight at once
+ALT_JOBS = 4
+
+# Number of alternates shown per row
+ALT_SHOW = 5
+
+#
+# Audit mode.  (DKPN, footprint) pairs of a whole component library are classified from the parts cache by a pool of processes.
+#
+
+# Pairs handed to a worker process at a time
+AUDIT_CHUNK_SIZE = 256
+
+# Parts cache key of the newest result in any locale, by part number.  For parts that aren't cached in the configured locale; packages don't change by locale.
+AUDIT_ANY_LOCALE = {}
+
 #===============================================================================
 #
 # End "configuration" section
@@ -115,17 +185,21 @@ def is_smt_pad(_pad):
 	return False
 
 def get_part_info(dkpn):
-	parms = [os.path.join(MY_DIR,"dkapia.py"), "PART_SEARCH", "-P", dkpn, "-rmMl", "-rmPp", "-rmPd"]
+	"""
+	Looks up a part by running dkapia.py.
+	@return: Tuple of (part JSON or None, error output or None)
+	"""
+
+	parms = [os.path.join(MY_DIR,"dkapia.py"), "PART_SEARCH", "-P", dkpn, "-rmMl", "-rmPp", "-rmPd", "-pace"]
 
 	proc = subprocess.Popen(parms, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 	(stdoutdata, stderrdata) = proc.communicate(None)
 
 	if proc.returncode != 0:
-		print stderrdata
-		return None
+		return (None, stderrdata)
 
-	return json.loads(stdoutdata)
+	return (json.loads(stdoutdata), None)
 
 def guess_schematic_package(l):
 	"""
@@ -266,82 +340,963 @@ def guess_digikey_package(jo):
 
 	return (pkg_mount_type,package_id)
 
-i = 0
+def get_verdict_cache_file_name():
+	"""
+	Returns the complete path to the BOM verdict cache file.
+	@return: Full path to the verdict cache file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), VERDICT_FILE)
+
+def load_verdict_cache():
+	"""
+	Loads the verdicts from previous runs.  A missing or broken file simply means we start from scratch.
+	@return: Map of row fingerprint to verdict.
+	"""
+
+	try:
+		with open(get_verdict_cache_file_name(), "rt") as v_file:
+			return json.load(v_file)
+	except Exception:
+		return {}
+
+def save_verdict_cache(_cache, _ttl):
+	"""
+	Saves the verdict cache.  Expired verdicts are dropped on the way out so the file does not grow forever.
+	@param _cache: Map of row fingerprint to verdict.
+	@param _ttl: Verdict time to live in seconds.
+	@return: Nothing
+	"""
+
+	now = time.time()
+
+	for k in _cache.keys():
+		if now - _cache[k][VK_TS] > _ttl:
+			del _cache[k]
+
+	try:
+		with open(get_verdict_cache_file_name(), "wt") as v_file:
+			json.dump(_cache, v_file, indent=4, sort_keys=True)
+	except Exception, e:
+		print >>sys.stderr, "Failed to save verdict cache: " + str(e)
+
+	return
+
+def row_fingerprint(l):
+	"""
+	Fingerprints the bits of a BOM row that the verdict depends on.
+	@param l: BOM row, already split into columns.
+	@return: Hex digest string.
+	"""
+
+	return hashlib.sha1("|".join((l[COL_IDX_DKPN].strip(), l[COL_IDX_PAD].strip(), l[COL_IDX_COUNT].strip()))).hexdigest()
+
+def classify_row(l):
+	"""
+	Queries Digi-Key for the part in the BOM row and classifies both sides of it.
+	@param l: BOM row, already split into columns.
+	@return: Tuple of (verdict map or None if the part lookup failed, error output or None)
+	"""
+
+	try:
+		with phase_profile.phase("part lookup"):
+			jo, err = get_part_info(l[COL_IDX_DKPN])
+	except Exception as e:
+		raise RuntimeError("Uncaught exception:",e)
+
+	if jo is None:
+		return (None, err)
+
+	with phase_profile.phase("classification"):
+		dk_mount,dk_package = guess_digikey_package(jo)
+		sc_mount,sc_package = guess_schematic_package(l)
+
+	ret = {}
+	ret[VK_TS] = time.time()
+	ret[VK_DK_MOUNT] = dk_mount
+	ret[VK_DK_PACKAGE] = dk_package
+	ret[VK_SC_MOUNT] = sc_mount
+	ret[VK_SC_PACKAGE] = sc_package
+
+	return (ret, None)
+
+def verdict_strings(v):
+	"""
+	Spells out both sides of a verdict.
+	@param v: Verdict map.
+	@return: Tuple of (schematic mount type, schematic package, DigiKey mount type, DigiKey package) strings.
+	"""
+
+	dk_mount = v[VK_DK_MOUNT]
+	dk_package = v[VK_DK_PACKAGE]
+	sc_mount = v[VK_SC_MOUNT]
+	sc_package = v[VK_SC_PACKAGE]
+
+	#
+	# Pointers to footprint conversion functions
+	#
+	dk_fc = None
+	sc_fc = None
+
+	if dk_mount == package_types.PKG_MOUNT_TYPE_SMT:
+		dk_fc = package_types.digikey_smt_type_to_string
+	elif dk_mount == package_types.PKG_MOUNT_TYPE_TH: 
+		dk_fc = package_types.digikey_th_type_to_string
+	else:
+		dk_fc = package_types.digikey_invalid_type_to_string
+
+	if sc_mount == package_types.PKG_MOUNT_TYPE_SMT:
+		sc_fc = package_types.schematic_smt_type_to_string
+	elif sc_mount == package_types.PKG_MOUNT_TYPE_TH: 
+		sc_fc = package_types.schematic_th_type_to_string
+	else:
+		sc_fc = package_types.schematic_invalid_type_to_string				
+
+	dk_str = dk_fc(dk_package)
+
+	#
+	# package_types.py only knows the packages we've run into.  The parameter dictionary knows what Digi-Key calls the rest.
+	#
+	learned = dkapia.PARAMETRICS_CACHE.value_text(dkapia.PARAM_ID_PACKAGE, dk_package)
+
+	if learned is not None:
+		dk_str = "%s \"%s\"" % (dk_str, learned.encode("utf-8"))
+
+	return (package_types.pkg_mount_type_to_string(sc_mount), sc_fc(sc_package), package_types.pkg_mount_type_to_string(dk_mount), dk_str)
+
+def report_mismatch(comp_id, v):
+	"""
+	Prints the mismatch report for a single BOM row.
+	@param comp_id: Component IDs of the row.
+	@param v: Verdict map.
+	"""
+
+	if not is_mismatch(v):
+		return
+
+	sc_mount_str, sc_package_str, dk_mount_str, dk_package_str = verdict_strings(v)
+
+	print >>sys.stderr,":( -- Possible mismatch for component: [%s]" % str(comp_id)
+	print >>sys.stderr, "	Mount type:	Schematic:	[%s]	Digikey	[%s]" % (sc_mount_str, dk_mount_str);
+	print >>sys.stderr, "	Package:	Schematic:	[%s]	Digikey	[%s]" % (sc_package_str, dk_package_str);
+
+	print >> sys.stderr,""
+
+	return
+
+def comp_field(_fields, _names):
+	"""
+	@param _fields: Map of lower cased field name to value.
+	@param _names: Acceptable field names, lower case, in order of preference.
+	@return: Value of the first field found or an empty string.
+	"""
+
+	for n in _names:
+		if n in _fields:
+			return _fields[n]
+
+	return ""
+
+def read_kicad_xml_bom(_file_name):
+	"""
+	Reads a KiCad XML BOM/netlist file and groups the components by value, footprint and DigiKey part number.
+	The file is parsed incrementally and every element is thrown away once we're done with it, so memory use depends on the number of component
+	groups rather than on the size of the design.
+	@param _file_name: KiCad XML BOM/netlist file.
+	@return: List of rows laid out like the KiBOM rows, COL_IDX_* and all, in order of first appearance.
+	"""
+
+	groups = {}
+	order = []
+	stack = []
+
+	for event, elem in ElementTree.iterparse(_file_name, events=("start", "end")):
+		if event == "start":
+			stack.append(elem)
+			continue
+
+		stack.pop()
+
+		if len(stack) != 2:
+			# Only care about the children of <components>, <libparts>, <nets> and so on
+			continue
+
+		if elem.tag == "comp":
+			fields = {}
+
+			for f in elem.iter("field"):
+				fields[f.get("name", "").strip().lower()] = (f.text or "").strip()
+
+			# KiCad 6 and up
+			for p in elem.iter("property"):
+				fields.setdefault(p.get("name", "").strip().lower(), p.get("value", "").strip())
+
+			ls = elem.find("libsource")
+
+			value = (elem.findtext("value") or "").strip()
+			footprint = (elem.findtext("footprint") or "").strip()
+			dkpn = comp_field(fields, XML_DKPN_FIELDS)
+
+			key = (value, footprint, dkpn)
+			g = groups.get(key)
+
+			if g is None:
+				g = [""] * (max(COL_IDX_ROW, COL_IDX_DESC, COL_IDX_COMP, COL_IDX_IDS, COL_IDX_VALUE, COL_IDX_PAD, COL_IDX_COUNT, COL_IDX_MFG, COL_IDX_MFGPN, COL_IDX_DKPN) + 1)
+				g[COL_IDX_ROW] = str(len(order) + 1)
+				g[COL_IDX_VALUE] = value
+				g[COL_IDX_PAD] = footprint
+				g[COL_IDX_DKPN] = dkpn
+				g[COL_IDX_MFG] = comp_field(fields, XML_MFG_FIELDS)
+				g[COL_IDX_MFGPN] = comp_field(fields, XML_MFGPN_FIELDS)
+
+				if ls is not None:
+					g[COL_IDX_DESC] = ls.get("description", "")
+					g[COL_IDX_COMP] = ls.get("part", "")
+
+				g[COL_IDX_IDS] = []
+				groups[key] = g
+				order.append(key)
+
+			g[COL_IDX_IDS].append(elem.get("ref", ""))
+
+		stack[-1].remove(elem)
+
+	ret = []
+
+	for key in order:
+		g = groups[key]
+
+		if len(g[COL_IDX_DKPN]) < 1:
+			continue
+
+		g[COL_IDX_COUNT] = str(len(g[COL_IDX_IDS]))
+		g[COL_IDX_IDS] = " ".join(g[COL_IDX_IDS])
+		ret.append(g)
+
+	return ret
+
+def read_bom(_file_name):
+	"""
+	Reads the BOM file and returns the rows that have a DigiKey part number.
+	@param _file_name: KiBOM generated "CSV" file or a KiCad XML BOM/netlist file.
+	@return: List of rows, each already split into columns.
+	"""
+
+	if _file_name.lower().endswith(".xml"):
+		return read_kicad_xml_bom(_file_name)
+
+	ret = []
+
+	with open(_file_name, "rt") as in_file:
+		in_file.readline()
+
+		for l in in_file:
+			l = l.strip()
+			if len(l) < 1:
+				break
+
+			l = l.split(SEP_CHAR)
+
+			try:
+				comp_id = l[COL_IDX_IDS]
+				dkpn = l[COL_IDX_DKPN]
+			except IndexError as e:
+				print >>sys.stderr, "Failed to get line contents.  Check configuration.  Make sure that field separator is set correctly.\nException: %s" % (str(e))
+				break
+
+			if len(dkpn) < 1:
+				continue
+
+			ret.append(l)
+
+	return ret
+
+def first_error_line(err):
+	"""
+	@param err: Error output of a failed lookup, or None.
+	@return: The first non-blank line of it.
+	"""
+
+	lines = [e.strip() for e in (err or "").splitlines() if len(e.strip()) > 0]
+
+	if len(lines) < 1:
+		return "Unknown error."
+
+	return lines[0]
+
+def row_record(i, l, v, err, reused):
+	"""
+	Machine readable outcome of a single BOM row; a line of the -jsonl output.
+	@param i: Zero-based index of the row in the BOM.
+	@param l: BOM row.
+	@param v: Verdict map or None if the lookup failed.
+	@param err: Error output of the failed lookup.
+	@param reused: True if the verdict came from a previous run.
+	@return: JSON-able map.
+	"""
+
+	ret = {}
+	ret["index"] = i
+	ret["row"] = l[COL_IDX_ROW].strip()
+	ret["components"] = l[COL_IDX_IDS].strip()
+	ret["dkpn"] = l[COL_IDX_DKPN].strip()
+	ret["footprint"] = l[COL_IDX_PAD].strip()
+
+	if v is None:
+		ret["status"] = "failed"
+		ret["error"] = first_error_line(err)
+		return ret
+
+	sc_mount_str, sc_package_str, dk_mount_str, dk_package_str = verdict_strings(v)
+
+	ret["status"] = "mismatch" if is_mismatch(v) else "ok"
+	ret["reused"] = reused
+	ret["schematic"] = {"mount": sc_mount_str, "package": sc_package_str}
+	ret["digikey"] = {"mount": dk_mount_str, "package": dk_package_str}
+
+	return ret
+
+class ProgressLine(object):
+	"""
+	'Checked 120/450 rows, 3.2 rows/s, ETA 1:43' kept up to date on the last line of a terminal.  Does nothing if stderr is not a terminal.
+	"""
+
+	def __init__(self, _total):
+		self.total = _total
+		self.start = time.time()
+		self.last = 0
+		self.width = 0
+		self.enabled = sys.stderr.isatty()
+		return
+
+	def update(self, _done):
+		if not self.enabled or time.time() - self.last < PROGRESS_INTERVAL:
+			return
+
+		elapsed = max(time.time() - self.start, 0.001)
+		rate = _done / elapsed
+
+		if rate > 0:
+			eta = int((self.total - _done) / rate)
+			eta_str = "%d:%02d" % (eta / 60, eta % 60)
+		else:
+			eta_str = "?"
+
+		line = "Checked %d/%d rows, %.1f rows/s, ETA %s" % (_done, self.total, rate, eta_str)
+
+		sys.stderr.write("\r" + line.ljust(self.width))
+		sys.stderr.flush()
+
+		self.width = len(line)
+		self.last = time.time()
 
-comp_id = None
-dkpn = None
-jo = None
+		return
 
-with open(INFILE, "rt") as in_file:
-	i = i + 1
-	in_file.readline()
+	def clear(self):
+		"""
+		Wipes the progress line so that regular output can be printed.  The next update puts it back.
+		"""
 
-	for l in in_file:
-		l = l.strip()
-		if len(l) < 1:
-			break
+		if self.width > 0:
+			sys.stderr.write("\r" + (" " * self.width) + "\r")
+			self.width = 0
+			self.last = 0
 
-		l = l.split(SEP_CHAR)
+		return
 
+def check_bom(_file_name, _ttl, _force, _jobs=CHECK_JOBS, _ordered=False, _jsonl=None):
+	"""
+	Checks every row in the BOM.  Rows whose fingerprint matches a verdict younger than the TTL are not re-queried.
+	Lookups run _jobs at a time and every row is reported as soon as it is done, or with _ordered as soon as the rows before it are done.
+	At most _jobs * CHECK_WINDOW_PER_JOB rows are in flight or held back at any time.
+	@param _file_name: KiBOM generated "CSV" file.
+	@param _ttl: Verdict time to live in seconds.
+	@param _force: If true, ignore previous verdicts and re-query every row.
+	@param _jobs: Number of rows looked up at once.
+	@param _ordered: Report rows in BOM order instead of in order of completion.
+	@param _jsonl: If not None, a file that gets a JSON line (see row_record) per row as it is reported.
+	@return: List of (row, verdict), in BOM order, for every row that could be checked.
+	"""
+
+	with phase_profile.phase("verdict load"):
+		cache = load_verdict_cache()
+
+	now = time.time()
+
+	reused = 0
+	queried = 0
+	results = []
+	failed = []
+
+	with phase_profile.phase("bom read"):
+		rows = read_bom(_file_name)
+
+	jobs = max(_jobs, 1)
+	window = jobs * CHECK_WINDOW_PER_JOB
+	pool = ThreadPool(jobs)
+	done = Queue.Queue()
+	held = {}
+	progress = ProgressLine(len(rows))
+
+	def classify(i, l, fp):
 		try:
-			comp_id = l[COL_IDX_IDS]
-			dkpn = l[COL_IDX_DKPN]
-		except IndexError as e:
-			print >>sys.stderr, "Failed to get line contents.  Check configuration.  Make sure that field separator is set correctly.\nException: %s" % (str(e))
-			break
+			v, err = classify_row(l)
+		except Exception, e:
+			v, err = (None, str(e))
+
+		done.put((i, fp, v, err, False))
+
+	def submit(i):
+		l = rows[i]
+		fp = row_fingerprint(l)
+		v = cache.get(fp)
+
+		if v is not None and not _force and now - v[VK_TS] <= _ttl:
+			done.put((i, fp, v, None, True))
+		else:
+			if DEBUG:
+				print "DEBUG<main>: Looking at DKPN: %s for components: %s" % (l[COL_IDX_DKPN], l[COL_IDX_IDS])
+
+			pool.apply_async(classify, (i, l, fp))
+
+	def report(i, fp, v, err, was_reused):
+		l = rows[i]
+
+		progress.clear()
+
+		if v is None:
+			failed.append((l[COL_IDX_IDS], l[COL_IDX_DKPN], err))
+		else:
+			if was_reused:
+				if DEBUG:
+					print "DEBUG<main>: Reused verdict for DKPN: %s for components: %s" % (l[COL_IDX_DKPN], l[COL_IDX_IDS])
+			else:
+				cache[fp] = v
+
+			results.append((i, l, v))
+
+			with phase_profile.phase("report"):
+				report_mismatch(l[COL_IDX_IDS], v)
+
+		if _jsonl is not None:
+			print >>_jsonl, json.dumps(row_record(i, l, v, err, was_reused), sort_keys=True)
+			_jsonl.flush()
+
+	submitted = 0
+	reported = 0
+
+	try:
+		while reported < len(rows):
+			while submitted < len(rows) and submitted - reported < window:
+				submit(submitted)
+				submitted = submitted + 1
+
+			try:
+				item = done.get(True, PROGRESS_INTERVAL)
+			except Queue.Empty:
+				progress.update(reported)
+				continue
+
+			if item[2] is not None:
+				if item[4]:
+					reused = reused + 1
+				else:
+					queried = queried + 1
+
+			if _ordered:
+				held[item[0]] = item
+
+				while reported in held:
+					report(*held.pop(reported))
+					reported = reported + 1
+			else:
+				report(*item)
+				reported = reported + 1
+
+			progress.update(reported)
+	finally:
+		pool.close()
+		pool.join()
+		progress.clear()
+
+		with phase_profile.phase("verdict save"):
+			save_verdict_cache(cache, _ttl)
+
+	print >>sys.stderr, "Checked %d rows: %d from previous verdicts, %d queried." % (reused + queried, reused, queried)
+
+	if len(failed) > 0:
+		print >>sys.stderr, "Failed to look up %d rows:" % len(failed)
+
+		for comp_id, dkpn, err in failed:
+			print >>sys.stderr, "	[%s]	%s	%s" % (comp_id, dkpn, first_error_line(err))
+
+	return [(l, v) for i, l, v in sorted(results)]
+
+def is_mismatch(v):
+	"""
+	@param v: Verdict map.
+	@return: True if the schematic and DigiKey disagree on mount type or package.
+	"""
+
+	return v[VK_DK_MOUNT] != v[VK_SC_MOUNT] or v[VK_DK_PACKAGE] != v[VK_SC_PACKAGE]
+
+def part_parameter_value(_part, _parameter_id):
+	"""
+	@param _part: Part from a search result.
+	@param _parameter_id: Digi-Key parameter ID.
+	@return: Text value of the parameter or None if the part doesn't have it.
+	"""
+
+	for p in _part.get("Parameters", []):
+		if p.get("ParameterId") == _parameter_id:
+			return p.get("Value")
+
+	return None
+
+def part_unit_price(_part):
+	"""
+	@param _part: Part from a search result.
+	@return: Unit price at the lowest price break or None if there is no pricing.
+	"""
+
+	try:
+		return float(sorted(_part["StandardPricing"], key=lambda p: int(p["BreakQuantity"]))[0]["UnitPrice"])
+	except (KeyError, IndexError, ValueError, TypeError):
+		return None
+
+def alternate_keywords(l, v, _part):
+	"""
+	Builds the keyword search for replacements of the part in a BOM row out of its value, package, and mount type.
+	If the package doesn't match the schematic, the schematic side is what we're looking for.
+	@param l: BOM row, already split into columns.
+	@param v: Verdict map.
+	@param _part: Part from the search result for the row's DKPN.  May be None.
+	@return: Keyword string.
+	"""
+
+	kw = [l[COL_IDX_VALUE].strip()]
+
+	if _part is not None and not is_mismatch(v):
+		kw.append(part_parameter_value(_part, 16) or "")
+		kw.append(part_parameter_value(_part, 69) or "")
+	else:
+		if v[VK_SC_MOUNT] == package_types.PKG_MOUNT_TYPE_SMT:
+			kw.append(package_types.schematic_smt_type_to_string(v[VK_SC_PACKAGE]).replace("_", "-"))
+			kw.append("Surface Mount")
+		elif v[VK_SC_MOUNT] == package_types.PKG_MOUNT_TYPE_TH:
+			kw.append(package_types.schematic_th_type_to_string(v[VK_SC_PACKAGE]).replace("_", "-"))
+			kw.append("Through Hole")
+
+	return " ".join([k for k in kw if len(k) > 0])
+
+def search_alternates(_keywords):
+	"""
+	Runs a single keyword search.  Called from the alternates thread pool.
+	@param _keywords: Keyword string.
+	@return: List of parts found.  Empty if the search failed.
+	"""
+
+	try:
+		dkapia.pace_api_calls()
+		return dkapia.get_part_data(_keywords, ALT_RECORD_COUNT).get("Parts", [])
+	except RuntimeError as e:
+		print >>sys.stderr, "Alternates search for [%s] failed: %s" % (_keywords, str(e))
+		return []
 
-		if len(dkpn) < 1:
+def rank_alternates(l, v, _parts):
+	"""
+	Keeps the parts whose package matches the schematic and orders them by stock, most first, then by price, cheapest first.
+	@param l: BOM row, already split into columns.
+	@param v: Verdict map.
+	@param _parts: Candidate parts.
+	@return: List of candidate parts.
+	"""
+
+	ret = []
+	seen = set([l[COL_IDX_DKPN].strip().upper()])
+
+	for p in _parts:
+		dkpn = p.get("DigiKeyPartNumber", "").strip().upper()
+
+		if dkpn in seen:
 			continue
+		seen.add(dkpn)
+
+		try:
+			if guess_digikey_package(p) != (v[VK_SC_MOUNT], v[VK_SC_PACKAGE]):
+				continue
+		except RuntimeError:
+			continue
+
+		ret.append(p)
 
-		pad = l[COL_IDX_PAD]
+	def rank(_p):
+		price = part_unit_price(_p)
+		if price is None:
+			price = float("inf")
+		return (-int(_p.get("QuantityAvailable", 0)), price)
 
-		if DEBUG:
-			print "DEBUG<main>: Looking at DKPN: %s for components: %s" % (dkpn,comp_id)
+	return sorted(ret, key=rank)
+
+def find_alternates(_results, _low_stock, _jobs):
+	"""
+	Looks for replacements for every row with a package mismatch or low stock and prints them.
+	Identical searches from different rows are only made once and the searches are run _jobs at a time.
+	@param _results: List of (row, verdict) as returned by check_bom.
+	@param _low_stock: Rows whose part has fewer than this many available are flagged.
+	@param _jobs: Number of keyword searches in flight at once.
+	@return: Nothing
+	"""
+
+	flagged = []
+
+	for l, v in _results:
+		part = None
 
 		try:
-			jo = get_part_info(dkpn)
-		except Exception as e:
-			raise RuntimeError("Uncaught exception:",e)
+			part = dkapia.get_cached_part_data(l[COL_IDX_DKPN], 1)["Parts"][0]
+		except (RuntimeError, KeyError, IndexError, TypeError):
+			pass
+
+		reasons = []
+
+		if is_mismatch(v):
+			reasons.append("package mismatch")
+
+		if part is not None and int(part.get("QuantityAvailable", 0)) < _low_stock:
+			reasons.append("low stock (%s)" % str(part.get("QuantityAvailable", 0)))
+
+		if len(reasons) > 0:
+			flagged.append((l, v, alternate_keywords(l, v, part), ", ".join(reasons)))
+
+	keywords = sorted(set([f[2] for f in flagged]))
+
+	if len(keywords) < 1:
+		return
+
+	pool = ThreadPool(max(_jobs, 1))
+
+	try:
+		with phase_profile.phase("alternates search"):
+			found = dict(zip(keywords, pool.map(search_alternates, keywords)))
+	finally:
+		pool.close()
+		pool.join()
+
+	for l, v, kw, reason in flagged:
+		print >>sys.stderr, ":| -- Alternates for component: [%s] DKPN: [%s] Reason: %s" % (l[COL_IDX_IDS], l[COL_IDX_DKPN], reason)
+		print >>sys.stderr, "	Search:	[%s]" % kw
+
+		alts = rank_alternates(l, v, found[kw])
+
+		if len(alts) < 1:
+			print >>sys.stderr, "	No suitable alternates found."
+
+		for p in alts[:ALT_SHOW]:
+			price = part_unit_price(p)
+			print >>sys.stderr, "	%-24s	%-24s	Stock: %-8s	Price: %s" % (p.get("DigiKeyPartNumber", ""), p.get("ManufacturerPartNumber", ""), str(p.get("QuantityAvailable", "")), "?" if price is None else "%.4f" % price)
+
+		print >>sys.stderr, ""
+
+	return
+
+def read_audit_pairs(_file_name):
+	"""
+	Reads a library audit file: one DKPN and footprint per line, separated by SEP_CHAR.  Blank lines and lines starting with # are skipped.
+	@param _file_name: Audit file.
+	@return: List of rows, each shaped like a BOM row with only the DKPN and pad columns filled in, so that the BOM row functions work on them.
+	"""
+
+	ret = []
+
+	with open(_file_name, "rt") as in_file:
+		for n, line in enumerate(in_file):
+			line = line.strip()
+
+			if len(line) < 1 or line.startswith("#"):
+				continue
+
+			f = line.split(SEP_CHAR)
+
+			if len(f) < 2 or len(f[0].strip()) < 1:
+				print >>sys.stderr, "Skipping line %d of %s: expected DKPN%sfootprint." % (n + 1, _file_name, SEP_CHAR)
+				continue
+
+			l = [""] * (max(COL_IDX_DKPN, COL_IDX_PAD, COL_IDX_IDS, COL_IDX_COUNT) + 1)
+			l[COL_IDX_ROW] = str(n + 1)
+			l[COL_IDX_DKPN] = f[0].strip()
+			l[COL_IDX_PAD] = f[1].strip()
+			ret.append(l)
+
+	return ret
+
+def audit_pair_part(_dkpn):
+	"""
+	Finds a part in the parts cache without going to the network.  Age doesn't matter; the package of a part doesn't change.
+	@param _dkpn: DigiKey part number.
+	@return: Tuple of (part JSON or None, error or None)
+	"""
+
+	e = dkapia.cached_part_entry(dkapia.part_cache_key(_dkpn))
+
+	if e is None and dkapia.part_number_key(_dkpn) in AUDIT_ANY_LOCALE:
+		e = dkapia.cached_part_entry(AUDIT_ANY_LOCALE[dkapia.part_number_key(_dkpn)])
+
+	if e is None:
+		return (None, "Not in the parts cache.")
+
+	d = dkapia.part_cache_entry_data(e)
+
+	if d is None:
+		return (None, "Parts cache entry can't be decompressed.")
+
+	parts = d.get("Parts", [])
+
+	if len(parts) == 1:
+		return (parts[0], None)
+
+	for p in parts:
+		if dkapia.part_number_key(p.get("DigiKeyPartNumber", "")) == dkapia.part_number_key(_dkpn):
+			return (p, None)
+
+	return (None, "The cached search result has %d parts and none of them is %s." % (len(parts), _dkpn))
+
+def audit_load_caches():
+	"""
+	Loads what the audit classifies from: the state/config file for the locale if there is one, the parts cache, and the snapshot named by
+	DKAPIA_SNAPSHOT if any.  Then indexes the cached parts of every locale into AUDIT_ANY_LOCALE.
+	@raise ValueError: See dkapia.load_global_context.
+	@return: Nothing
+	"""
+
+	# Nothing is looked up on the network, so a bare parts cache or snapshot will do
+	if os.path.exists(dkapia.get_context_file_name()):
+		dkapia.load_global_context()
+	dkapia.load_zdict()
+	dkapia.load_parts_cache()
+
+	if os.environ.get(dkapia.SNAPSHOT_ENV):
+		dkapia.mount_cache_snapshot(os.environ[dkapia.SNAPSHOT_ENV])
+
+	AUDIT_ANY_LOCALE.clear()
+
+	for key in dkapia.PARTS_CACHE.keys() + dkapia.SNAPSHOT_PARTS.keys():
+		pn = dkapia.part_number_key(dkapia.split_part_cache_key(key)[0])
+		other = AUDIT_ANY_LOCALE.get(pn)
+
+		if other is None or dkapia.cached_part_entry(key)[dkapia.PK_TS] > dkapia.cached_part_entry(other)[dkapia.PK_TS]:
+			AUDIT_ANY_LOCALE[pn] = key
+
+	return
+
+def audit_worker_init():
+	"""
+	Readies an audit worker process.  Forked workers inherit the caches the parent loaded; anywhere processes are spawned instead, each one
+	loads them for itself.
+	"""
+
+	if len(AUDIT_ANY_LOCALE) < 1:
+		audit_load_caches()
+
+	return
+
+def audit_pair(_item):
+	"""
+	Classifies both sides of one library pair.  Runs in an audit worker process.
+	@param _item: Tuple of (index, row)
+	@return: Tuple of (index, verdict map or None, error or None)
+	"""
+
+	i, l = _item
+
+	try:
+		jo, err = audit_pair_part(l[COL_IDX_DKPN])
 
 		if jo is None:
-			continue
+			return (i, None, err)
 
 		dk_mount,dk_package = guess_digikey_package(jo)
 		sc_mount,sc_package = guess_schematic_package(l)
+	except Exception, e:
+		return (i, None, str(e))
+
+	v = {}
+	v[VK_DK_MOUNT] = dk_mount
+	v[VK_DK_PACKAGE] = dk_package
+	v[VK_SC_MOUNT] = sc_mount
+	v[VK_SC_PACKAGE] = sc_package
+
+	return (i, v, None)
+
+def audit_chunk(_items):
+	"""
+	Classifies a chunk of library pairs.  Runs in an audit worker process.
+	@param _items: List of (index, row)
+	@return: List of what audit_pair returns.
+	"""
 
-		if DEBUG:
-			print ""
+	return [audit_pair(item) for item in _items]
 
+def audit_library(_file_name, _jobs, _chunk, _jsonl=None):
+	"""
+	Classifies every (DKPN, footprint) pair of a library audit file against the parts cache, sharded across _jobs processes, _chunk pairs at a time.
+	Nothing is looked up on the network; parts that aren't cached are reported as such.  Results are merged and reported in file order.
+	@param _file_name: Audit file, see read_audit_pairs.
+	@param _jobs: Number of worker processes.
+	@param _chunk: Pairs handed to a worker at a time.
+	@param _jsonl: If not None, a file that gets a JSON line (see row_record) per pair.
+	@return: List of (row, verdict) for every pair that could be classified, in file order.
+	"""
 
-		#print dkpn + " --> " + str(guess_digikey_package(jo))
+	with phase_profile.phase("bom read"):
+		rows = read_audit_pairs(_file_name)
 
-		if dk_mount != sc_mount or dk_package != sc_package:
+	with phase_profile.phase("cache load"):
+		try:
+			audit_load_caches()
+		except ValueError, e:
+			print >>sys.stderr, "Failed to load dkapia state/config file: " + str(e)
+			return []
 
-			#
-			# Pointers to footprint conversion functions
-			#
-			dk_fc = None
-			sc_fc = None
+	jobs = max(_jobs, 1)
+	results = [None] * len(rows)
+	progress = ProgressLine(len(rows))
+	start = time.time()
 
-			if dk_mount == package_types.PKG_MOUNT_TYPE_SMT:
-				dk_fc = package_types.digikey_smt_type_to_string
-			elif dk_mount == package_types.PKG_MOUNT_TYPE_TH: 
-				dk_fc = package_types.digikey_th_type_to_string
-			else:
-				dk_fc = package_types.digikey_invalid_type_to_string
+	with phase_profile.phase("audit"):
+		pool = multiprocessing.Pool(jobs, audit_worker_init)
 
-			if sc_mount == package_types.PKG_MOUNT_TYPE_SMT:
-				sc_fc = package_types.schematic_smt_type_to_string
-			elif sc_mount == package_types.PKG_MOUNT_TYPE_TH: 
-				sc_fc = package_types.schematic_th_type_to_string
+		try:
+			chunk = max(_chunk, 1)
+			chunks = [[(i, rows[i]) for i in range(c, min(c + chunk, len(rows)))] for c in range(0, len(rows), chunk)]
+
+			# Whole chunks are the tasks, rather than imap's chunksize, so that waiting for them can time out to update the progress line
+			it = pool.imap_unordered(audit_chunk, chunks)
+			done = 0
+
+			while done < len(rows):
+				try:
+					items = it.next(PROGRESS_INTERVAL)
+				except multiprocessing.TimeoutError:
+					progress.update(done)
+					continue
+
+				for i, v, err in items:
+					results[i] = (v, err)
+
+				done = done + len(items)
+				progress.update(done)
+
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+			progress.clear()
+
+	elapsed = max(time.time() - start, 0.001)
+
+	ret = []
+	failed = []
+	mismatches = 0
+
+	with phase_profile.phase("report"):
+		for i in range(len(rows)):
+			l = rows[i]
+			v, err = results[i]
+
+			if v is None:
+				failed.append((l[COL_IDX_ROW], l[COL_IDX_DKPN], err))
 			else:
-				sc_fc = package_types.schematic_invalid_type_to_string				
+				ret.append((l, v))
+
+				if is_mismatch(v):
+					mismatches = mismatches + 1
+					report_mismatch("%s @ %s" % (l[COL_IDX_DKPN], l[COL_IDX_PAD]), v)
+
+			if _jsonl is not None:
+				print >>_jsonl, json.dumps(row_record(i, l, v, err, False), sort_keys=True)
 
-			print >>sys.stderr,":( -- Possible mismatch for component: [%s]" % str(comp_id)
-			print >>sys.stderr, "	Mount type:	Schematic:	[%s]	Digikey	[%s]" % (package_types.pkg_mount_type_to_string(sc_mount),package_types.pkg_mount_type_to_string(dk_mount));
-			print >>sys.stderr, "	Package:	Schematic:	[%s]	Digikey	[%s]" % (sc_fc(sc_package),dk_fc(dk_package));
+	print >>sys.stderr, "Audited %d pairs in %.1f s, %.0f pairs/s with %d processes: %d mismatches, %d not classified." % (len(rows), elapsed, len(rows) / elapsed, jobs, mismatches, len(failed))
 
-			print >> sys.stderr,""
+	if len(failed) > 0:
+		print >>sys.stderr, "Failed to classify %d pairs:" % len(failed)
 
+		for line, dkpn, err in failed:
+			print >>sys.stderr, "	line %s	%s	%s" % (line, dkpn, first_error_line(err))
 
+	return ret
 
+def setup_argparse():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("-i", help="BOM file to check.  Defaults to the INFILE configured in the script.", default=INFILE)
+	parser.add_argument("-F", action="store_true", help="Force a full re-check ignoring previous verdicts.")
+	parser.add_argument("-ttl", help="Hours a previous verdict stays valid.  Defaults to %d." % VERDICT_TTL_HOURS, default=VERDICT_TTL_HOURS, type=float)
+	parser.add_argument("-j", help="Number of rows looked up at once.  Defaults to %d." % CHECK_JOBS, default=CHECK_JOBS, type=int)
+	parser.add_argument("-ordered", action="store_true", help="Report rows in BOM order.  Rows are still looked up concurrently; each one is reported once the rows before it are done.")
+	parser.add_argument("-jsonl", help="Also write a JSON line per row to this file as rows are reported.  '-' for stdout.")
+	parser.add_argument("-alt", action="store_true", help="Look for alternates for rows with a package mismatch or low stock.")
+	parser.add_argument("-altLowStock", help="With -alt, rows whose part has fewer than this many available are flagged.  Defaults to %d." % ALT_LOW_STOCK, default=ALT_LOW_STOCK, type=int)
+	parser.add_argument("-altJobs", help="With -alt, number of keyword searches in flight at once.  Defaults to %d." % ALT_JOBS, default=ALT_JOBS, type=int)
+	parser.add_argument("-audit", help="Audit a component library instead of checking a BOM: classify every DKPN%sfootprint line of this file from the parts cache using a pool of processes." % SEP_CHAR)
+	parser.add_argument("-auditJobs", help="With -audit, number of worker processes.  Defaults to the number of CPUs (%d here)." % multiprocessing.cpu_count(), default=multiprocessing.cpu_count(), type=int)
+	parser.add_argument("-auditChunk", help="With -audit, pairs handed to a worker process at a time.  Defaults to %d." % AUDIT_CHUNK_SIZE, default=AUDIT_CHUNK_SIZE, type=int)
+	parser.add_argument("--profile", action="store_true", help="Time the phases of the run and print a breakdown to stderr at the end.")
+	parser.add_argument("--profile-dump", help="With --profile, also profile the whole run with cProfile and dump the pstats to this file.")
+
+	return parser
+
+def main():
+	args = setup_argparse().parse_args()
+
+	if args.profile:
+		phase_profile.start(args.profile_dump)
+
+	try:
+		dkapia.load_parametrics_cache()
+
+		jsonl = None
+
+		if args.jsonl == "-":
+			jsonl = sys.stdout
+		elif args.jsonl:
+			jsonl = open(args.jsonl, "wt")
+
+		try:
+			if args.audit:
+				audit_library(args.audit, args.auditJobs, args.auditChunk, jsonl)
+				return
+
+			results = check_bom(args.i, args.ttl * 60 * 60, args.F, args.j, args.ordered, jsonl)
+		finally:
+			if jsonl is not None and jsonl is not sys.stdout:
+				jsonl.close()
+
+		if args.alt:
+			try:
+				dkapia.load_global_context()
+			except ValueError, e:
+				print >>sys.stderr, "Failed to load dkapia state/config file: " + str(e)
+				return
+
+			dkapia.load_zdict()
+			dkapia.load_parts_cache()
+			dkapia.load_negative_cache()
+
+			if os.environ.get(dkapia.SNAPSHOT_ENV):
+				dkapia.mount_cache_snapshot(os.environ[dkapia.SNAPSHOT_ENV])
+
+			find_alternates(results, args.altLowStock, args.altJobs)
+
+			dkapia.save_global_context()
+			dkapia.save_parts_cache()
+			dkapia.save_negative_cache()
+			dkapia.save_part_index()
+			dkapia.save_price_history()
+	finally:
+		phase_profile.report()
+
+if __name__ == '__main__':
+	main()
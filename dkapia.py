@@ -37,14 +37,37 @@
 
 import requests
 import os.path
+import stat
 import json
 import sys
 import datetime
+# datetime.strptime imports this lazily, which blows up if the first call happens in two threads at once
+import _strptime
 import argparse
 import traceback
+import time
+import heapq
+import re
+import zlib
+import base64
+import threading
+import Queue
+import urlparse
+import email.utils
+
+try:
+	import fcntl
+except ImportError:
+	# No cross-process locking on this platform; the in-process lock still applies
+	fcntl = None
 
 from HTMLParser import HTMLParser
 
+import phase_profile
+import part_index
+import price_history
+import memory_cache
+
 class MyHTMLParser(HTMLParser):
 	"""
 	We use this to dig out the 'FORM' element out of the login form that we need to get past in order to get initial magic tokens.
@@ -67,11 +90,98 @@ The file we keep our application state, configuration parameters, and super secr
 """
 STATE_FILE = ".digi-key_api_state.json"
 
+"""
+Lock file that serializes token refreshes and state file writes between dkapia processes.
+"""
+STATE_LOCK_FILE = ".digi-key_api_state.lock"
+
 """
 The file we're going to be caching parametric information in.
 """
 PARAMETRICS_FILE = ".digi-key_api_parametrics.json"
 
+"""
+The file we're going to be caching part search results in.
+"""
+PARTS_FILE = ".digi-key_api_parts.json"
+
+"""
+The file we're going to be caching failed part lookups in.
+"""
+NEGATIVE_FILE = ".digi-key_api_negative.json"
+
+"""
+Optional shared dictionary used to prime the compression of cached search results.  See CACHE_TRAIN_DICT.
+"""
+ZDICT_FILE = ".digi-key_api_zdict.bin"
+
+"""
+The file the refresh scheduler keeps its queue and call log in.
+"""
+REFRESH_STATE_FILE = ".digi-key_api_refresh.json"
+
+"""
+The file we keep the local part number index in.  See LOCAL_SEARCH.
+"""
+INDEX_FILE = ".digi-key_api_index.json"
+
+"""
+The file PREFETCH keeps its progress in so that an interrupted run can be resumed.
+"""
+PREFETCH_FILE = ".digi-key_api_prefetch.json"
+
+"""
+Lock file for lookups in flight.  Each parts cache key locks its own byte of it; see FlightLock.
+"""
+FLIGHT_LOCK_FILE = ".digi-key_api_flight.lock"
+
+"""
+Directory where a process that looked a part up leaves the result for the other processes that were waiting for it.
+"""
+FLIGHT_DIR = ".digi-key_api_flight"
+
+"""
+Stock and price history records.  Binary; see price_history.py.
+"""
+HISTORY_FILE = ".digi-key_api_history.bin"
+
+"""
+Part names and chain heads of the stock and price history.
+"""
+HISTORY_PARTS_FILE = ".digi-key_api_history.json"
+
+"""
+The file AUTH_KEEPER keeps the health of every credential in.  Kept out of the state file, which every dkapia process writes its own copy of.
+"""
+KEEPER_FILE = ".digi-key_api_keeper.json"
+
+"""
+Environment variable naming a cache snapshot to mount read-only.  Same as -snapshot; inherited by the dkapia processes check_bom.py starts.
+"""
+SNAPSHOT_ENV = "DKAPIA_SNAPSHOT"
+
+"""
+(language, currency) the API answers in when the locale headers are left out.  Cache keys of results in this locale are plain part numbers, same as
+every entry cached before locales were supported, so old caches need no migration.
+"""
+API_DEFAULT_LOCALE = ("en", "usd")
+
+"""
+(language, currency) of lookups that don't ask for a particular one.  Set from the state/config file and -locale/-currency.
+"""
+LOCALE = API_DEFAULT_LOCALE
+
+"""
+Part fields that depend on the locale.  LOCALE_PRICING gathers these from every locale asked for.
+"""
+LOCALE_PRICE_FIELDS = ("StandardPricing", "UnitPrice", "QuantityAvailable")
+
+"""
+Identifies a cache snapshot file and the version of its layout.
+"""
+SNAPSHOT_FORMAT = "digi-key_api_cache_snapshot"
+SNAPSHOT_VERSION = 1
+
 """
 The Digi-Key search API endpoint
 """
@@ -82,16 +192,390 @@ The Digi-Key search API endpoint
 API_PART_SEARCH_URI = "https://api.digikey.com/services/partsearch/v2/keywordsearch"
 
 """
-The host that we shuffle magic strings through in order to get access to the API
+The host that we shuffle magic strings through in order to get access to the API.
+"""
+SSO_DEFAULT_HOST = "https://sso.digikey.com"
+
+"""
+SSO_DEFAULT_HOST unless overridden by SSO_HOST in the state/config file, e.g. to point at a stand-in server for testing.
+"""
+SSO_HOST = SSO_DEFAULT_HOST
+
+"""
+SSO session cookies kept between runs so that AUTH_NEW can skip the login form while the SSO session is still good.  Only readable by its owner.
+"""
+SSO_COOKIE_FILE = ".digi-key_api_sso.json"
+
+"""
+How long, in seconds, cookies that don't say when they expire are kept.  The SSO server drops its sessions well before this.
 """
-SSO_HOST = "https://sso.digikey.com"
+SSO_SESSION_COOKIE_TTL = 12 * 60 * 60
 
 """
 Application state/context
 """
 GLOBAL_CONTEXT = None
 
-PARAMETRICS_CACHE = {}
+class PartLookupError(RuntimeError):
+	"""
+	A part search that failed, with a guess at why.  kind is one of the LF_* constants.
+	"""
+
+	def __init__(self, _kind, _message):
+		RuntimeError.__init__(self, "[%s] %s" % (_kind, _message))
+		self.kind = _kind
+		self.reason = _message
+		return
+
+class StateFileLock(object):
+	"""
+	Reentrant lock that is held across threads (RLock) and across processes (flock on the state lock file).
+	The file is only locked by the outermost acquisition so a thread that already holds the lock can save the state without blocking on itself.
+	"""
+
+	def __init__(self, _file_name=None):
+		"""
+		@param _file_name: Lock file.  Defaults to the state lock file in the home directory.
+		"""
+
+		self.file_name = _file_name
+		self.lock = threading.RLock()
+		self.depth = 0
+		self.lock_file = None
+		return
+
+	def __enter__(self):
+		self.lock.acquire()
+
+		if self.depth == 0 and fcntl is not None:
+			try:
+				self.lock_file = open(self.file_name or get_state_lock_file_name(), "a")
+				fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+			except Exception:
+				self.lock.release()
+				raise
+
+		self.depth = self.depth + 1
+
+		return self
+
+	def __exit__(self, _type, _value, _tb):
+		self.depth = self.depth - 1
+
+		if self.depth == 0 and self.lock_file is not None:
+			fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+			self.lock_file.close()
+			self.lock_file = None
+
+		self.lock.release()
+
+		return False
+
+"""
+Held while refreshing tokens or writing the state file.
+"""
+STATE_FILE_LOCK = StateFileLock()
+
+class FlightLock(object):
+	"""
+	Cross-process lock on one parts cache key: an fcntl record lock on one byte of the flight lock file, at an offset given by the CRC of the key.
+	Record locks belong to the process, not the file descriptor, and closing any descriptor of the file drops all of them, so the file is opened once
+	and kept open.  Threads of one process don't exclude each other through this; lookup_part_data_shared takes care of that.
+	"""
+
+	lock_file = None
+	open_lock = threading.Lock()
+
+	def __init__(self, _key):
+		self.offset = zlib.crc32(_key) & 0x0fffffff
+		return
+
+	def __enter__(self):
+		if fcntl is None:
+			return self
+
+		with FlightLock.open_lock:
+			if FlightLock.lock_file is None:
+				FlightLock.lock_file = open(get_flight_lock_file_name(), "a")
+
+		fcntl.lockf(FlightLock.lock_file.fileno(), fcntl.LOCK_EX, 1, self.offset)
+
+		return self
+
+	def __exit__(self, _type, _value, _tb):
+		if fcntl is not None:
+			fcntl.lockf(FlightLock.lock_file.fileno(), fcntl.LOCK_UN, 1, self.offset)
+
+		return False
+
+class PartFlight(object):
+	"""
+	A lookup in flight.  The thread that started it sets data or error and then the event; the threads that joined it wait on the event.
+	"""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.data = None
+		self.error = None
+		return
+
+class ParameterDictionary(object):
+	"""
+	Everything we have learned about Digi-Key parameters: ParameterId to parameter name and (ParameterId, ValueId) to value text.
+	Learned from every part of every search response.  All strings are interned so that the thousands of parts sharing "Surface Mount" share one string,
+	and lookups are by integer ID in both directions.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.names = {}
+		self.values = {}
+		self.value_ids = {}
+		self.strings = {}
+		self.dirty = False
+		return
+
+	def intern(self, _s):
+		return self.strings.setdefault(_s, _s)
+
+	def learn_value(self, _pid, _vid, _text):
+		"""
+		Records a single (ParameterId, ValueId, text) triple.  Must be called with the lock held.
+		"""
+
+		v = self.values.setdefault(_pid, {})
+
+		if v.get(_vid) != _text:
+			_text = self.intern(_text)
+			v[_vid] = _text
+			self.value_ids.setdefault(_pid, {})[_text] = _vid
+			self.dirty = True
+
+		return
+
+	def learn(self, _parts):
+		"""
+		Learns the parameters of every part in a search response.
+		@param _parts: List of parts.
+		@return: Nothing
+		"""
+
+		with self.lock:
+			for part in _parts:
+				for p in part.get("Parameters", []):
+					try:
+						pid = int(p["ParameterId"])
+					except (KeyError, ValueError, TypeError):
+						continue
+
+					if self.names.get(pid) != p.get("Parameter"):
+						self.names[pid] = self.intern(p.get("Parameter"))
+						self.dirty = True
+
+					try:
+						self.learn_value(pid, int(p["ValueId"]), p["Value"])
+					except (KeyError, ValueError, TypeError):
+						pass
+
+		return
+
+	def name(self, _pid):
+		"""
+		@return: Name of the parameter or None if we have never seen it.
+		"""
+
+		return self.names.get(_pid)
+
+	def value_text(self, _pid, _vid):
+		"""
+		@return: Text of the parameter value or None if we have never seen it.
+		"""
+
+		return self.values.get(_pid, {}).get(_vid)
+
+	def value_id(self, _pid, _text):
+		"""
+		@return: ValueId of the parameter value text or None if we have never seen it.
+		"""
+
+		return self.value_ids.get(_pid, {}).get(_text)
+
+	def to_json(self):
+		"""
+		@return: Compact JSON-able form.  JSON object keys have to be strings so the IDs are stringified.
+		"""
+
+		with self.lock:
+			ret = {}
+			ret["P"] = dict([(str(k), v) for k, v in self.names.items()])
+			ret["V"] = dict([(str(k), dict([(str(i), t) for i, t in v.items()])) for k, v in self.values.items()])
+
+		return ret
+
+	def from_json(self, _jo):
+		"""
+		Loads what to_json produced.  Also takes the old flat parameter ID to name map.
+		"""
+
+		self.merge_json(_jo)
+		self.dirty = False
+
+		return
+
+	def merge_json(self, _jo):
+		"""
+		Adds what to_json produced, from another dictionary, to this one.  Marks us dirty if anything was new.
+		"""
+
+		with self.lock:
+			if "P" not in _jo:
+				_jo = {"P": _jo, "V": {}}
+
+			for k, v in _jo["P"].items():
+				if self.names.get(int(k)) != v:
+					self.names[int(k)] = self.intern(v)
+					self.dirty = True
+
+			for k, v in _jo["V"].items():
+				for i, t in v.items():
+					self.learn_value(int(k), int(i), t)
+
+		return
+
+PARAMETRICS_CACHE = ParameterDictionary()
+
+"""
+Every Digi-Key and manufacturer part number in the parts cache, for LOCAL_SEARCH.  Loaded by get_part_index the first time it is needed.
+"""
+PART_INDEX = None
+
+"""
+Default number of LOCAL_SEARCH results.
+"""
+LOCAL_SEARCH_LIMIT = 20
+
+"""
+Default size of MEMORY_CACHE in approximate bytes.  Overridden by MEMORY_CACHE_BYTES in the state/config file or by configure_memory_cache.
+"""
+MEMORY_CACHE_DEFAULT_BYTES = 32 * 1024 * 1024
+
+"""
+Decoded search results of recently used parts, keyed by parts cache key.  The parts cache itself keeps results compressed.
+"""
+MEMORY_CACHE = memory_cache.MemoryCache(MEMORY_CACHE_DEFAULT_BYTES)
+
+"""
+Stock and price history.  Created on first use by get_price_history().
+"""
+PRICE_HISTORY = None
+
+# Parameter IDs we care about
+PARAM_ID_PACKAGE = 16
+PARAM_ID_MOUNTING_TYPE = 69
+
+"""
+Cached part search results keyed by the normalized part number.
+"""
+PARTS_CACHE = {}
+
+"""
+Part search results from a snapshot mounted with -snapshot, keyed by the normalized part number.  Consulted when PARTS_CACHE has nothing newer.
+Never saved.
+"""
+SNAPSHOT_PARTS = {}
+
+"""
+Part numbers that are known not to work, keyed by the normalized part number.
+"""
+NEGATIVE_CACHE = {}
+
+"""
+When entries were taken out of NEGATIVE_CACHE, keyed by the normalized part number.  Keeps save_negative_cache from bringing them back from the file.
+"""
+NEGATIVE_CLEARED = {}
+
+"""
+How long, in seconds, a known-bad part number is remembered.  Shorter than PART_CACHE_TTL so that a part that shows up on Digi-Key later isn't missed
+for long.
+"""
+NEGATIVE_CACHE_TTL = 12 * 60 * 60
+
+"""
+Serializes changes to, and saves of, the parts cache when we have more than one thread going.
+"""
+STATE_LOCK = threading.RLock()
+
+"""
+Parts cache key to the PartFlight of the lookup in progress for it.
+"""
+PART_FLIGHTS = {}
+PART_FLIGHTS_LOCK = threading.Lock()
+
+"""
+How long, in seconds, a lookup result is left in FLIGHT_DIR for other processes.  The parts cache file has it after that.
+"""
+FLIGHT_RESULT_TTL = 10 * 60
+
+"""
+Number of API calls currently in flight on, and made so far by, each credential, keyed by client ID.  Guarded by CREDENTIAL_LOCK.
+"""
+CREDENTIAL_IN_FLIGHT = {}
+CREDENTIAL_CALLS = {}
+CREDENTIAL_LOCK = threading.Lock()
+
+"""
+How long, in seconds, a cached part search result is good for.
+"""
+PART_CACHE_TTL = 24 * 60 * 60
+
+"""
+The part count (RecordCount) of the searches the parts cache holds.  Searches with any other count go to the API and aren't cached.
+"""
+PART_CACHE_COUNT = 1
+
+"""
+Shared compression dictionary and its ID.  None if there is no dictionary.
+"""
+ZDICT = None
+ZDICT_ID = None
+
+"""
+Compressor and decompressor that have already been fed the shared dictionary.  Copied for every entry.
+"""
+ZDICT_COMPRESSOR = None
+ZDICT_DECOMPRESSOR = None
+
+"""
+Results per page of a paginated keyword search.  50 is the most the API hands out at once.
+"""
+KEYWORD_PAGE_SIZE = 50
+
+"""
+Access tokens are refreshed this many seconds before they expire.
+"""
+TOKEN_EXPIRY_MARGIN = 5 * 60
+
+"""
+AUTH_KEEPER refreshes tokens this many seconds before they expire, well ahead of TOKEN_EXPIRY_MARGIN so that part searches never have to.  Tokens that
+live less than twice this long are refreshed halfway through their life instead.
+"""
+KEEPER_REFRESH_MARGIN = 15 * 60
+
+"""
+AUTH_KEEPER retries a failed refresh after KEEPER_RETRY_MIN seconds, doubling the wait after every further failure up to KEEPER_RETRY_MAX.
+"""
+KEEPER_RETRY_MIN = 60
+KEEPER_RETRY_MAX = 30 * 60
+
+"""
+AUTH_KEEPER_LOOP re-reads the state file at least this often, to pick up tokens other processes refreshed and credentials added since.
+"""
+KEEPER_POLL_INTERVAL = 15 * 60
+
+"""
+Upper bound on the size of a trained dictionary.  The deflate window is 32K so anything much bigger would be out of reach of the data it's priming.
+"""
+ZDICT_MAX_SIZE = 16 * 1024
 
 """
 If set by config file or command line parameters we output humorous debug information
@@ -110,12 +594,138 @@ CK_CONTEXT_REF_TOK = "REFRESH_TOKEN"
 CK_CONTEXT_ACC_TOK = "ACCESS_TOKEN"
 CK_CONTEXT_EXP = "EXPIRES"
 CK_CONTEXT_TS = "GEN_TIMESTAMP"
+CK_CONTEXT_RATE_LIMIT = "RATE_LIMIT"
+CK_CREDENTIALS = "CREDENTIALS"
+CK_LOCALE_LANGUAGE = "LOCALE_LANGUAGE"
+CK_LOCALE_CURRENCY = "LOCALE_CURRENCY"
+CK_MEMORY_CACHE_BYTES = "MEMORY_CACHE_BYTES"
+CK_SSO_HOST = "SSO_HOST"
+
+# Auth keeper health keys, per client ID in KEEPER_FILE.  Times are seconds since the epoch.
+KK_CHECKED = "CHECKED"
+KK_REFRESHED = "REFRESHED"
+KK_FAILURES = "FAILURES"
+KK_ERROR = "ERROR"
+KK_NEXT = "NEXT"
+
+# Rate limit keys within the CONTEXT
+RL_LIMIT = "LIMIT"
+RL_REMAINING = "REMAINING"
+RL_BURST_LIMIT = "BURST_LIMIT"
+RL_BURST_REMAINING = "BURST_REMAINING"
+RL_RESET = "RESET"
+RL_BURST_RESET = "BURST_RESET"
+RL_TS = "TS"
+
+"""
+Response headers that carry the rate limit information, mapped to the keys we keep them under.
+"""
+RATE_LIMIT_HEADERS = {
+	"x-ratelimit-limit": RL_LIMIT,
+	"x-ratelimit-remaining": RL_REMAINING,
+	"x-ratelimit-reset": RL_RESET,
+	"x-burstlimit-limit": RL_BURST_LIMIT,
+	"x-burstlimit-remaining": RL_BURST_REMAINING,
+	"x-burstlimit-reset": RL_BURST_RESET,
+	"retry-after": RL_RESET,
+}
+
+"""
+Once fewer than this many calls remain, batch runs spread the rest evenly until the limit resets.
+"""
+QUOTA_RESERVE = 50
+
+"""
+How long to back off when we are out of calls and the server did not say when the limit resets.
+"""
+QUOTA_DEFAULT_BACKOFF = 60
 
 PC_ID = "Id"
 
+# Flight result keys
+FK_KEY = "KEY"
+FK_TS = "TS"
+FK_DATA = "DATA"
+FK_KIND = "KIND"
+FK_REASON = "REASON"
+
+# Parts cache entry keys
+PK_TS = "TS"
+PK_LAST_USED = "LAST_USED"
+PK_DATA = "DATA"
+PK_ZDATA = "Z"
+PK_ZDICT = "ZD"
+
+# Cache snapshot keys
+SK_FORMAT = "FORMAT"
+SK_VERSION = "VERSION"
+SK_CREATED = "CREATED"
+SK_PARTS = "PARTS"
+SK_PARAMETRICS = "PARAMETRICS"
+SK_NEGATIVE = "NEGATIVE"
+
+# Negative cache entry keys
+NK_TS = "TS"
+NK_KIND = "KIND"
+NK_REASON = "REASON"
+
+# SSO cookie file keys
+SC_SAVED = "SAVED"
+SC_COOKIES = "COOKIES"
+
+# Lookup failure kinds.  Only the permanent ones are remembered in the negative cache.
+LF_INVALID = "INVALID"
+LF_NO_RESULTS = "NO_RESULTS"
+LF_AUTH = "AUTH"
+LF_TRANSIENT = "TRANSIENT"
+
+LF_PERMANENT = (LF_INVALID, LF_NO_RESULTS)
+
+# Refresh scheduler configuration keys
+CK_REFRESH_PER_MINUTE = "REFRESH_CALLS_PER_MINUTE"
+CK_REFRESH_PER_DAY = "REFRESH_CALLS_PER_DAY"
+
+# Refresh scheduler state keys
+RK_QUEUE = "QUEUE"
+RK_CALLS = "CALLS"
+
+REFRESH_DEFAULT_PER_MINUTE = 60
+REFRESH_DEFAULT_PER_DAY = 500
+
+"""
+Refresh intervals.  A part that is not low on stock, recently used, or expensive is refreshed once per REFRESH_BASE_INTERVAL.
+Each of those traits halves (low stock quarters) the interval, but never below REFRESH_MIN_INTERVAL.
+"""
+REFRESH_BASE_INTERVAL = 7 * 24 * 60 * 60
+REFRESH_MIN_INTERVAL = 60 * 60
+REFRESH_RETRY_INTERVAL = 60 * 60
+REFRESH_LOW_STOCK = 1000
+REFRESH_MEDIUM_STOCK = 10000
+REFRESH_RECENT_USE = 7 * 24 * 60 * 60
+REFRESH_HIGH_VALUE = 10.0
+
+# Prefetch progress keys
+PF_PENDING = "PENDING"
+PF_FAILED = "FAILED"
+
+PREFETCH_DEFAULT_WORKERS = 2
+
+"""
+PREFETCH saves the parts cache and its progress after this many parts so an interruption loses little work.
+"""
+PREFETCH_SAVE_EVERY = 25
+
+"""
+Seconds between PREFETCH progress lines.
+"""
+PREFETCH_REPORT_INTERVAL = 5
+
 DBG_IN_FILE = ""
 
-CMD_ARGS = None
+"""
+Command line flags that drop a section from search results, and the section each one drops.
+"""
+SECTION_FLAGS = (("rmMl", "MediaLinks"), ("rmPp", "PrimaryPhoto"), ("rmPd", "PrimaryDatasheet"))
 
 def get_context_file_name():
 	"""
@@ -125,6 +735,14 @@ def get_context_file_name():
 
 	return os.path.join(os.path.expanduser("~"), STATE_FILE)
 
+def get_state_lock_file_name():
+	"""
+	Returns the complete path to the state lock file.
+	@return: Full path to the state lock file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), STATE_LOCK_FILE)
+
 def get_parametrics_cache_file_name():
 	"""
 	Returns the complete path to the parametrics cache file.
@@ -133,41 +751,378 @@ def get_parametrics_cache_file_name():
 
 	return os.path.join(os.path.expanduser("~"), PARAMETRICS_FILE)
 
-def save_parametrics_cache():
+def get_parts_cache_file_name():
 	"""
-	Saves the parametrics cache to a JSON file.
-	@return: Nothing
+	Returns the complete path to the parts cache file.
+	@return: Full path to the parts cache file
 	"""
 
-	global PARAMETRICS_CACHE
+	return os.path.join(os.path.expanduser("~"), PARTS_FILE)
 
-	try:
-		with open(get_parametrics_cache_file_name(), "wt") as ctx_file:
-			json.dump(PARAMETRICS_CACHE, ctx_file, indent=4, sort_keys=True)
-	except Exception, e:
-		print >> sys.stderr, "Failed to save parametrics cache: " + str(e)
+def get_negative_cache_file_name():
+	"""
+	Returns the complete path to the negative cache file.
+	@return: Full path to the negative cache file
+	"""
 
-	return
+	return os.path.join(os.path.expanduser("~"), NEGATIVE_FILE)
+
+def get_zdict_file_name():
+	"""
+	Returns the complete path to the shared compression dictionary file.
+	@return: Full path to the shared compression dictionary file
+	"""
 
+	return os.path.join(os.path.expanduser("~"), ZDICT_FILE)
 
-def save_global_context():
+def get_part_index_file_name():
 	"""
-	Saves the global program sstate and configuration to a JSON file.
-	@return: Nothing
+	Returns the complete path to the part number index file.
+	@return: Full path to the part number index file
 	"""
 
-	global GLOBAL_CONTEXT
+	return os.path.join(os.path.expanduser("~"), INDEX_FILE)
 
-	try:
-		with open(get_context_file_name(), "wt") as ctx_file:
-			json.dump(GLOBAL_CONTEXT, ctx_file, indent=4, sort_keys=True)
-	except Exception, e:
-		print >> sys.stderr, "Failed to save save/configuration: " + str(e)
-		print >> sys.stderr, "Current state: " + str(GLOBAL_CONTEXT)
+def get_flight_lock_file_name():
+	"""
+	Returns the complete path to the lookups in flight lock file.
+	@return: Full path to the lookups in flight lock file
+	"""
 
-	return
+	return os.path.join(os.path.expanduser("~"), FLIGHT_LOCK_FILE)
 
-def load_parametrics_cache():
+def get_flight_result_file_name(_key):
+	"""
+	Returns the complete path to the file a lookup result for a parts cache key is shared through.
+	@param _key: Parts cache key.
+	@return: Full path to the flight result file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), FLIGHT_DIR, "%08x.json" % (zlib.crc32(_key) & 0xffffffff))
+
+def get_sso_cookie_file_name():
+	"""
+	Returns the complete path to the SSO cookie file.
+	@return: Full path to the SSO cookie file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), SSO_COOKIE_FILE)
+
+def get_history_file_name():
+	"""
+	Returns the complete path to the stock and price history record file.
+	@return: Full path to the stock and price history record file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), HISTORY_FILE)
+
+def get_history_parts_file_name():
+	"""
+	Returns the complete path to the stock and price history part name file.
+	@return: Full path to the stock and price history part name file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), HISTORY_PARTS_FILE)
+
+def get_keeper_file_name():
+	"""
+	Returns the complete path to the auth keeper health file.
+	@return: Full path to the auth keeper health file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), KEEPER_FILE)
+
+def get_prefetch_file_name():
+	"""
+	Returns the complete path to the prefetch progress file.
+	@return: Full path to the prefetch progress file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), PREFETCH_FILE)
+
+def get_refresh_state_file_name():
+	"""
+	Returns the complete path to the refresh scheduler state file.
+	@return: Full path to the refresh scheduler state file
+	"""
+
+	return os.path.join(os.path.expanduser("~"), REFRESH_STATE_FILE)
+
+def save_parametrics_cache():
+	"""
+	Saves the parametrics cache to a JSON file if anything was learned.  Whatever other processes learned since we loaded it is merged in first, and
+	the file is replaced in one go.
+	@return: Nothing
+	"""
+
+	global PARAMETRICS_CACHE
+
+	if not PARAMETRICS_CACHE.dirty:
+		return
+
+	with STATE_FILE_LOCK:
+		ours = PARAMETRICS_CACHE.to_json()
+
+		try:
+			with open(get_parametrics_cache_file_name(), "rt") as ctx_file:
+				PARAMETRICS_CACHE.merge_json(json.load(ctx_file))
+		except Exception, e:
+			# Nothing to merge
+			pass
+
+		# What we learned is newer than what the file says
+		PARAMETRICS_CACHE.merge_json(ours)
+
+		try:
+			with open(get_parametrics_cache_file_name() + ".tmp", "wt") as ctx_file:
+				json.dump(PARAMETRICS_CACHE.to_json(), ctx_file, separators=(',', ':'), sort_keys=True)
+
+			os.rename(get_parametrics_cache_file_name() + ".tmp", get_parametrics_cache_file_name())
+			PARAMETRICS_CACHE.dirty = False
+		except Exception, e:
+			print >> sys.stderr, "Failed to save parametrics cache: " + str(e)
+
+	return
+
+def save_part_index():
+	"""
+	Saves the part number index to a JSON file if anything was added to it.  Whatever other processes added since we loaded it is merged in first.
+	@return: Nothing
+	"""
+
+	if PART_INDEX is None or not PART_INDEX.dirty:
+		return
+
+	with STATE_FILE_LOCK:
+		try:
+			with open(get_part_index_file_name(), "rt") as idx_file:
+				PART_INDEX.merge_json(json.load(idx_file))
+		except Exception, e:
+			# Nothing to merge
+			pass
+
+		try:
+			with open(get_part_index_file_name() + ".tmp", "wt") as idx_file:
+				json.dump(PART_INDEX.to_json(), idx_file, separators=(',', ':'))
+
+			os.rename(get_part_index_file_name() + ".tmp", get_part_index_file_name())
+			PART_INDEX.dirty = False
+		except Exception, e:
+			print >> sys.stderr, "Failed to save part number index: " + str(e)
+
+	return
+
+def save_price_history():
+	"""
+	Appends the stock and pricing samples taken since the last save to the history file.
+	@return: Nothing
+	"""
+
+	if PRICE_HISTORY is None:
+		return
+
+	with STATE_FILE_LOCK:
+		try:
+			PRICE_HISTORY.flush()
+		except (IOError, OSError, ValueError), e:
+			print >> sys.stderr, "Failed to save stock and price history: " + str(e)
+
+	return
+
+def merge_parts_cache_file():
+	"""
+	Takes the entries of the parts cache file that are newer than ours, or that we don't have.  Several dkapia processes (e.g. check_bom.py -j) may
+	be filling the cache at the same time and each of them only knows about its own additions.  Must be called with STATE_LOCK and STATE_FILE_LOCK held.
+	@return: Nothing
+	"""
+
+	try:
+		with open(get_parts_cache_file_name(), "rt") as ctx_file:
+			disk = json.load(ctx_file)
+	except Exception, e:
+		return
+
+	for k, de in disk.items():
+		e = PARTS_CACHE.get(k)
+
+		if e is None or de[PK_TS] > e[PK_TS]:
+			if e is not None:
+				de[PK_LAST_USED] = max(de.get(PK_LAST_USED, 0), e.get(PK_LAST_USED, 0))
+			PARTS_CACHE[k] = de
+			MEMORY_CACHE.pop(k)
+		else:
+			e[PK_LAST_USED] = max(de.get(PK_LAST_USED, 0), e.get(PK_LAST_USED, 0))
+
+	return
+
+def save_parts_cache():
+	"""
+	Saves the parts cache to a JSON file.  Whatever other processes saved since we loaded it is merged in first, and the file is replaced in one go.
+	@return: Nothing
+	"""
+
+	global PARTS_CACHE
+
+	with STATE_LOCK, STATE_FILE_LOCK:
+		merge_parts_cache_file()
+
+		out = {}
+
+		for k in PARTS_CACHE.keys():
+			e = PARTS_CACHE[k]
+
+			if PK_ZDATA not in e:
+				set_part_cache_entry_data(e, e[PK_DATA])
+
+			out[k] = dict([(i, e[i]) for i in e.keys() if i != PK_DATA])
+
+		try:
+			with open(get_parts_cache_file_name() + ".tmp", "wt") as ctx_file:
+				json.dump(out, ctx_file, separators=(',', ':'))
+
+			os.rename(get_parts_cache_file_name() + ".tmp", get_parts_cache_file_name())
+		except Exception, e:
+			print >> sys.stderr, "Failed to save parts cache: " + str(e)
+
+		sweep_flight_results()
+
+	return
+
+def sweep_flight_results():
+	"""
+	Removes lookup results older than FLIGHT_RESULT_TTL from FLIGHT_DIR.  By then whoever fetched them has saved them to the parts cache file.
+	@return: Nothing
+	"""
+
+	d = os.path.join(os.path.expanduser("~"), FLIGHT_DIR)
+	now = time.time()
+
+	try:
+		names = os.listdir(d)
+	except OSError, e:
+		return
+
+	for n in names:
+		try:
+			if now - os.path.getmtime(os.path.join(d, n)) > FLIGHT_RESULT_TTL:
+				os.remove(os.path.join(d, n))
+		except OSError, e:
+			# Another process swept it first
+			pass
+
+	return
+
+def merge_negative_cache_file():
+	"""
+	Takes the entries of the negative cache file that are newer than ours, or that we don't have, unless we took them out since.  Several dkapia
+	processes may be learning bad part numbers at the same time.  Must be called with STATE_LOCK and STATE_FILE_LOCK held.
+	@return: Nothing
+	"""
+
+	try:
+		with open(get_negative_cache_file_name(), "rt") as ctx_file:
+			disk = json.load(ctx_file)
+	except Exception, e:
+		return
+
+	for k, dn in disk.items():
+		n = NEGATIVE_CACHE.get(k)
+
+		if dn[NK_TS] <= NEGATIVE_CLEARED.get(k, 0):
+			continue
+
+		if n is None or dn[NK_TS] > n[NK_TS]:
+			NEGATIVE_CACHE[k] = dn
+
+	return
+
+def save_negative_cache():
+	"""
+	Saves the negative cache to a JSON file.  Whatever other processes saved since we loaded it is merged in first, and the file is replaced in one
+	go.  Expired entries are dropped on the way out.
+	@return: Nothing
+	"""
+
+	global NEGATIVE_CACHE
+
+	with STATE_LOCK, STATE_FILE_LOCK:
+		merge_negative_cache_file()
+
+		now = time.time()
+
+		for k in NEGATIVE_CACHE.keys():
+			if now - NEGATIVE_CACHE[k][NK_TS] > NEGATIVE_CACHE_TTL:
+				del NEGATIVE_CACHE[k]
+
+		try:
+			with open(get_negative_cache_file_name() + ".tmp", "wt") as ctx_file:
+				json.dump(NEGATIVE_CACHE, ctx_file, indent=4, sort_keys=True)
+
+			os.rename(get_negative_cache_file_name() + ".tmp", get_negative_cache_file_name())
+		except Exception, e:
+			print >> sys.stderr, "Failed to save negative cache: " + str(e)
+
+	return
+
+def forget_bad_part(_key):
+	"""
+	Takes a part number out of the negative cache, and remembers when so that saving doesn't bring it back from the file.
+	@param _key: Normalized part number, see part_number_key.
+	@return: Nothing
+	"""
+
+	with STATE_LOCK:
+		NEGATIVE_CACHE.pop(_key, None)
+		NEGATIVE_CLEARED[_key] = time.time()
+
+	return
+
+def write_state_file(_file_name, _root):
+	"""
+	Replaces a state/config file in one go, so that a process reading it never sees half of it.  The new file gets the permissions of the old one, or
+	is made readable only by us if there wasn't one; it holds passwords.  Must be called with the file's lock held.
+	@param _file_name: State/config file.
+	@param _root: Whole state/config map.
+	@raise Exception: Passes along any exceptions from writing the file.
+	@return: Nothing
+	"""
+
+	try:
+		mode = stat.S_IMODE(os.stat(_file_name).st_mode)
+	except OSError, e:
+		mode = 0600
+
+	fd = os.open(_file_name + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+	os.fchmod(fd, mode)
+
+	with os.fdopen(fd, "wt") as ctx_file:
+		json.dump(_root, ctx_file, indent=4, sort_keys=True)
+
+	os.rename(_file_name + ".tmp", _file_name)
+
+	return
+
+def save_global_context():
+	"""
+	Saves the global program sstate and configuration to a JSON file.
+	@return: Nothing
+	"""
+
+	global GLOBAL_CONTEXT
+
+	with STATE_FILE_LOCK:
+		# Another process may have rotated the tokens since we loaded them.  Writing ours back would lock everyone out.
+		adopt_newer_tokens()
+
+		try:
+			write_state_file(get_context_file_name(), GLOBAL_CONTEXT)
+		except Exception, e:
+			print >> sys.stderr, "Failed to save save/configuration: " + str(e)
+			print >> sys.stderr, "Current state: " + str(GLOBAL_CONTEXT)
+
+	return
+
+def load_parametrics_cache():
 	"""
 	Loads the parametrics cache from a JSON file.
 	@raise Exception: Passes along any exceptions from the 'open' call.
@@ -178,406 +1133,3396 @@ def load_parametrics_cache():
 
 	try:
 		with open(get_parametrics_cache_file_name(), "rt") as ctx_file:
-			PARAMETRICS_CACHE = json.load(ctx_file)
+			PARAMETRICS_CACHE.from_json(json.load(ctx_file))
 	except Exception, e:
 		# Sink it quietly
 		pass
 
 	return
 
-def load_global_context():
+def load_parts_cache():
 	"""
-	Loads the global program state and configuration from a JSON file.
-	The function also performs basic sanity checking and will throw an exception if something is thought to be hinky.
-	@raise ValueError: Raises a ValueError if a required bit is missing in the file.  Should only be of concern during the first invocation.
-	@raise Exception: Passes along any exceptions from the 'open' call.
+	Loads the parts cache from a JSON file.
 	@return: Nothing
 	"""
 
-	global GLOBAL_CONTEXT
-	global CONFIG_VERSION
-	global DEBUG_FLAG
+	global PARTS_CACHE
 
 	try:
-		with open(get_context_file_name(), "rt") as ctx_file:
-			GLOBAL_CONTEXT = json.load(ctx_file)
+		with open(get_parts_cache_file_name(), "rt") as ctx_file:
+			PARTS_CACHE = json.load(ctx_file)
 	except Exception, e:
-		print >> sys.stderr, "Failed to parse state/cofig file: " + str(e)
-		raise e
+		# Sink it quietly
+		pass
+
+	return
+
+def get_part_index():
+	"""
+	Returns the part number index, loading it from its JSON file the first time.  Most runs never need it so it isn't loaded up front.
+	@return: The PartIndex.
+	"""
+
+	global PART_INDEX
+
+	with STATE_LOCK:
+		if PART_INDEX is None:
+			idx = part_index.PartIndex()
+
+			try:
+				with open(get_part_index_file_name(), "rt") as idx_file:
+					idx.from_json(json.load(idx_file))
+			except Exception, e:
+				# Sink it quietly; LOCAL_SEARCH rebuilds it
+				pass
+
+			PART_INDEX = idx
+
+	return PART_INDEX
+
+def get_price_history():
+	"""
+	Returns the stock and price history.  Nothing is read from disk until it is queried or saved.
+	@return: The PriceHistory.
+	"""
+
+	global PRICE_HISTORY
+
+	with STATE_LOCK:
+		if PRICE_HISTORY is None:
+			PRICE_HISTORY = price_history.PriceHistory(get_history_file_name(), get_history_parts_file_name())
+
+	return PRICE_HISTORY
+
+def history_keys(_parts):
+	"""
+	Works out which histories a history command is about.
+	@param _parts: Comma separated Digi-Key part numbers, or None for every part with a history.
+	@return: Sorted list of parts cache keys.  Part numbers are looked up in the current LOCALE.
+	"""
+
+	if _parts is None:
+		return sorted(get_price_history().parts)
+
+	return [part_cache_key(pn) for pn in _parts.split(",") if len(pn.strip()) > 0]
+
+def history_to_string(_cmd, _parts, _days):
+	"""
+	Answers a history query.  Reads the records of each part straight from the history file, newest first.
+	@param _cmd: HIST_TREND, HIST_MINMAX, or HIST_CHANGE.
+	@param _parts: Comma separated Digi-Key part numbers, or None for every part with a history.
+	@param _days: Only look at the last this many days.  All of the history if None.  Ignored by HIST_CHANGE.
+	@return: Human readable multi-line string.
+	"""
+
+	h = get_price_history()
+	h.open()
+
+	since = 0
+
+	if _days is not None:
+		since = time.time() - _days * price_history.DAY
+
+	def ts(_s):
+		return datetime.datetime.fromtimestamp(_s[price_history.HS_TS]).strftime("%Y-%m-%d %H:%M")
+
+	def price(_s):
+		p = price_history.unit_price(_s)
+
+		if p is None:
+			return "?"
+
+		return "%.4f" % p
+
+	def qty(_s):
+		if _s[price_history.HS_QTY] < 0:
+			return "?"
+
+		return str(_s[price_history.HS_QTY])
+
+	ret = []
+
+	for key in history_keys(_parts):
+		if _cmd == "HIST_TREND":
+			t = h.trend(key, since)
+
+			if t is None:
+				ret.append("%-30s no history" % key)
+				continue
+
+			if t["SLOPE"] is None:
+				slope = "no trend yet"
+			else:
+				slope = "%+.1f/day" % t["SLOPE"]
+
+			if t["DAYS_LEFT"] is not None:
+				slope = slope + ", out in ~%.0f days" % t["DAYS_LEFT"]
+
+			ret.append("%-30s %6d samples %s .. %s  stock %s -> %s (%s)  price %s -> %s" % (key, t["SAMPLES"], ts(t["FIRST"]), ts(t["LAST"]), qty(t["FIRST"]), qty(t["LAST"]), slope, price(t["FIRST"]), price(t["LAST"])))
+		elif _cmd == "HIST_MINMAX":
+			m = h.min_max(key, since)
+
+			if m is None:
+				ret.append("%-30s no history" % key)
+				continue
+
+			line = "%-30s %6d samples" % (key, m["SAMPLES"])
+
+			if m["MIN_QTY"] is not None:
+				line = line + "  stock %s (%s) .. %s (%s)" % (qty(m["MIN_QTY"]), ts(m["MIN_QTY"]), qty(m["MAX_QTY"]), ts(m["MAX_QTY"]))
+
+			if m["MIN_PRICE"] is not None:
+				line = line + "  price %s (%s) .. %s (%s)" % (price(m["MIN_PRICE"]), ts(m["MIN_PRICE"]), price(m["MAX_PRICE"]), ts(m["MAX_PRICE"]))
+
+			ret.append(line)
+		else:
+			c = h.last_change(key)
+
+			if key not in h.ids:
+				ret.append("%-30s no history" % key)
+				continue
+
+			if c is None:
+				ret.append("%-30s no change on record" % key)
+				continue
+
+			before, after = c
+			what = []
+
+			if before[price_history.HS_QTY] != after[price_history.HS_QTY]:
+				what.append("stock %s -> %s" % (qty(before), qty(after)))
+
+			if before[price_history.HS_TIERS] != after[price_history.HS_TIERS]:
+				what.append("price %s -> %s" % (price(before), price(after)))
+
+				if price(before) == price(after):
+					what.append("other price tiers changed")
+
+			ret.append("%-30s between %s and %s: %s" % (key, ts(before), ts(after), ", ".join(what)))
+
+	if len(ret) < 1:
+		return "No stock and price history recorded yet."
+
+	return "\n".join(ret)
+
+def rebuild_part_index():
+	"""
+	Indexes every part in the parts cache from scratch.
+	@return: Number of parts indexed.
+	"""
+
+	global PART_INDEX
+
+	PART_INDEX = part_index.PartIndex()
+
+	with STATE_LOCK:
+		for e in PARTS_CACHE.values():
+			d = part_cache_entry_data(e)
+
+			if d is not None:
+				PART_INDEX.add_parts(d.get("Parts", []))
+
+	# Not merged with the file; whatever is in it is what we are replacing
+	try:
+		os.remove(get_part_index_file_name())
+	except OSError:
+		pass
+
+	PART_INDEX.dirty = True
+
+	return len(PART_INDEX)
+
+def local_search(_query, _limit, _fuzzy):
+	"""
+	Looks up a piece of a Digi-Key or manufacturer part number in the part number index and prints the matches.  No remote calls.
+	@param _query: Part number or a piece of one.
+	@param _limit: Maximum number of results.
+	@param _fuzzy: Look for substring and look-alike matches even if there are enough prefix matches.
+	@return: Number of matches.
+	"""
+
+	if len(get_part_index()) < 1 and len(PARTS_CACHE) > 0:
+		print >> sys.stderr, "Indexed %d parts." % rebuild_part_index()
+
+	matches = PART_INDEX.search(_query, _limit, _fuzzy)
+
+	for dkpn, term, how in matches:
+		info = PART_INDEX.part_info(dkpn)
+		print (u"%-24s %-24s %-20s %-9s %s" % (dkpn, info[part_index.II_MPN], info[part_index.II_MFG], how, info[part_index.II_DESC])).encode("utf-8")
+
+	if len(matches) < 1:
+		print >> sys.stderr, "No parts matching [%s] in the local index." % _query
+
+	return len(matches)
+
+def load_negative_cache():
+	"""
+	Loads the negative cache from a JSON file.
+	@return: Nothing
+	"""
+
+	global NEGATIVE_CACHE
+
+	try:
+		with open(get_negative_cache_file_name(), "rt") as ctx_file:
+			NEGATIVE_CACHE = json.load(ctx_file)
+	except Exception, e:
+		# Sink it quietly
+		pass
+
+	return
+
+def load_zdict():
+	"""
+	Loads the shared compression dictionary, if there is one, and primes a compressor and a decompressor with it.
+	@return: Nothing
+	"""
+
+	global ZDICT
+	global ZDICT_ID
+
+	try:
+		with open(get_zdict_file_name(), "rb") as z_file:
+			set_zdict(z_file.read())
+	except IOError, e:
+		# No dictionary; plain zlib it is
+		ZDICT = None
+		ZDICT_ID = None
+
+	return
+
+def set_zdict(_zdict):
+	"""
+	Makes _zdict the shared compression dictionary.
+	Python 2.7's zlib can't take a preset dictionary so we get the same effect by compressing the dictionary first, sync flushing, and copying the primed
+	compressor for every entry.  The decompressor is primed the same way by feeding it the compressed dictionary.
+	@param _zdict: Dictionary contents.  None or empty to go without.
+	@return: Nothing
+	"""
+
+	global ZDICT
+	global ZDICT_ID
+	global ZDICT_COMPRESSOR
+	global ZDICT_DECOMPRESSOR
+
+	if not _zdict:
+		ZDICT = None
+		ZDICT_ID = None
+		return
+
+	c = zlib.compressobj(9)
+	prefix = c.compress(_zdict) + c.flush(zlib.Z_SYNC_FLUSH)
+
+	d = zlib.decompressobj()
+	d.decompress(prefix)
+
+	ZDICT = _zdict
+	ZDICT_ID = "%08x" % (zlib.crc32(_zdict) & 0xffffffff)
+	ZDICT_COMPRESSOR = c
+	ZDICT_DECOMPRESSOR = d
+
+	return
+
+def compress_part_data(_data):
+	"""
+	Compresses a search result for storage in the parts cache.
+	@param _data: Search result as returned by get_part_data.
+	@return: Tuple of (base64 encoded compressed JSON, ID of the dictionary used or None)
+	"""
+
+	raw = json.dumps(_data, separators=(',', ':'))
+
+	if ZDICT is None:
+		return (base64.b64encode(zlib.compress(raw, 9)), None)
+
+	c = ZDICT_COMPRESSOR.copy()
+
+	return (base64.b64encode(c.compress(raw) + c.flush()), ZDICT_ID)
+
+def decompress_part_data(_zdata, _zdict_id):
+	"""
+	Reverses compress_part_data.
+	@param _zdata: Base64 encoded compressed JSON.
+	@param _zdict_id: ID of the dictionary the data was compressed with or None.
+	@return: Search result or None if the data was compressed with a dictionary we no longer have.
+	"""
+
+	raw = base64.b64decode(_zdata)
+
+	if _zdict_id is None:
+		return json.loads(zlib.decompress(raw))
+
+	if _zdict_id != ZDICT_ID:
+		return None
+
+	d = ZDICT_DECOMPRESSOR.copy()
+
+	return json.loads(d.decompress(raw) + d.flush())
+
+def part_cache_entry_data(_entry):
+	"""
+	Returns the search result held in a parts cache entry.  Compressed entries are decompressed on every call and the result is not kept; that is what
+	MEMORY_CACHE is for.
+	@param _entry: Parts cache entry.
+	@return: Search result or None if it can't be decompressed.
+	"""
+
+	if PK_DATA in _entry:
+		return _entry[PK_DATA]
+
+	with phase_profile.phase("cache decompress"):
+		return decompress_part_data(_entry[PK_ZDATA], _entry.get(PK_ZDICT))
+
+def set_part_cache_entry_data(_entry, _data):
+	"""
+	Stores a search result in a parts cache entry, compressed.
+	@param _entry: Parts cache entry.
+	@param _data: Search result.
+	@return: Nothing
+	"""
+
+	_entry[PK_ZDATA], _entry[PK_ZDICT] = compress_part_data(_data)
+	_entry.pop(PK_DATA, None)
+
+	return
+
+def configure_memory_cache(_max_bytes, _ttl=None):
+	"""
+	Replaces MEMORY_CACHE with an empty one of the given size.  For programs that use dkapia as a library.
+	@param _max_bytes: Size in approximate bytes; see memory_cache.approximate_size.  Zero turns it off.
+	@param _ttl: Time to live of an entry in seconds, on top of the _ttl of get_cached_part_data.  None for no limit.
+	@return: Nothing
+	"""
+
+	global MEMORY_CACHE
+
+	MEMORY_CACHE = memory_cache.MemoryCache(_max_bytes, _ttl)
+
+	return
+
+def train_zdict():
+	"""
+	Builds a shared compression dictionary from the parts cache and recompresses the cache with it.
+	The dictionary is made of the JSON fragments that show up most often in cached results, most frequent last so that they end up closest to the data.
+	@return: Size of the new dictionary in bytes.
+	"""
+
+	counts = {}
+
+	def walk(_o):
+		if isinstance(_o, dict):
+			for k in _o.keys():
+				frag = json.dumps({k: _o[k]}, separators=(',', ':'))[1:-1]
+
+				if len(frag) < 512:
+					counts[frag] = counts.get(frag, 0) + 1
+
+				walk(_o[k])
+		elif isinstance(_o, list):
+			for i in _o:
+				walk(i)
+
+	for e in PARTS_CACHE.values():
+		d = part_cache_entry_data(e)
+
+		if d is not None:
+			walk(d)
+
+	# Rank by bytes saved; one-offs save nothing
+	ranked = sorted([f for f in counts.keys() if counts[f] > 1], key=lambda f: counts[f] * len(f), reverse=True)
+
+	picked = []
+	size = 0
+
+	for f in ranked:
+		if size + len(f) + 1 > ZDICT_MAX_SIZE:
+			continue
+		picked.append(f)
+		size = size + len(f) + 1
+
+	picked.reverse()
+	zdict = ",".join(picked)
+
+	try:
+		with open(get_zdict_file_name(), "wb") as z_file:
+			z_file.write(zdict)
+	except IOError, e:
+		print >> sys.stderr, "Failed to save compression dictionary: " + str(e)
+		return 0
+
+	# Everything that was readable gets recompressed with the new dictionary on save
+	for k in PARTS_CACHE.keys():
+		e = PARTS_CACHE[k]
+		d = part_cache_entry_data(e)
+
+		if d is None:
+			del PARTS_CACHE[k]
+			continue
+
+		e[PK_DATA] = d
+		e.pop(PK_ZDATA, None)
+		e.pop(PK_ZDICT, None)
+
+	set_zdict(zdict)
+
+	return len(zdict)
+
+def read_cache_snapshot(_file_name):
+	"""
+	Reads a cache snapshot made by export_cache_snapshot.
+	@param _file_name: Snapshot file.
+	@raise ValueError: Raises a ValueError if the file is not a snapshot or is from a newer version of this program.
+	@raise Exception: Passes along any exceptions from the 'open' call.
+	@return: The snapshot object.
+	"""
+
+	with open(_file_name, "rb") as s_file:
+		raw = s_file.read()
+
+	try:
+		jo = json.loads(zlib.decompress(raw))
+	except (zlib.error, ValueError), e:
+		raise ValueError("%s is not a cache snapshot: %s" % (_file_name, str(e)))
+
+	if not isinstance(jo, dict) or jo.get(SK_FORMAT) != SNAPSHOT_FORMAT:
+		raise ValueError("%s is not a cache snapshot." % _file_name)
+
+	if jo.get(SK_VERSION, 0) > SNAPSHOT_VERSION:
+		raise ValueError("%s is a version %s snapshot.  This program only understands up to version %d." % (_file_name, str(jo.get(SK_VERSION)), SNAPSHOT_VERSION))
+
+	return jo
+
+def export_cache_snapshot(_file_name):
+	"""
+	Writes the parts, parametrics, and negative caches to a single compressed snapshot file.  The results are stored decompressed inside the snapshot,
+	which is compressed as a whole, so that it doesn't depend on the compression dictionary of this machine.
+	@param _file_name: Snapshot file.
+	@return: Number of parts exported.
+	"""
+
+	parts = {}
+
+	with STATE_LOCK:
+		for k, e in PARTS_CACHE.items():
+			d = part_cache_entry_data(e)
+
+			if d is None:
+				continue
+
+			parts[k] = {PK_TS: e[PK_TS], PK_LAST_USED: e.get(PK_LAST_USED, e[PK_TS]), PK_DATA: d}
+
+		negative = dict(NEGATIVE_CACHE)
+
+	jo = {}
+	jo[SK_FORMAT] = SNAPSHOT_FORMAT
+	jo[SK_VERSION] = SNAPSHOT_VERSION
+	jo[SK_CREATED] = time.time()
+	jo[SK_PARTS] = parts
+	jo[SK_PARAMETRICS] = PARAMETRICS_CACHE.to_json()
+	jo[SK_NEGATIVE] = negative
+
+	with phase_profile.phase("json.dumps"):
+		raw = json.dumps(jo, separators=(',', ':'))
+
+	# Write and rename so that a CI job never picks up half a snapshot
+	tmp_name = _file_name + ".tmp"
+
+	with open(tmp_name, "wb") as s_file:
+		s_file.write(zlib.compress(raw, 9))
+
+	os.rename(tmp_name, _file_name)
+
+	return len(parts)
+
+def import_cache_snapshot(_file_name):
+	"""
+	Merges a cache snapshot into the local caches.  For every part and negative cache entry the newer of the two wins.
+	@param _file_name: Snapshot file.
+	@raise ValueError: See read_cache_snapshot.
+	@return: Tuple of (parts taken from the snapshot, parts in the snapshot)
+	"""
+
+	jo = read_cache_snapshot(_file_name)
+	parts = jo.get(SK_PARTS, {})
+	taken = 0
+
+	with STATE_LOCK:
+		for k, se in parts.items():
+			e = PARTS_CACHE.get(k)
+
+			if e is not None and e[PK_TS] >= se[PK_TS]:
+				e[PK_LAST_USED] = max(e.get(PK_LAST_USED, 0), se.get(PK_LAST_USED, 0))
+				continue
+
+			last_used = se.get(PK_LAST_USED, se[PK_TS])
+
+			if e is not None:
+				last_used = max(last_used, e.get(PK_LAST_USED, 0))
+
+			# Compressed on save
+			PARTS_CACHE[k] = {PK_TS: se[PK_TS], PK_LAST_USED: last_used, PK_DATA: se[PK_DATA]}
+			MEMORY_CACHE.pop(k)
+			get_part_index().add_parts(se[PK_DATA].get("Parts", []))
+			taken = taken + 1
+
+		for k, sn in jo.get(SK_NEGATIVE, {}).items():
+			n = NEGATIVE_CACHE.get(k)
+
+			if n is None or n[NK_TS] < sn[NK_TS]:
+				NEGATIVE_CACHE[k] = sn
+
+	PARAMETRICS_CACHE.merge_json(jo.get(SK_PARAMETRICS, {"P": {}, "V": {}}))
+
+	return (taken, len(parts))
+
+def mount_cache_snapshot(_file_name):
+	"""
+	Makes the parts in a cache snapshot available to lookups without copying them into the local parts cache.  Its parametrics are learned.
+	A missing or broken snapshot is reported and otherwise ignored; the lookups just go to Digi-Key.
+	@param _file_name: Snapshot file.
+	@return: Nothing
+	"""
+
+	global SNAPSHOT_PARTS
+
+	try:
+		jo = read_cache_snapshot(_file_name)
+	except Exception, e:
+		print >> sys.stderr, "Failed to mount cache snapshot: " + str(e)
+		return
+
+	SNAPSHOT_PARTS = jo.get(SK_PARTS, {})
+	PARAMETRICS_CACHE.merge_json(jo.get(SK_PARAMETRICS, {"P": {}, "V": {}}))
+
+	if DEBUG_FLAG:
+		print "Mounted %d parts from cache snapshot %s." % (len(SNAPSHOT_PARTS), _file_name)
+
+	return
+
+def cached_part_entry(_key):
+	"""
+	Finds the newest cached result for a part: the local parts cache or the mounted snapshot.
+	@param _key: Cache key, see part_cache_key.
+	@return: Cache entry or None.
+	"""
+
+	e = PARTS_CACHE.get(_key)
+	se = SNAPSHOT_PARTS.get(_key)
+
+	if se is not None and (e is None or se[PK_TS] > e[PK_TS]):
+		return se
+
+	return e
+
+def load_global_context():
+	"""
+	Loads the global program state and configuration from a JSON file.
+	The function also performs basic sanity checking and will throw an exception if something is thought to be hinky.
+	@raise ValueError: Raises a ValueError if a required bit is missing in the file.  Should only be of concern during the first invocation.
+	@raise Exception: Passes along any exceptions from the 'open' call.
+	@return: Nothing
+	"""
+
+	global GLOBAL_CONTEXT
+	global CONFIG_VERSION
+	global DEBUG_FLAG
+	global LOCALE
+	global SSO_HOST
+
+	try:
+		# Saves replace the file in one go, but the lock also keeps us from reading it between two processes' token refreshes
+		with STATE_FILE_LOCK, open(get_context_file_name(), "rt") as ctx_file:
+			GLOBAL_CONTEXT = json.load(ctx_file)
+	except Exception, e:
+		print >> sys.stderr, "Failed to parse state/cofig file: " + str(e)
+		raise e
+
+	if not GLOBAL_CONTEXT.has_key(CK_API_CLIENT_ID):
+		raise ValueError("State/config file is missing the API_CLIENT_ID key.  This is part of the API configuration on the Digi-Key API portal.")
+
+	if not GLOBAL_CONTEXT.has_key(CK_API_SECRET):
+		raise ValueError("State/config file is missing the API_SECRET key.  This is part of the API configuration on the Digi-Key API portal.")
+
+	if not GLOBAL_CONTEXT.has_key(CK_API_REDIRECT):
+		raise ValueError("State/config file is missing the API_REDIRECT_URI key.  This is part of the API configuration on the Digi-Key API portal.")
+
+	if not GLOBAL_CONTEXT.has_key(CK_LOGIN_NAME):
+		raise ValueError("State/config file is missing the LOGIN_NAME key.  This is the login name of your Digi-Key account that you use to buy parts.")
+
+	if not GLOBAL_CONTEXT.has_key(CK_LOGIN_PASSWORD):
+		raise ValueError("State/config file is missing the LOGIN_PASSWORD key.  This is the password of your Digi-Key account that you use to buy parts.")
+
+
+	if not GLOBAL_CONTEXT.has_key(CK_CONTEXT):
+		raise ValueError("State/config file is missing the CONTEXT.  This means that your file is corrupt/incomplete.  Please read documentation in this source file.")
+
+	client_ids = set()
+
+	for cred in get_credentials():
+		if not cred.has_key(CK_API_CLIENT_ID) or not cred.has_key(CK_API_SECRET):
+			raise ValueError("Every entry in CREDENTIALS needs an API_CLIENT_ID and an API_SECRET.")
+
+		if cred[CK_API_CLIENT_ID] in client_ids:
+			raise ValueError("Client ID " + cred[CK_API_CLIENT_ID] + " is listed more than once.  Every credential needs its own API application.")
+
+		client_ids.add(cred[CK_API_CLIENT_ID])
+
+		if not cred.has_key(CK_CONTEXT):
+			cred[CK_CONTEXT] = {}
+
+	if GLOBAL_CONTEXT.has_key(CK_SSO_HOST):
+		SSO_HOST = GLOBAL_CONTEXT[CK_SSO_HOST].rstrip("/")
+
+	if GLOBAL_CONTEXT.has_key(CK_MEMORY_CACHE_BYTES):
+		configure_memory_cache(int(GLOBAL_CONTEXT[CK_MEMORY_CACHE_BYTES]))
+
+	LOCALE = normalize_locale((GLOBAL_CONTEXT.get(CK_LOCALE_LANGUAGE, API_DEFAULT_LOCALE[0]), GLOBAL_CONTEXT.get(CK_LOCALE_CURRENCY, API_DEFAULT_LOCALE[1])))
+
+	if not GLOBAL_CONTEXT.has_key(CK_DEBUG):
+		GLOBAL_CONTEXT[CK_DEBUG] = "FALSE"
+
+	if GLOBAL_CONTEXT[CK_DEBUG] == "TRUE":
+		DEBUG_FLAG = True
+	else:
+		DEBUG_FLAG = False
+
+	if DEBUG_FLAG:
+		print "Successfully loaded application state/config."
+
+	return
+
+
+def get_credentials():
+	"""
+	Returns the pool of API credentials.  The top level of the state/config file is the first credential and every entry of its CREDENTIALS list is another.
+	Each one is a map with its own API_CLIENT_ID, API_SECRET, and CONTEXT (tokens and rate limit) so the same functions work on any of them.
+	@return: List of credential maps.
+	"""
+
+	return [GLOBAL_CONTEXT] + GLOBAL_CONTEXT.get(CK_CREDENTIALS, [])
+
+def get_credential(_index):
+	"""
+	Looks up a credential by its position in the pool.
+	@param _index: Zero-based index.  Zero is the top level of the state/config file.
+	@raise ValueError: Raises a ValueError if there is no such credential.
+	@return: Credential map.
+	"""
+
+	creds = get_credentials()
+
+	if _index < 0 or _index >= len(creds):
+		raise ValueError("There is no credential %d.  The state/config file has %d." % (_index, len(creds)))
+
+	return creds[_index]
+
+def credential_remaining(_cred):
+	"""
+	Works out how many calls a credential has left according to its last recorded rate limit.
+	@param _cred: Credential map.
+	@return: Calls remaining, or None if we don't know (never used, or the window has reset since).
+	"""
+
+	rl = _cred[CK_CONTEXT].get(CK_CONTEXT_RATE_LIMIT)
+
+	if rl is None or rl.get(RL_REMAINING) is None:
+		return None
+
+	if rl.get(RL_RESET) is not None and rl[RL_RESET] <= time.time():
+		return None
+
+	return rl[RL_REMAINING]
+
+def acquire_credential(_exclude=()):
+	"""
+	Picks the least loaded credential for the next API call and counts the call as in flight.  Credentials that don't have to wait for their rate limit
+	come first, then the ones with the fewest calls in flight, then the ones with the most calls remaining, then the ones we have used the least.
+	Call release_credential when done.
+	@param _exclude: Client IDs not to pick, e.g. the ones that were just throttled.
+	@return: Credential map, or None if every credential is excluded.
+	"""
+
+	best = None
+	best_key = None
+
+	with CREDENTIAL_LOCK:
+		for cred in get_credentials():
+			client_id = cred[CK_API_CLIENT_ID]
+
+			if client_id in _exclude:
+				continue
+
+			remaining = credential_remaining(cred)
+
+			if remaining is None:
+				remaining = sys.maxint
+
+			key = (quota_pace_delay(cred) > 0, CREDENTIAL_IN_FLIGHT.get(client_id, 0), -remaining, CREDENTIAL_CALLS.get(client_id, 0))
+
+			if best_key is None or key < best_key:
+				best = cred
+				best_key = key
+
+		if best is not None:
+			CREDENTIAL_IN_FLIGHT[best[CK_API_CLIENT_ID]] = CREDENTIAL_IN_FLIGHT.get(best[CK_API_CLIENT_ID], 0) + 1
+			CREDENTIAL_CALLS[best[CK_API_CLIENT_ID]] = CREDENTIAL_CALLS.get(best[CK_API_CLIENT_ID], 0) + 1
+
+	return best
+
+def release_credential(_cred):
+	"""
+	Counterpart of acquire_credential.
+	@param _cred: Credential map returned by acquire_credential.
+	@return: Nothing
+	"""
+
+	with CREDENTIAL_LOCK:
+		CREDENTIAL_IN_FLIGHT[_cred[CK_API_CLIENT_ID]] = CREDENTIAL_IN_FLIGHT.get(_cred[CK_API_CLIENT_ID], 1) - 1
+
+	return
+
+def create_api_auth_refresh_parms(_client_id, _api_secret, _refresh_token):
+	"""
+	Creates the request parameters necessary to refresh an authentication token.
+	@param _client_id: Client ID magic string from the API setup.
+	@param _api_secret: Super secret API secret from the API setup that you are never allowed to see past the initial creation of the application.
+	@param _refresh_token: Last valid refresh token.  This is an important magic string.  This is usually stored in the application state/configuration.
+	@return: A map of parameters that may be useful in refreshing the auth token.
+	"""
+
+	ret = {}
+	ret["refresh_token"] = _refresh_token
+	ret["grant_type"] = "refresh_token"
+	ret["client_id"] = _client_id
+	ret["client_secret"] = _api_secret
+
+	return ret
+
+def create_api_call_headers(_client_id, _auth_token, _locale=None):
+	"""
+	Creates the necessary headers to invoke an API call.
+	@param _client_id: Client ID magic string.
+	@param _auth_token: Authentication token magic string.  This is usually stored in the application state/configuration.
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@return: A map of headers.
+	"""
+
+	language, currency = normalize_locale(_locale)
+
+	ret = {}
+	ret["accept"] = "application/json"
+	ret["accept-encoding"] = "gzip, deflate"
+	ret["x-digikey-locale-language"] = language
+	ret["x-digikey-locale-currency"] = currency
+	ret["authorization"] = str(_auth_token)
+	ret["content-type"] = "application/json"
+	ret["x-ibm-client-id"] = str(_client_id)
+
+	return ret
+
+def create_api_part_search(_id, _qty):
+	"""
+	Creates the map containing the pertinent part search parameters.
+	@param _id: Digi-Key part ID.
+	@param _qty: Part quantity.  Should probably be more than zero.
+	@return: A map of the parameters.
+	"""
+	ret = {}
+	ret["Keywords"] = _id
+	ret["RecordCount"] = _qty
+
+	return ret
+
+def create_api_keyword_search(_keywords, _start, _count):
+	"""
+	Creates the map containing the parameters for one page of a keyword search.
+	@param _keywords: Search keywords.
+	@param _start: Zero-based index of the first result of the page.
+	@param _count: Number of results in the page.
+	@return: A map of the parameters.
+	"""
+	ret = {}
+	ret["Keywords"] = _keywords
+	ret["RecordStartPosition"] = _start
+	ret["RecordCount"] = _count
+
+	return ret
+
+def credential_setting(_cred, _key):
+	"""
+	Looks up a setting that a CREDENTIALS entry may override, such as the redirect URI or the login.
+	@param _cred: Credential map.
+	@param _key: Setting.
+	@return: The credential's own setting, or the one at the top level of the state/config file.
+	"""
+
+	if _key in _cred:
+		return _cred[_key]
+
+	return GLOBAL_CONTEXT[_key]
+
+def get_sso_host(_cred=None):
+	"""
+	@param _cred: Credential map.
+	@return: The credential's SSO_HOST if it has one, SSO_HOST otherwise.
+	"""
+
+	if _cred is not None and CK_SSO_HOST in _cred:
+		return _cred[CK_SSO_HOST].rstrip("/")
+
+	return SSO_HOST
+
+def credential_auth_settings(_cred):
+	"""
+	Collects what the authentication magic needs to know about a credential of the state/config file.  The top level of the file fills in what a
+	CREDENTIALS entry leaves out.
+	@param _cred: Credential map.
+	@return: Auth settings map: CK_API_CLIENT_ID, CK_API_SECRET, and CK_SSO_HOST, plus CK_API_REDIRECT, CK_LOGIN_NAME, and CK_LOGIN_PASSWORD if anybody
+	has them.
+	"""
+
+	ret = {}
+
+	for k in (CK_API_CLIENT_ID, CK_API_SECRET, CK_API_REDIRECT, CK_LOGIN_NAME, CK_LOGIN_PASSWORD):
+		if k in _cred or k in GLOBAL_CONTEXT:
+			ret[k] = credential_setting(_cred, k)
+
+	ret[CK_SSO_HOST] = get_sso_host(_cred)
+
+	return ret
+
+def sso_cookie_key(_settings):
+	"""
+	@param _settings: Auth settings map, see credential_auth_settings.
+	@return: The key a login's SSO cookies are kept under: the SSO host and the login name.  Credentials that share a login share a session.
+	"""
+
+	return _settings[CK_SSO_HOST] + "|" + _settings[CK_LOGIN_NAME]
+
+def load_sso_cookies(_session, _key, _file_name, _debug=False):
+	"""
+	Puts the SSO cookies saved for a login into a session.  Expired cookies are left out.  A cookie file that others can read is not used.
+	@param _session: requests Session.
+	@param _key: See sso_cookie_key.
+	@param _file_name: SSO cookie file.
+	@param _debug: Say how many were loaded.
+	@return: Number of cookies loaded.
+	"""
+
+	try:
+		if os.stat(_file_name).st_mode & 0077:
+			print >> sys.stderr, "Not using %s: it is readable by others.  Fix its permissions or run SSO_CLEAR." % _file_name
+			return 0
+
+		with open(_file_name, "rt") as sso_file:
+			saved = json.load(sso_file).get(_key)
+	except Exception, e:
+		# Nothing saved
+		return 0
+
+	if saved is None:
+		return 0
+
+	now = time.time()
+	n = 0
+
+	for c in saved[SC_COOKIES]:
+		if c.get("expires") is None:
+			if now - saved[SC_SAVED] > SSO_SESSION_COOKIE_TTL:
+				continue
+		elif c["expires"] < now:
+			continue
+
+		_session.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"), expires=c.get("expires"), secure=c.get("secure", False))
+		n = n + 1
+
+	if _debug:
+		print "Loaded %d saved SSO cookies." % n
+
+	return n
+
+def save_sso_cookies(_session, _key, _file_name, _lock):
+	"""
+	Saves the cookies of a session that got through the SSO login, for load_sso_cookies.  The file is created readable by its owner only.
+	@param _session: requests Session.
+	@param _key: See sso_cookie_key.
+	@param _file_name: SSO cookie file.
+	@param _lock: Lock that guards the file.
+	@return: Nothing
+	"""
+
+	cookies = []
+
+	for c in _session.cookies:
+		cookies.append({"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires, "secure": c.secure})
+
+	with _lock:
+		try:
+			with open(_file_name, "rt") as sso_file:
+				jo = json.load(sso_file)
+		except Exception, e:
+			jo = {}
+
+		jo[_key] = {SC_SAVED: time.time(), SC_COOKIES: cookies}
+
+		tmp_name = _file_name + ".tmp"
+
+		try:
+			if os.path.exists(tmp_name):
+				os.remove(tmp_name)
+
+			with os.fdopen(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), "wt") as sso_file:
+				json.dump(jo, sso_file, separators=(',', ':'))
+
+			os.rename(tmp_name, _file_name)
+		except (IOError, OSError), e:
+			print >> sys.stderr, "Failed to save SSO cookies: " + str(e)
+
+	return
+
+def clear_sso_cookies():
+	"""
+	Forgets all saved SSO cookies.
+	@return: Nothing
+	"""
+
+	try:
+		os.remove(get_sso_cookie_file_name())
+	except OSError, e:
+		# Nothing saved
+		pass
+
+	return
+
+def auth_code_from_redirect(r, _redirect_uri):
+	"""
+	Digs the authorization code out of a redirect to the redirect URI.
+	@param r: Response object
+	@param _redirect_uri: The API application's redirect URI.
+	@return: The code, or None if the response isn't such a redirect.
+	"""
+
+	if r.status_code not in (301, 302, 303, 307):
+		return None
+
+	location = r.headers.get("Location", "")
+
+	if not location.startswith(_redirect_uri):
+		return None
+
+	code = urlparse.parse_qs(urlparse.urlparse(location).query).get("code")
+
+	if not code:
+		return None
+
+	return code[0]
+
+def auth_magic_url_one(_settings):
+	"""
+	@param _settings: Auth settings map, see credential_auth_settings.
+	@return: The URL of the first step of the authentication magic.
+	"""
+
+	return _settings[CK_SSO_HOST] + "/as/authorization.oauth2?response_type=code&client_id=" + _settings[CK_API_CLIENT_ID] + "&redirect_uri=" + _settings[CK_API_REDIRECT]
+
+def create_auth_magic_url_one(_cred=None):
+	"""
+	Cobbles together a URL for the first step of the authentication magic
+	@see: https://api-portal.digikey.com/node/188
+	@param _cred: Credential to authenticate.  Defaults to the top level of the state/config file.
+	@return: A URL with the magic bits specified in the application configuration
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	return auth_magic_url_one(credential_auth_settings(_cred))
+
+def create_auth_magic_url_two(_code, _cred=None):
+	"""
+	Cobbles together a URL for the second step of the authentication magic.
+	@see: https://api-portal.digikey.com/node/188
+	@param _cred: Credential to authenticate.  Defaults to the top level of the state/config file.
+	@return: A URL with the magic bits specified in the application configuration combined with magic bits produced by authentication magic step one.
+	"""
+
+	# For V1
+	# V2 expects everything to be moved out of the request and into the body
+	# return SSO_HOST + "/as/token.oauth2?grant_type=authorization_code&code=" + _code + "&client_id=" + GLOBAL_CONTEXT[CK_API_CLIENT_ID] + "&client_secret=" + GLOBAL_CONTEXT[CK_API_SECRET] + "&redirect_uri=" + GLOBAL_CONTEXT[CK_API_REDIRECT]
+
+	return get_sso_host(_cred) + "/as/token.oauth2"
+
+def sso_login_code(_settings, _cookie_file=None, _cookie_lock=None, _debug=False):
+	"""
+	Gets an authorization code out of the SSO server, logging in through its form unless saved cookies show the SSO session is still good.
+	Shared by invoke_auth_magic_one and DigiKeyClient.
+	@param _settings: Auth settings map, see credential_auth_settings.
+	@param _cookie_file: SSO cookie file to load and save the session cookies with.  None to not keep them.
+	@param _cookie_lock: Lock that guards _cookie_file.
+	@param _debug: Print what's going on.
+	@raise KeyError: A setting the login needs is missing.
+	@raise RuntimeError: The SSO server didn't go along with it.
+	@return: Magic code to be used in step two of the authentication.
+	"""
+
+	for k in (CK_API_REDIRECT, CK_LOGIN_NAME, CK_LOGIN_PASSWORD):
+		if k not in _settings:
+			# Before bothering the SSO server
+			raise KeyError(k)
+
+	if _debug:
+		print "Trying to perform first stage of magic: invoking a redirect so user has chance to approve us."
+
+	https_session = requests.Session()
+
+	if _cookie_file is not None:
+		load_sso_cookies(https_session, sso_cookie_key(_settings), _cookie_file, _debug)
+
+	magic_string = auth_magic_url_one(_settings)
+	r = https_session.post(magic_string, allow_redirects=False)
+
+	# With a live SSO session we are sent straight back with a code
+	magic_code = auth_code_from_redirect(r, _settings[CK_API_REDIRECT])
+
+	if magic_code is not None:
+		if _debug:
+			print "The saved SSO session is still good; skipped the login form."
+
+		if _cookie_file is not None:
+			save_sso_cookies(https_session, sso_cookie_key(_settings), _cookie_file, _cookie_lock)
+
+		return magic_code
+
+	if r.status_code in (301, 302, 303, 307):
+		# Off to the login form
+		r = https_session.get(urlparse.urljoin(magic_string, r.headers["Location"]))
+
+	if r.status_code != 200:
+		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT START " + ("*" * 10)
+		print >> sys.stderr, "Failed in the first sub-step of the authentication magic step one."
+		print >> sys.stderr, "Response code: " + str(r.status_code)
+		dump_response_headers(r, sys.stderr)
+		print >> sys.stderr, r.text
+		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT END " + ("*" * 10)
+		raise RuntimeError("Failed to get new tokens in authentication magic step one.  See program output for details.")
+
+	html_parser = MyHTMLParser()
+	html_parser.feed(r.text)
+
+	if _debug:
+		print "Trying to perform second stage of magic: fudging login via form."
+
+	https_session.headers.update({"Referer": magic_string, "Content-Type": "application/x-www-form-urlencoded"})
+
+	r = https_session.post(urlparse.urljoin(magic_string, html_parser.form_action), data={"pf.username": _settings[CK_LOGIN_NAME], "pf.pass": _settings[CK_LOGIN_PASSWORD], "pf.ok":"clicked"}, allow_redirects=False)
+
+	#
+	# XXX I guess here there could be another response.  If the session is expired there might be another clickthrough dialog.
+	#
+	if r.status_code != 302:
+		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT START " + ("*" * 10)
+		print >> sys.stderr, "Failed in the second sub-step of the authentication magic step one."
+		print >> sys.stderr, "Response code: " + str(r.status_code)
+		dump_response_headers(r, sys.stderr)
+		print >> sys.stderr, r.text
+		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT END " + ("*" * 10)
+		raise RuntimeError("Failed to get new tokens in authentication magic step one.  See program output for details.")
+
+	magic_code = None
+
+	try:
+		#
+		# What do you mean "robust"?
+		#
+		# On success the redirect header will look something like this:
+		# Location: https://localhost?code=<MAGIC BEANS>
+		#
+		# We extract the code parameter because that's really all we care about
+		#
+
+		magic_code = r.headers["Location"].split("?")[1].split("=")[1]
+	except Exception, e:
+		print >> sys.stderr, "Failed to extract code from the 'Location' response header: " + str(e)
+		dump_response_headers(r, sys.stderr)
+		raise RuntimeError("Failed to get new tokens in authentication magic step one.  See program output for details.")
+
+	if magic_code is None:
+		raise RuntimeError("Failed to get new tokens in authentication magic step one.  Magic code seems to be None even though everything went well.")
+
+	if _debug:
+		print "If we got this far we probably have a new code."
+		print "Code: " + str(magic_code)
+
+	if _cookie_file is not None:
+		save_sso_cookies(https_session, sso_cookie_key(_settings), _cookie_file, _cookie_lock)
+
+	return magic_code
+
+def invoke_auth_magic_one(_cred=None):
+	"""
+	Performs the first step of the authentication magic.
+	@see: https://api-portal.digikey.com/node/188
+	@param _cred: Credential to authenticate.  Defaults to the top level of the state/config file.
+	@return: Magic code to be used in step two of the authentication.
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	return sso_login_code(credential_auth_settings(_cred), get_sso_cookie_file_name(), STATE_FILE_LOCK, DEBUG_FLAG)
+
+def store_token_response(_ctx, _jo):
+	"""
+	Puts the tokens of a token endpoint response into a CONTEXT.
+	@param _ctx: CONTEXT map of the credential.
+	@param _jo: Parsed response.
+	@return: Nothing
+	"""
+
+	_ctx[CK_CONTEXT_ACC_TOK] = _jo["access_token"]
+	_ctx[CK_CONTEXT_REF_TOK] = _jo["refresh_token"]
+
+	if "expires_in" in _jo:
+		_ctx[CK_CONTEXT_EXP] = _jo["expires_in"]
+
+	_ctx[CK_CONTEXT_TS] = datetime.datetime.now().isoformat()
+
+	return
+
+def trade_auth_code(_session, _settings, _ctx, _code, _debug=False):
+	"""
+	Trades the code from sso_login_code for tokens.  Shared by invoke_auth_magic_two and DigiKeyClient.
+	@param _session: requests Session to make the call with.
+	@param _settings: Auth settings map, see credential_auth_settings.
+	@param _ctx: CONTEXT map that gets the tokens.
+	@param _code: Magic code from step one of the authentication process.
+	@param _debug: Print what's going on.
+	@raise KeyError: A setting is missing.
+	@raise RuntimeError: The SSO server said no.
+	@return: Nothing
+	"""
+
+	if _debug:
+		print "Trying to collect more magic beans."
+
+	magic_string = _settings[CK_SSO_HOST] + "/as/token.oauth2"
+
+	if _debug:
+		print "Magic URL: " + magic_string
+
+	post_data = {}
+
+	post_data["code"] = _code
+	post_data["client_id"] = _settings[CK_API_CLIENT_ID]
+	post_data["client_secret"] = _settings[CK_API_SECRET]
+	post_data["redirect_uri"] = _settings[CK_API_REDIRECT]
+	post_data["grant_type"] = "authorization_code"
+
+	r = _session.post(magic_string, data=post_data)
+
+	if r.status_code < 200 or r.status_code >= 300:
+		print >> sys.stderr, "Failed to get new tokens in authentication magic step two"
+		print >> sys.stderr, "Response code: " + str(r.status_code)
+		dump_response_headers(r, sys.stderr)
+		print >> sys.stderr, "Response text: "
+		print >> sys.stderr, r.text
+
+		raise RuntimeError("Failed to get new tokens in authentication magic step two.  See program output for details.")
+
+	store_token_response(_ctx, json.loads(r.text))
+
+	if _debug:
+		print "We should have enough magic beans to grow the bean stalk so that we can climb INTO THE CLOUD."
+
+	return
+
+def invoke_auth_magic_two(_code, _cred=None):
+	"""
+	Performs the second step of the authentication magic.  Here we get the real-real authentication token and a refresh token.
+	@param _code: Magic code from step one of the authentication process.
+	@param _cred: Credential to authenticate.  Defaults to the top level of the state/config file.
+	@see: https://api-portal.digikey.com/node/188
+
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	trade_auth_code(requests.Session(), credential_auth_settings(_cred), _cred[CK_CONTEXT], _code, DEBUG_FLAG)
+
+	return
+
+def new_auth(_cred=None):
+	"""
+	Performs the new authentication song and dance.  Waves the dead chicken in the air in just the right way.
+	@see: https://api-portal.digikey.com/node/188
+	@param _cred: Credential to authenticate.  Defaults to the top level of the state/config file.
+	"""
+	magic_code = invoke_auth_magic_one(_cred)
+	invoke_auth_magic_two(magic_code, _cred)
+
+	return
+
+def renew_tokens(_session, _settings, _ctx, _cookie_file=None, _cookie_lock=None, _debug=False):
+	"""
+	Trades the refresh token in a CONTEXT for new tokens, or goes through the whole authentication magic if there isn't one.  Shared by
+	refresh_auth_token and DigiKeyClient.
+	@param _session: requests Session to make the token calls with.
+	@param _settings: Auth settings map, see credential_auth_settings.
+	@param _ctx: CONTEXT map of the credential.  Gets the new tokens.
+	@param _cookie_file: See sso_login_code.
+	@param _cookie_lock: See sso_login_code.
+	@param _debug: Print what's going on.
+	@raise KeyError: A setting is missing.
+	@raise RuntimeError: The SSO server said no.
+	@return: Nothing
+	"""
+
+	if CK_CONTEXT_REF_TOK not in _ctx:
+		# We don't have a refresh token so lets be robust and make one!
+		if _debug:
+			print CK_CONTEXT_REF_TOK + " is missing.  Will try to perform new authentication magic."
+
+		magic_code = sso_login_code(_settings, _cookie_file, _cookie_lock, _debug)
+		trade_auth_code(_session, _settings, _ctx, magic_code, _debug)
+
+		return
+
+	if _debug:
+		print CK_CONTEXT_REF_TOK + " exists."
+
+	d = create_api_auth_refresh_parms(_settings[CK_API_CLIENT_ID], _settings[CK_API_SECRET], _ctx[CK_CONTEXT_REF_TOK])
+	r = _session.post(_settings[CK_SSO_HOST] + "/as/token.oauth2", data=d)
+
+	if r.status_code < 200 or r.status_code >= 300:
+		# Uh oh number 2
+		raise RuntimeError("Failed to refresh token.  Code: %d Body: %s" % (r.status_code, r.text))
+
+	# Everything honky-dory
+	store_token_response(_ctx, r.json())
+
+	return
+
+def refresh_auth_token(_cred=None):
+	"""
+	Refreshes the authentication token.  This should be done less than every 24 hours unless you want to jump through hoops in getting another auth token.
+	All of the necessary information is retreived from the application state/configuration.
+	@param _cred: Credential to refresh.  Defaults to the top level of the state/config file.
+	@return: Nothing
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	try:
+		renew_tokens(requests.Session(), credential_auth_settings(_cred), _cred[CK_CONTEXT], get_sso_cookie_file_name(), STATE_FILE_LOCK, DEBUG_FLAG)
+	except RuntimeError, e:
+		print >> sys.stderr, str(e)
+		raise
+
+	return
+
+def parse_context_timestamp(_ts):
+	"""
+	Parses a GEN_TIMESTAMP value.  datetime.isoformat leaves out the microseconds when there are none.
+	@param _ts: ISO formatted timestamp.
+	@return: datetime object or None if it can't be parsed.
+	"""
+
+	for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+		try:
+			return datetime.datetime.strptime(_ts, fmt)
+		except (ValueError, TypeError):
+			pass
+
+	return None
+
+def adopt_context_tokens(_ours, _disk):
+	"""
+	Takes the tokens of another copy of a CONTEXT if they were generated after ours.  Shared by adopt_newer_tokens and DigiKeyClient.
+	@param _ours: Our CONTEXT map.  Updated.
+	@param _disk: The other CONTEXT map, usually from the state file.
+	@return: True if its tokens were taken.
+	"""
+
+	disk_ts = parse_context_timestamp(_disk.get(CK_CONTEXT_TS))
+	our_ts = parse_context_timestamp(_ours.get(CK_CONTEXT_TS))
+
+	if disk_ts is None or (our_ts is not None and disk_ts <= our_ts):
+		return False
+
+	for k in (CK_CONTEXT_REF_TOK, CK_CONTEXT_ACC_TOK, CK_CONTEXT_EXP, CK_CONTEXT_TS):
+		if k in _disk:
+			_ours[k] = _disk[k]
+
+	return True
+
+def adopt_newer_tokens(_cred=None):
+	"""
+	Re-reads the state file and takes its tokens if they were generated after ours.  Must be called with STATE_FILE_LOCK held.
+	Credentials are matched up by client ID.
+	@param _cred: Credential whose tokens to check.  All of them if None.
+	@return: True if any tokens in the state file were adopted.
+	"""
+
+	try:
+		with open(get_context_file_name(), "rt") as ctx_file:
+			disk_root = json.load(ctx_file)
+	except Exception, e:
+		return False
+
+	disk_creds = {}
+
+	for cred in [disk_root] + disk_root.get(CK_CREDENTIALS, []):
+		if CK_API_CLIENT_ID in cred and CK_CONTEXT in cred:
+			disk_creds[cred[CK_API_CLIENT_ID]] = cred[CK_CONTEXT]
+
+	if _cred is None:
+		creds = get_credentials()
+	else:
+		creds = [_cred]
+
+	adopted = False
+
+	for cred in creds:
+		disk = disk_creds.get(cred[CK_API_CLIENT_ID])
+
+		if disk is None or not adopt_context_tokens(cred[CK_CONTEXT], disk):
+			continue
+
+		if DEBUG_FLAG:
+			print "Picked up tokens for " + cred[CK_API_CLIENT_ID] + " generated by another process at " + disk[CK_CONTEXT_TS]
+
+		adopted = True
+
+	return adopted
+
+def refresh_auth_token_shared(_seen_token, _cred=None):
+	"""
+	Single-flight wrapper around refresh_auth_token.  Threads and processes that notice an expired token all call this with the token they saw;
+	the first one through the lock refreshes and saves, everyone after it finds a different token and just uses that.
+	This matters because Digi-Key rotates the refresh token on every use so concurrent refreshes invalidate each other.
+	@param _seen_token: The access token the caller found to be expired or rejected.
+	@param _cred: Credential the token belongs to.  Defaults to the top level of the state/config file.
+	@return: Nothing
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	with STATE_FILE_LOCK:
+		if _cred[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK) != _seen_token:
+			# Another thread got here first
+			return
+
+		if adopt_newer_tokens(_cred) and _cred[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK) != _seen_token:
+			# Another process got here first
+			return
+
+		refresh_auth_token(_cred)
+		save_global_context()
+
+	return
+
+def auth_token_expired(_cred=None):
+	"""
+	Works out whether the access token is about to expire using GEN_TIMESTAMP and EXPIRES.
+	@param _cred: Credential to check.  Defaults to the top level of the state/config file.
+	@return: True if the token expires within TOKEN_EXPIRY_MARGIN seconds.  False if it doesn't or if we can't tell.
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	expires = auth_token_expiry(_cred)
+
+	if expires is None:
+		return False
+
+	return datetime.datetime.now() >= expires - datetime.timedelta(seconds=TOKEN_EXPIRY_MARGIN)
+
+def auth_token_expiry(_cred=None):
+	"""
+	@param _cred: Credential to check.  Defaults to the top level of the state/config file.
+	@return: When the access token expires according to GEN_TIMESTAMP and EXPIRES, as a datetime.  None if we can't tell.
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	ctx = _cred[CK_CONTEXT]
+	ts = parse_context_timestamp(ctx.get(CK_CONTEXT_TS))
+
+	if ts is None or CK_CONTEXT_EXP not in ctx:
+		return None
+
+	return ts + datetime.timedelta(seconds=int(ctx[CK_CONTEXT_EXP]))
+
+def ensure_auth_token(_cred=None):
+	"""
+	Refreshes the access token, single-flight, if it is about to expire.  A credential that has no access token yet, usually a freshly added one, gets one.
+	@param _cred: Credential to check.  Defaults to the top level of the state/config file.
+	@return: Nothing
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	if CK_CONTEXT_ACC_TOK not in _cred[CK_CONTEXT] or auth_token_expired(_cred):
+		if DEBUG_FLAG:
+			print "Access token for " + _cred[CK_API_CLIENT_ID] + " is missing or about to expire.  Refreshing."
+
+		refresh_auth_token_shared(_cred[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK), _cred)
+
+	return
+
+def load_keeper_health():
+	"""
+	Loads the auth keeper health of every credential.  A missing or broken file simply means no history.
+	@return: Map of client ID to health map, see KK_*.
+	"""
+
+	try:
+		with open(get_keeper_file_name(), "rt") as k_file:
+			return json.load(k_file)
+	except Exception, e:
+		# Sink it quietly
+		return {}
+
+def save_keeper_health(_health):
+	"""
+	Saves the auth keeper health.  The file is replaced in one go.
+	@param _health: Map of client ID to health map.
+	@return: Nothing
+	"""
+
+	with STATE_FILE_LOCK:
+		try:
+			with open(get_keeper_file_name() + ".tmp", "wt") as k_file:
+				json.dump(_health, k_file, indent=4, sort_keys=True)
+
+			os.rename(get_keeper_file_name() + ".tmp", get_keeper_file_name())
+		except Exception, e:
+			print >> sys.stderr, "Failed to save auth keeper health: " + str(e)
+
+	return
+
+def keeper_refresh_due(_cred, _health):
+	"""
+	Works out when AUTH_KEEPER should next refresh a credential's tokens: KEEPER_REFRESH_MARGIN seconds before they expire, or halfway through their life
+	if that is later.  A credential without tokens, or whose expiry we can't tell, is due right away.  After a failure the retry time wins.
+	@param _cred: Credential map.
+	@param _health: The credential's health map, see KK_*.
+	@return: Seconds since the epoch.
+	"""
+
+	ctx = _cred[CK_CONTEXT]
+	ts = parse_context_timestamp(ctx.get(CK_CONTEXT_TS))
+
+	# Unless someone else has refreshed the tokens since
+	if _health.get(KK_FAILURES, 0) > 0 and _health.get(KK_NEXT) is not None and (ts is None or time.mktime(ts.timetuple()) < _health.get(KK_CHECKED, 0)):
+		return _health[KK_NEXT]
+
+	expires = auth_token_expiry(_cred)
+
+	if CK_CONTEXT_ACC_TOK not in ctx or expires is None:
+		return time.time()
+
+	lifetime = int(ctx[CK_CONTEXT_EXP])
+	due = expires - datetime.timedelta(seconds=min(KEEPER_REFRESH_MARGIN, lifetime / 2))
+
+	return time.mktime(due.timetuple())
+
+def keep_credential_warm(_cred, _health):
+	"""
+	Refreshes a credential's tokens, single-flight, and records how it went.  Failures are retried with exponential backoff.
+	@param _cred: Credential map.
+	@param _health: The credential's health map, see KK_*.  Updated.
+	@return: True if the credential has fresh tokens.
+	"""
+
+	ctx = _cred[CK_CONTEXT]
+	now = time.time()
+
+	_health[KK_CHECKED] = now
+
+	try:
+		with phase_profile.phase("auth"):
+			refresh_auth_token_shared(ctx.get(CK_CONTEXT_ACC_TOK), _cred)
+	except Exception, e:
+		# Anything from a 400 to the network being down; all we can do about any of it is try again later
+		failures = _health.get(KK_FAILURES, 0) + 1
+
+		_health[KK_FAILURES] = failures
+		_health[KK_ERROR] = str(e)
+		_health[KK_NEXT] = now + min(KEEPER_RETRY_MIN * (2 ** (failures - 1)), KEEPER_RETRY_MAX)
+
+		print >> sys.stderr, "Failed to refresh tokens for %s (%d in a row): %s" % (_cred[CK_API_CLIENT_ID], failures, str(e))
+
+		return False
+
+	_health[KK_REFRESHED] = time.time()
+	_health[KK_FAILURES] = 0
+	_health.pop(KK_ERROR, None)
+	_health[KK_NEXT] = keeper_refresh_due(_cred, _health)
+
+	if DEBUG_FLAG:
+		print "Refreshed tokens for %s.  Next refresh at %s." % (_cred[CK_API_CLIENT_ID], datetime.datetime.fromtimestamp(_health[KK_NEXT]).isoformat())
+
+	return True
+
+def keeper_to_string():
+	"""
+	Formats the token expiry and auth keeper health of every credential.
+	@return: Human readable multi-line string.
+	"""
+
+	def ts(_v):
+		if _v is None:
+			return "never"
+		return datetime.datetime.fromtimestamp(_v).replace(microsecond=0).isoformat()
+
+	ret = []
+	creds = get_credentials()
+	all_health = load_keeper_health()
+
+	for i in range(len(creds)):
+		cred = creds[i]
+		health = all_health.get(cred[CK_API_CLIENT_ID], {})
+		expires = auth_token_expiry(cred)
+
+		ret.append("Credential %d: %s" % (i, cred[CK_API_CLIENT_ID]))
+		ret.append("Token expires:   " + ("unknown" if expires is None else expires.replace(microsecond=0).isoformat()))
+		ret.append("Next refresh:    " + ts(keeper_refresh_due(cred, health)))
+		ret.append("Last refreshed:  " + ts(health.get(KK_REFRESHED)))
+		ret.append("Last checked:    " + ts(health.get(KK_CHECKED)))
+
+		if health.get(KK_FAILURES, 0) > 0:
+			ret.append("Failures:        %d in a row, last: %s" % (health[KK_FAILURES], health.get(KK_ERROR, "unknown")))
+
+		ret.append("")
+
+	return "\n".join(ret).rstrip()
+
+def keep_auth_tokens(_continuous):
+	"""
+	Refreshes the tokens of every credential that is due, see keeper_refresh_due, so that batch runs start with valid tokens and never stall on a refresh
+	or a new login.  The state file is re-read first every time around, since other processes may have refreshed tokens or the user may have edited it.
+	In one-shot mode, e.g. from a timer, it returns once everything due has been tried.  In continuous mode it sleeps until the next credential is due,
+	waking up at least every KEEPER_POLL_INTERVAL seconds.
+	@param _continuous: Keep going forever if true.
+	@return: Number of credentials whose refresh failed.
+	"""
+
+	global DEBUG_FLAG
+
+	while True:
+		debug = DEBUG_FLAG
+
+		try:
+			with STATE_FILE_LOCK:
+				load_global_context()
+		except Exception, e:
+			if not _continuous:
+				raise
+
+			print >> sys.stderr, "Failed to re-read the state/config file: " + str(e)
+			time.sleep(KEEPER_RETRY_MIN)
+			continue
+		finally:
+			# The command line wins over the state file
+			DEBUG_FLAG = debug
+
+		failed = 0
+		all_health = load_keeper_health()
+
+		for cred in get_credentials():
+			health = all_health.setdefault(cred[CK_API_CLIENT_ID], {})
+
+			if keeper_refresh_due(cred, health) <= time.time() and not keep_credential_warm(cred, health):
+				failed = failed + 1
+
+		save_keeper_health(all_health)
+		save_global_context()
+
+		if not _continuous:
+			return failed
+
+		wait = min([keeper_refresh_due(cred, all_health[cred[CK_API_CLIENT_ID]]) for cred in get_credentials()] + [time.time() + KEEPER_POLL_INTERVAL]) - time.time()
+
+		if DEBUG_FLAG:
+			print "Auth keeper sleeping for %d seconds." % wait
+
+		time.sleep(max(wait, 1))
+
+
+def dump_request_headers(r, _target=sys.stdout):
+	"""
+	Dumps the response headers in a relatively useful fasion
+	@param r: Response object
+	@param _target: Where to dump the information.  Should be a file descriptor type object.
+	"""
+
+	print >> _target, "\n" + ("*" * 10) + " REQUEST HEADERS START " + ("*" * 10)
+
+	for h in r.request.headers.keys():
+		print >> _target, h + ": " + r.request.headers[h]
+	print >> _target, ("*" * 10) + " REQUEST HEADERS END " + ("*" * 10) + "\n"
+
+	return
+
+def dump_response_headers(r, _target=sys.stdout):
+	"""
+	Dumps the response headers in a relatively useful fasion
+	@param r: Response object
+	@param _target: Where to dump the information.  Should be a file descriptor type object.
+	"""
+
+	print >> _target, "\n" + ("*" * 10) + " RESPONSE HEADERS START " + ("*" * 10)
+
+	for h in r.headers.keys():
+		print >> _target, h + ": " + r.headers[h]
+	print >> _target, ("*" * 10) + " RESPONSE HEADERS END " + ("*" * 10) + "\n"
+
+	return
+
+def parse_rate_limit_value(_value):
+	"""
+	Digs the number out of a rate limit header.  Depending on the API version the value is either a plain number or something along the lines of 'name=rate-limit-1,1000;'.
+	If the header lists several limits the most restrictive one wins.  Retry-After may also be an HTTP date, which is turned into a timestamp.
+	@param _value: Header value.
+	@return: The number or None if there is no number to be had.
+	"""
+
+	date = email.utils.parsedate_tz(_value.strip())
+
+	if date is not None:
+		# Otherwise the regex below would take the day of the month for the number of seconds to wait
+		return int(email.utils.mktime_tz(date))
+
+	v = [int(i) for i in re.findall(r"(?:^|,)\s*(\d+)\s*;?", _value.strip())]
+
+	if len(v) < 1:
+		return None
+
+	return min(v)
+
+def record_rate_limit(r, _cred=None):
+	"""
+	Records the rate limit headers of an API response in the application state.  It is saved with the rest of the state at the end of the run; saving
+	the state file after every call made concurrent runs read it half written.
+	@param r: Response object
+	@param _cred: Credential that made the call.  Defaults to the top level of the state/config file.
+	@return: Nothing
+	"""
+
+	if _cred is None:
+		_cred = GLOBAL_CONTEXT
+
+	rl = parse_rate_limit(r)
+
+	if rl is None:
+		return
+
+	_cred[CK_CONTEXT][CK_CONTEXT_RATE_LIMIT] = rl
+
+	return
+
+def parse_rate_limit(r):
+	"""
+	Pulls the rate limit information out of an API response.  Reset values are turned into absolute timestamps.
+	@param r: Response object
+	@return: Rate limit map (see RL_*), or None if the response had nothing to say about it.
+	"""
+
+	rl = {}
+
+	for h in r.headers.keys():
+		k = RATE_LIMIT_HEADERS.get(h.lower())
+
+		if k is None:
+			continue
+
+		v = parse_rate_limit_value(r.headers[h])
+
+		if v is None:
+			continue
+
+		if k in (RL_RESET, RL_BURST_RESET) and v < 1000000000:
+			# Relative; seconds from now
+			v = time.time() + v
+
+		rl[k] = v
+
+	if r.status_code == 429:
+		rl.setdefault(RL_REMAINING, 0)
+
+		if RL_RESET not in rl:
+			rl[RL_RESET] = time.time() + QUOTA_DEFAULT_BACKOFF
+
+	if len(rl) < 1:
+		return None
+
+	rl[RL_TS] = time.time()
+
+	return rl
+
+def quota_pace_delay(_cred=None):
+	"""
+	Works out how long a batch run should wait before making the next call based on the last recorded rate limit headers.
+	@param _cred: Credential to check.  If None, the whole pool; the wait is until the first credential is good to go.
+	@return: Seconds to wait.  Zero if there is no reason to wait.
+	"""
+
+	if _cred is None:
+		return min([quota_pace_delay(c) for c in get_credentials()])
+
+	rl = _cred[CK_CONTEXT].get(CK_CONTEXT_RATE_LIMIT)
+
+	if rl is None:
+		return 0
+
+	now = time.time()
+	wait = 0
+
+	burst_reset = rl.get(RL_BURST_RESET)
+
+	if rl.get(RL_BURST_REMAINING) is not None and rl[RL_BURST_REMAINING] <= 0:
+		if burst_reset is not None and burst_reset > now:
+			wait = burst_reset - now
+		elif burst_reset is None and now - rl[RL_TS] < QUOTA_DEFAULT_BACKOFF:
+			wait = rl[RL_TS] + QUOTA_DEFAULT_BACKOFF - now
+
+	reset = rl.get(RL_RESET)
+	remaining = rl.get(RL_REMAINING)
+
+	if remaining is None:
+		return wait
+
+	if reset is not None and reset <= now:
+		# The window has rolled over since we last heard
+		return wait
+
+	if remaining <= 0:
+		if reset is None:
+			reset = rl[RL_TS] + QUOTA_DEFAULT_BACKOFF
+
+		wait = max(wait, reset - now)
+	elif remaining < QUOTA_RESERVE and reset is not None:
+		wait = max(wait, (reset - now) / remaining)
+
+	return max(wait, 0)
+
+def pace_api_calls():
+	"""
+	Sleeps as long as quota_pace_delay says to.  Called by batch runs before each remote call.
+	@return: Nothing
+	"""
+
+	wait = quota_pace_delay()
+
+	if wait > 0:
+		if DEBUG_FLAG:
+			print "Pacing API calls: sleeping for %.1f seconds." % wait
+		time.sleep(wait)
+
+	return
+
+def quota_to_string():
+	"""
+	Formats the last recorded rate limit information of every credential.
+	@return: Human readable multi-line string.
+	"""
+
+	creds = get_credentials()
+
+	if len(creds) == 1:
+		return credential_quota_to_string(creds[0])
+
+	ret = []
+
+	for i in range(len(creds)):
+		ret.append("Credential %d: %s" % (i, creds[i][CK_API_CLIENT_ID]))
+		ret.append(credential_quota_to_string(creds[i]))
+		ret.append("")
+
+	ret.append("Pool pacing delay: %.1f seconds" % quota_pace_delay())
+
+	return "\n".join(ret)
+
+def credential_quota_to_string(_cred):
+	"""
+	Formats the last recorded rate limit information of one credential.
+	@param _cred: Credential map.
+	@return: Human readable multi-line string.
+	"""
+
+	rl = _cred[CK_CONTEXT].get(CK_CONTEXT_RATE_LIMIT)
+
+	if rl is None:
+		return "No rate limit information recorded yet.  Make an API call first."
+
+	def ts(_v):
+		if _v is None:
+			return "unknown"
+		return datetime.datetime.fromtimestamp(_v).isoformat()
+
+	ret = []
+	ret.append("Recorded:        " + ts(rl.get(RL_TS)))
+	ret.append("Remaining:       %s of %s" % (str(rl.get(RL_REMAINING, "unknown")), str(rl.get(RL_LIMIT, "unknown"))))
+	ret.append("Resets:          " + ts(rl.get(RL_RESET)))
+
+	if RL_BURST_LIMIT in rl or RL_BURST_REMAINING in rl:
+		ret.append("Burst remaining: %s of %s" % (str(rl.get(RL_BURST_REMAINING, "unknown")), str(rl.get(RL_BURST_LIMIT, "unknown"))))
+		ret.append("Burst resets:    " + ts(rl.get(RL_BURST_RESET)))
+
+	ret.append("Pacing delay:    %.1f seconds" % quota_pace_delay(_cred))
+
+	return "\n".join(ret)
+
+def classify_lookup_failure(_status_code):
+	"""
+	Guesses what kind of failure an API response code means.
+	@param _status_code: HTTP response code.
+	@return: One of the LF_* constants.
+	"""
+
+	if _status_code in (401, 403):
+		return LF_AUTH
+
+	if _status_code == 404:
+		return LF_NO_RESULTS
+
+	if _status_code == 429 or _status_code >= 500:
+		return LF_TRANSIENT
+
+	return LF_INVALID
+
+def post_api_call(_payload, _head):
+	"""
+	POSTs a search.  Network trouble is turned into a transient PartLookupError.
+	@return: Response object
+	"""
+
+	try:
+		with phase_profile.phase("http"):
+			return requests.post(API_PART_SEARCH_URI, data=_payload, headers=_head)
+	except requests.exceptions.RequestException, e:
+		raise PartLookupError(LF_TRANSIENT, "Remote call failed: " + str(e))
+
+def get_part_data(_id, _qty, _locale=None):
+	"""
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@raise PartLookupError: Raises a PartLookupError, which is a RuntimeError, if the call fails or the response code is not 2xx.  The search can fail for any
+	number of reasons including an invalid part number.  A malformed request, auth error, an invalid search, they all return code 4xx.  The kind
+	attribute of the exception is a guess at which it was.
+	@return: Search results in a fully formed Python object.
+	"""
+
+	return post_search(create_api_part_search(_id.strip(), int(_qty)), _locale)
+
+def post_search_with_credential(_payload, _cred, _locale=None):
+	"""
+	Makes a search API call with one particular credential.  Takes care of the token and the rate limit bookkeeping.
+	@param _payload: JSON encoded search parameters.
+	@param _cred: Credential map.
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@raise PartLookupError: Raises a transient PartLookupError on network trouble.
+	@return: Response object
+	"""
+
+	with phase_profile.phase("auth"):
+		ensure_auth_token(_cred)
+
+	token = _cred[CK_CONTEXT][CK_CONTEXT_ACC_TOK]
+	head = create_api_call_headers(_cred[CK_API_CLIENT_ID], token, _locale)
+
+	r = post_api_call(_payload, head)
+
+	if r.status_code == 401:
+		# Expired early or refreshed elsewhere without us noticing.  One retry with a fresh token.
+		with phase_profile.phase("auth"):
+			refresh_auth_token_shared(token, _cred)
+
+		head = create_api_call_headers(_cred[CK_API_CLIENT_ID], _cred[CK_CONTEXT][CK_CONTEXT_ACC_TOK], _locale)
+
+		r = post_api_call(_payload, head)
+
+	record_rate_limit(r, _cred)
+
+	return r
+
+def post_search(_search, _locale=None):
+	"""
+	Makes a search API call on the least loaded credential, failing over to the others when it is throttled, and turns failures into exceptions.
+	@param _search: Search parameter map as made by create_api_part_search or create_api_keyword_search.
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@raise PartLookupError: See get_part_data.
+	@return: Search results in a fully formed Python object.
+	"""
+
+	payload = json.dumps(_search)
+	throttled = set()
+
+	while True:
+		cred = acquire_credential(throttled)
+
+		try:
+			r = post_search_with_credential(payload, cred, _locale)
+		finally:
+			release_credential(cred)
+
+		if r.status_code != 429 or len(throttled) + 1 >= len(get_credentials()):
+			break
+
+		# Fail over to the next credential
+		throttled.add(cred[CK_API_CLIENT_ID])
+
+		if DEBUG_FLAG:
+			print "Credential " + cred[CK_API_CLIENT_ID] + " is throttled.  Trying another one."
+
+	if DEBUG_FLAG:
+		dump_response_headers(r)
+		dump_request_headers(r)
+
+
+	if r.status_code < 200 or r.status_code >= 300:
+
+		reason_guess = "Don't know why."
+
+		if r.status_code == 429:
+			reason_guess = "Rate Limit Exceeded."
+
+		raise PartLookupError(classify_lookup_failure(r.status_code), "Remote call failed. Best guess: %s Code: %s Body: %s" % (reason_guess,str(r.status_code),r.text))
+
+	with phase_profile.phase("json.loads"):
+		body = json.loads(r.text)
+
+	PARAMETRICS_CACHE.learn(body.get("Parts", []))
+
+	if DEBUG_FLAG:
+		print "\n" + ("*" * 10) + " RESULT START " + ("*" * 10)
+		print json.dumps(body, indent=4)
+		print ("*" * 10) + " RESULT END " + ("*" * 10) + "\n"
+
+	return body
+
+def normalize_locale(_locale):
+	"""
+	@param _locale: (language, currency) or None for LOCALE.
+	@return: Lower case (language, currency) tuple.
+	"""
+
+	if _locale is None:
+		return LOCALE
+
+	return (_locale[0].strip().lower(), _locale[1].strip().lower())
+
+def parse_locale(_s):
+	"""
+	Parses a locale the way it is given on the command line.
+	@param _s: 'language/currency', e.g. 'de/eur'.
+	@raise ValueError: Raises a ValueError if the string doesn't look like that.
+	@return: Normalized (language, currency) tuple.
+	"""
+
+	p = _s.split("/")
+
+	if len(p) != 2 or len(p[0].strip()) < 1 or len(p[1].strip()) < 1:
+		raise ValueError("Locales go like language/currency, e.g. de/eur.  Got [%s]." % _s)
+
+	return normalize_locale(p)
+
+def part_number_key(_id):
+	"""
+	Normalizes a part number.  This is the negative cache key; a part number that doesn't exist doesn't exist in any locale.
+	@param _id: Digi-Key part number.
+	@return: Normalized part number.
+	"""
+
+	return _id.strip().upper()
+
+def part_cache_key(_id, _locale=None):
+	"""
+	Normalizes a part number and locale into a parts cache key.  Results in API_DEFAULT_LOCALE are keyed by the bare part number.
+	@param _id: Digi-Key part number.
+	@param _locale: (language, currency).  Defaults to LOCALE.
+	@return: Cache key.
+	"""
+
+	locale = normalize_locale(_locale)
+
+	if locale == API_DEFAULT_LOCALE:
+		return part_number_key(_id)
+
+	return "%s|%s|%s" % (part_number_key(_id), locale[0], locale[1])
+
+def split_part_cache_key(_key):
+	"""
+	Undoes part_cache_key.
+	@param _key: Cache key.
+	@return: Tuple of (part number, (language, currency))
+	"""
+
+	p = _key.split("|")
+
+	if len(p) == 3:
+		return (p[0], (p[1], p[2]))
+
+	return (_key, API_DEFAULT_LOCALE)
+
+def cache_part_data(_id, _data, _locale=None):
+	"""
+	Stores a search result in the parts cache.
+	@param _id: Digi-Key part number.
+	@param _data: Search result as returned by get_part_data.
+	@param _locale: (language, currency) of the result.  Defaults to LOCALE.
+	@return: Nothing
+	"""
+
+	global PARTS_CACHE
+
+	now = time.time()
+	key = part_cache_key(_id, _locale)
+
+	with STATE_LOCK:
+		e = PARTS_CACHE.get(key, {})
+
+		e[PK_TS] = now
+		e.setdefault(PK_LAST_USED, now)
+		set_part_cache_entry_data(e, _data)
+
+		PARTS_CACHE[key] = e
+
+	MEMORY_CACHE.put(key, _data, now)
+
+	get_part_index().add_parts(_data.get("Parts", []))
+
+	for part in _data.get("Parts", []):
+		if part.get("DigiKeyPartNumber"):
+			get_price_history().record(part_cache_key(part["DigiKeyPartNumber"], _locale), part, now)
+
+	return
+
+def iter_keyword_search(_keywords, _limit=None, _page_size=KEYWORD_PAGE_SIZE):
+	"""
+	Generator that yields the parts of a keyword search one at a time across as many pages as it takes.
+	While the caller works through one page the next one is already being fetched by a background thread.  At most one page is held in reserve so
+	memory use stays bounded no matter how many results there are.  Calls are paced using the recorded rate limit.
+	@param _keywords: Search keywords.
+	@param _limit: Maximum number of parts to yield.  None for all of them.
+	@param _page_size: Results per page.
+	@raise PartLookupError: See get_part_data.  Raised when the failed page would have been yielded.
+	@return: Generator of parts.
+	"""
+
+	pages = Queue.Queue(1)
+	stop = threading.Event()
+
+	def put(_item):
+		while not stop.is_set():
+			try:
+				pages.put(_item, True, 0.5)
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	def fetcher():
+		start = 0
+
+		try:
+			while not stop.is_set() and (_limit is None or start < _limit):
+				count = _page_size
+
+				if _limit is not None:
+					count = min(count, _limit - start)
+
+				pace_api_calls()
+				body = post_search(create_api_keyword_search(_keywords, start, count))
+				parts = body.get("Parts", [])
+
+				if not put(parts):
+					return
+
+				start = start + len(parts)
+				total = body.get("Results", body.get("ProductsCount"))
+
+				if len(parts) < count or (total is not None and start >= int(total)):
+					break
+		except Exception, e:
+			put(e)
+			return
+
+		put(None)
+
+	t = threading.Thread(target=fetcher)
+	t.daemon = True
+	t.start()
+
+	try:
+		while True:
+			page = pages.get()
+
+			if page is None:
+				return
+
+			if isinstance(page, Exception):
+				raise page
+
+			for p in page:
+				yield p
+	finally:
+		# Also runs when the caller stops early
+		stop.set()
+
+def parameters_to_string(_pid):
+	"""
+	Formats what the parameter dictionary knows.
+	@param _pid: Parameter ID whose values to list, or None to list the parameters themselves.
+	@return: Human readable multi-line string.
+	"""
+
+	ret = []
+
+	if _pid is None:
+		for k in sorted(PARAMETRICS_CACHE.names.keys()):
+			ret.append("%8d	%s	(%d values)" % (k, PARAMETRICS_CACHE.name(k), len(PARAMETRICS_CACHE.values.get(k, {}))))
+	else:
+		v = PARAMETRICS_CACHE.values.get(_pid, {})
+
+		for k in sorted(v.keys()):
+			ret.append("%8d	%s" % (k, v[k]))
+
+	if len(ret) < 1:
+		return "Nothing learned yet."
+
+	return "\n".join(ret).encode("utf-8")
+
+def remove_sections(_part, _sections):
+	"""
+	@param _part: Part or search result.
+	@param _sections: Names of the sections to remove, e.g. MediaLinks.
+	@return: Shallow copy of _part without the sections.  The original may be in the parts cache and is left alone.
+	"""
+
+	return dict([(k, v) for k, v in _part.items() if k not in _sections])
+
+def keyword_search(_keywords, _limit, _compact, _remove=()):
+	"""
+	Streams the parts of a keyword search to stdout, one JSON object per line.
+	@param _keywords: Search keywords.
+	@param _limit: Maximum number of parts to output.  None for all of them.
+	@param _compact: Compact JSON if true.
+	@param _remove: Sections to remove from the parts, see SECTION_FLAGS.
+	@return: Number of parts output.
+	"""
+
+	# One object per line either way; compact only drops the spaces
+	seps = (',', ':')
+
+	if not _compact:
+		seps = (', ', ': ')
+
+	n = 0
+
+	for p in iter_keyword_search(_keywords, _limit):
+		p = remove_sections(p, _remove)
+
+		print json.dumps(p, ensure_ascii=True, separators=seps)
+		n = n + 1
+
+	return n
+
+def lookup_part_data(_id, _qty, _locale=None):
+	"""
+	get_part_data for part numbers, as opposed to general keyword searches.  A search that comes back empty is a failure here and the outcome is
+	recorded in the negative cache: permanent failures are remembered and a success clears any earlier failure.
+	@param _id: Digi-Key part number.
+	@param _qty: Part quantity.
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@raise PartLookupError: See get_part_data.  Also raised with kind LF_NO_RESULTS if nothing was found.
+	@return: Search results in a fully formed Python object.
+	"""
+
+	try:
+		d = get_part_data(_id, _qty, _locale)
+
+		if len(d.get("Parts", [])) < 1:
+			raise PartLookupError(LF_NO_RESULTS, "No parts found for [%s]." % _id.strip())
+	except PartLookupError, e:
+		if e.kind in LF_PERMANENT:
+			with STATE_LOCK:
+				NEGATIVE_CACHE[part_number_key(_id)] = {NK_TS: time.time(), NK_KIND: e.kind, NK_REASON: e.reason}
+		raise
+
+	if part_number_key(_id) in NEGATIVE_CACHE:
+		forget_bad_part(part_number_key(_id))
+
+	return d
+
+def known_bad_part(_id):
+	"""
+	@param _id: Digi-Key part number.
+	@return: The negative cache entry if the part number failed permanently within NEGATIVE_CACHE_TTL, None otherwise.
+	"""
+
+	n = NEGATIVE_CACHE.get(part_number_key(_id))
+
+	if n is None or time.time() - n[NK_TS] > NEGATIVE_CACHE_TTL:
+		return None
+
+	return n
+
+def negative_cache_to_string():
+	"""
+	Formats the negative cache.
+	@return: Human readable multi-line string.
+	"""
+
+	ret = []
+
+	for k in sorted(NEGATIVE_CACHE.keys()):
+		n = NEGATIVE_CACHE[k]
+		state = "expired" if known_bad_part(k) is None else "until " + datetime.datetime.fromtimestamp(n[NK_TS] + NEGATIVE_CACHE_TTL).isoformat()
+		ret.append("%-24s %-10s %s: %s" % (k, n[NK_KIND], state, n[NK_REASON]))
+
+	if len(ret) < 1:
+		return "No known-bad part numbers."
+
+	return "\n".join(ret)
+
+def get_cached_part_data(_id, _qty, _ttl=PART_CACHE_TTL, _locale=None):
+	"""
+	Same as get_part_data except that results younger than _ttl are served from MEMORY_CACHE or, failing that, the parts cache.
+	@param _id: Digi-Key part number.
+	@param _qty: Part quantity.  Anything but PART_CACHE_COUNT bypasses the parts cache.
+	@param _ttl: Maximum age of a cached result in seconds.  Zero or less forces a remote call, even for known-bad part numbers.
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@raise PartLookupError: See lookup_part_data.  Known-bad part numbers fail right away without a remote call.
+	@return: Search results in a fully formed Python object.
+	"""
+
+	if int(_qty) != PART_CACHE_COUNT:
+		n = known_bad_part(_id)
+
+		if n is not None and _ttl > 0:
+			raise PartLookupError(n[NK_KIND], "Known bad part number (cached): " + n[NK_REASON])
+
+		return lookup_part_data(_id, _qty, _locale)
+
+	key = part_cache_key(_id, _locale)
+	now = time.time()
+	d = None
+
+	if _ttl > 0:
+		d = MEMORY_CACHE.get(key, _ttl)
+
+	e = cached_part_entry(key)
+
+	if d is None and e is not None and _ttl > 0 and now - e[PK_TS] <= _ttl:
+		d = part_cache_entry_data(e)
+
+		if d is not None:
+			MEMORY_CACHE.put(key, d, e[PK_TS])
+
+	if d is None:
+		n = known_bad_part(_id)
+
+		if n is not None and _ttl > 0:
+			raise PartLookupError(n[NK_KIND], "Known bad part number (cached): " + n[NK_REASON])
+
+		d = lookup_part_data_shared(_id, _qty, _ttl, now, _locale)
+		e = cached_part_entry(key)
+	elif DEBUG_FLAG:
+		print "Serving [%s] from the parts cache." % _id
+
+	if e is not None:
+		e[PK_LAST_USED] = now
+
+	return d
+
+def lookup_part_data_shared(_id, _qty, _ttl, _since, _locale=None):
+	"""
+	Fetches a part into the parts cache, sharing the lookup with anyone else after the same parts cache key at the same time.  Threads of this process
+	that ask while a lookup is in flight wait for it and get its result.  Other processes wait on the key's FlightLock and take the result from
+	FLIGHT_DIR, where the process that fetched it left it.  A permanent failure is shared the same way; after a transient one the next in line tries
+	for itself.
+	@param _id: Digi-Key part number.
+	@param _qty: Part quantity.
+	@param _ttl: Maximum age of a result fetched by another process, in seconds.  Results fetched after _since are taken regardless.
+	@param _since: When the caller found the parts cache entry missing or stale.
+	@param _locale: (language, currency) to ask for.  Defaults to LOCALE.
+	@raise PartLookupError: See lookup_part_data.
+	@return: Search results in a fully formed Python object.
+	"""
+
+	key = part_cache_key(_id, _locale)
+
+	with PART_FLIGHTS_LOCK:
+		f = PART_FLIGHTS.get(key)
+		leader = f is None
+
+		if leader:
+			f = PartFlight()
+			PART_FLIGHTS[key] = f
+
+	if not leader:
+		if DEBUG_FLAG:
+			print "Waiting for the lookup of [%s] already in flight." % key
+
+		f.event.wait()
+
+		if f.error is not None:
+			raise f.error
+
+		return f.data
+
+	try:
+		with STATE_LOCK:
+			e = PARTS_CACHE.get(key)
+
+		d = None
+
+		# A flight that landed between the caller's cache check and ours
+		if e is not None and e[PK_TS] >= _since:
+			d = part_cache_entry_data(e)
+
+		if d is None:
+			with FlightLock(key):
+				d = take_flight_result(key, _ttl, _since)
+
+				if d is None:
+					d = fetch_flight_result(_id, _qty, key, _locale)
+
+		f.data = d
+	except Exception, ex:
+		f.error = ex
+		raise
+	finally:
+		with PART_FLIGHTS_LOCK:
+			PART_FLIGHTS.pop(key, None)
+
+		f.event.set()
+
+	return f.data
+
+def take_flight_result(_key, _ttl, _since):
+	"""
+	Takes a lookup result another process left in FLIGHT_DIR.  Must be called with the key's FlightLock held.
+	@param _key: Parts cache key.
+	@param _ttl: Maximum age of the result in seconds.
+	@param _since: Results fetched after this are taken regardless of _ttl.
+	@raise PartLookupError: The other process found the part number to be permanently bad.
+	@return: Search results, or None if there is no usable result.
+	"""
+
+	try:
+		with open(get_flight_result_file_name(_key), "rt") as res_file:
+			r = json.load(res_file)
+	except Exception, e:
+		return None
+
+	if r.get(FK_KEY) != _key or (r[FK_TS] < _since and time.time() - r[FK_TS] > _ttl):
+		return None
+
+	if FK_KIND in r:
+		with STATE_LOCK:
+			NEGATIVE_CACHE[part_number_key(split_part_cache_key(_key)[0])] = {NK_TS: r[FK_TS], NK_KIND: r[FK_KIND], NK_REASON: r[FK_REASON]}
+
+		raise PartLookupError(r[FK_KIND], r[FK_REASON])
+
+	with STATE_LOCK:
+		e = PARTS_CACHE.get(_key, {})
+
+		if e.get(PK_TS, 0) < r[FK_TS]:
+			e[PK_TS] = r[FK_TS]
+			e.setdefault(PK_LAST_USED, time.time())
+			set_part_cache_entry_data(e, r[FK_DATA])
+
+			PARTS_CACHE[_key] = e
+
+	MEMORY_CACHE.put(_key, r[FK_DATA], r[FK_TS])
+	get_part_index().add_parts(r[FK_DATA].get("Parts", []))
+
+	if DEBUG_FLAG:
+		print "Took [%s] as looked up by another process." % _key
+
+	return r[FK_DATA]
+
+def fetch_flight_result(_id, _qty, _key, _locale):
+	"""
+	Looks a part up, caches it, and leaves the result in FLIGHT_DIR for processes waiting on the key's FlightLock.  Must be called with it held.
+	@param _id: Digi-Key part number.
+	@param _qty: Part quantity.
+	@param _key: Parts cache key.
+	@param _locale: (language, currency) to ask for.
+	@raise PartLookupError: See lookup_part_data.
+	@return: Search results in a fully formed Python object.
+	"""
+
+	r = {FK_KEY: _key}
+
+	try:
+		d = lookup_part_data(_id, _qty, _locale)
+		cache_part_data(_id, d, _locale)
+
+		with STATE_LOCK:
+			r[FK_TS] = PARTS_CACHE[_key][PK_TS]
+			r[FK_DATA] = d
+	except PartLookupError, ex:
+		if ex.kind not in LF_PERMANENT:
+			raise
+
+		r[FK_TS] = time.time()
+		r[FK_KIND] = ex.kind
+		r[FK_REASON] = ex.reason
+		d = None
+
+	if fcntl is not None:
+		try:
+			os.makedirs(os.path.join(os.path.expanduser("~"), FLIGHT_DIR))
+		except OSError, ex:
+			# Already there
+			pass
+
+		try:
+			with open(get_flight_result_file_name(_key) + ".tmp", "wt") as res_file:
+				json.dump(r, res_file, separators=(',', ':'))
+
+			os.rename(get_flight_result_file_name(_key) + ".tmp", get_flight_result_file_name(_key))
+		except (IOError, OSError), ex:
+			# Waiting processes fetch it themselves
+			print >> sys.stderr, "Failed to share the lookup of [%s]: %s" % (_key, str(ex))
+
+	if d is None:
+		raise PartLookupError(r[FK_KIND], r[FK_REASON])
+
+	return d
+
+def search_for_part(_part, _count, _compact, _ttl=PART_CACHE_TTL, _pace=False, _remove=()):
+	"""
+	Looks a part up, from the parts cache if possible, and formats it.
+	@param _part: Digi-Key part number.
+	@param _count: Part quantity.
+	@param _compact: Compact JSON if true.
+	@param _ttl: Maximum age of a cached result in seconds.
+	@param _pace: Pace the remote call, if there is one, using the recorded rate limit.
+	@param _remove: Sections to remove from the result, see SECTION_FLAGS.
+	@raise PartLookupError: See get_cached_part_data.
+	@return: JSON string of the part, or of the whole search result if it found more than one.
+	"""
+
+	d = None
+
+	ind = 2
+	seps = (', ', ': ')
+
+	if _compact:
+		ind = None
+		seps = (',', ':')
+
+	e = cached_part_entry(part_cache_key(_part))
+
+	if _pace and (int(_count) != PART_CACHE_COUNT or e is None or _ttl <= 0 or time.time() - e[PK_TS] > _ttl):
+		pace_api_calls()
+
+	d = get_cached_part_data(_part, _count, _ttl)
+
+	if len(d["Parts"]) == 1:
+		d = d["Parts"][0]
+
+	d = remove_sections(d, _remove)
+
+	with phase_profile.phase("json.dumps"):
+		return json.dumps(d, indent=ind, ensure_ascii=True, separators=seps)
+
+def load_refresh_state():
+	"""
+	Loads the refresh scheduler state.  A missing or broken file simply means an empty queue and call log.
+	@return: Refresh scheduler state map.
+	"""
+
+	ret = {}
+
+	try:
+		with open(get_refresh_state_file_name(), "rt") as st_file:
+			ret = json.load(st_file)
+	except Exception, e:
+		# Sink it quietly
+		pass
+
+	ret.setdefault(RK_QUEUE, [])
+	ret.setdefault(RK_CALLS, [])
+
+	return ret
+
+def save_refresh_state(_state):
+	"""
+	Saves the refresh scheduler state.
+	@param _state: Refresh scheduler state map.
+	@return: Nothing
+	"""
+
+	try:
+		with open(get_refresh_state_file_name(), "wt") as st_file:
+			json.dump(_state, st_file, separators=(',', ':'))
+	except Exception, e:
+		print >> sys.stderr, "Failed to save refresh scheduler state: " + str(e)
+
+	return
+
+def get_refresh_budget():
+	"""
+	Returns the refresh call budget from the application state/configuration.  The defaults are per credential so they grow with the pool;
+	configured values are for the whole pool.
+	@return: Tuple of (calls per minute, calls per day)
+	"""
+
+	n = len(get_credentials())
+
+	return (int(GLOBAL_CONTEXT.get(CK_REFRESH_PER_MINUTE, REFRESH_DEFAULT_PER_MINUTE * n)), int(GLOBAL_CONTEXT.get(CK_REFRESH_PER_DAY, REFRESH_DEFAULT_PER_DAY * n)))
+
+def refresh_budget_wait(_state, _per_minute, _per_day):
+	"""
+	Works out how long we have to wait before the next call fits in the budget.
+	Calls older than a day are dropped from the call log as a side effect.
+	@param _state: Refresh scheduler state map.
+	@param _per_minute: Maximum number of calls in any 60 second window.
+	@param _per_day: Maximum number of calls in any 24 hour window.
+	@return: Seconds to wait.  Zero if a call can be made right now.
+	"""
+
+	now = time.time()
+	calls = [c for c in _state[RK_CALLS] if now - c < 24 * 60 * 60]
+	_state[RK_CALLS] = calls
+
+	wait = 0
+
+	if len(calls) >= _per_day:
+		wait = max(wait, calls[len(calls) - _per_day] + 24 * 60 * 60 - now)
+
+	last_minute = [c for c in calls if now - c < 60]
+
+	if len(last_minute) >= _per_minute:
+		wait = max(wait, last_minute[len(last_minute) - _per_minute] + 60 - now)
+
+	return wait
+
+def part_refresh_interval(_entry, _now):
+	"""
+	Works out how often a cached part should be refreshed.  Low stock, recently used, and high value parts are refreshed more often.
+	@param _entry: Parts cache entry.
+	@param _now: Current time.
+	@return: Refresh interval in seconds.
+	"""
+
+	interval = REFRESH_BASE_INTERVAL
+
+	try:
+		part = part_cache_entry_data(_entry)["Parts"][0]
+	except (KeyError, IndexError, TypeError):
+		return interval
+
+	qty = part.get("QuantityAvailable")
+
+	if qty is not None:
+		if int(qty) < REFRESH_LOW_STOCK:
+			interval = interval / 4
+		elif int(qty) < REFRESH_MEDIUM_STOCK:
+			interval = interval / 2
+
+	if _now - _entry.get(PK_LAST_USED, 0) < REFRESH_RECENT_USE:
+		interval = interval / 2
+
+	try:
+		if float(part["StandardPricing"][0]["UnitPrice"]) >= REFRESH_HIGH_VALUE:
+			interval = interval / 2
+	except (KeyError, IndexError, TypeError, ValueError):
+		pass
+
+	return max(interval, REFRESH_MIN_INTERVAL)
+
+def build_refresh_queue(_state):
+	"""
+	Brings the persisted refresh queue in line with the parts cache.  Parts that are no longer cached are dropped, newly cached parts are scheduled, and
+	parts refreshed outside of the scheduler are pushed back.
+	@param _state: Refresh scheduler state map.
+	@return: The queue as a heap of [due time, part cache key] pairs.
+	"""
+
+	now = time.time()
+	queue = []
+	seen = set()
+
+	for due, key in _state[RK_QUEUE]:
+		if key in PARTS_CACHE and key not in seen:
+			# The part may have been refreshed by something other than the scheduler since the queue was saved
+			e = PARTS_CACHE[key]
+			queue.append([max(due, e[PK_TS] + part_refresh_interval(e, now)), key])
+			seen.add(key)
+
+	for key in PARTS_CACHE.keys():
+		if key not in seen:
+			e = PARTS_CACHE[key]
+			queue.append([e[PK_TS] + part_refresh_interval(e, now), key])
+
+	heapq.heapify(queue)
+	_state[RK_QUEUE] = queue
+
+	return queue
+
+def refresh_parts(_continuous, _per_minute=None, _per_day=None):
+	"""
+	Refreshes cached parts in order of when they are due, without going over the call budget.
+	In bounded mode it returns once nothing is due or the budget is spent.  In continuous mode it sleeps until the next part is due or the budget frees up.
+	@param _continuous: Keep going forever if true.
+	@param _per_minute: Override for the per-minute call budget.
+	@param _per_day: Override for the per-day call budget.
+	@return: Number of parts refreshed.
+	"""
+
+	per_minute, per_day = get_refresh_budget()
+
+	if _per_minute is not None:
+		per_minute = _per_minute
+	if _per_day is not None:
+		per_day = _per_day
+
+	state = load_refresh_state()
+	queue = build_refresh_queue(state)
+	refreshed = 0
+
+	try:
+		while len(queue) > 0:
+			now = time.time()
+			due, key = queue[0]
+
+			wait = max(due - now, refresh_budget_wait(state, per_minute, per_day), quota_pace_delay())
+
+			if wait > 0:
+				if not _continuous:
+					break
+
+				save_refresh_state(state)
+				save_parts_cache()
+				save_price_history()
+				time.sleep(wait)
+				continue
+
+			heapq.heappop(queue)
+			state[RK_CALLS].append(time.time())
+
+			try:
+				pn, locale = split_part_cache_key(key)
+				cache_part_data(pn, lookup_part_data(pn, 1, locale), locale)
+				refreshed = refreshed + 1
+				heapq.heappush(queue, [time.time() + part_refresh_interval(PARTS_CACHE[key], time.time()), key])
+
+				if DEBUG_FLAG:
+					print "Refreshed [%s]." % key
+			except RuntimeError, e:
+				print >> sys.stderr, "Failed to refresh [%s]: %s" % (key, str(e))
+				heapq.heappush(queue, [time.time() + REFRESH_RETRY_INTERVAL, key])
+	finally:
+		save_refresh_state(state)
+		save_parts_cache()
+		save_price_history()
+
+	return refreshed
+
+def comma_list(_value):
+	"""
+	Splits a comma separated command line value.  Used instead of nargs="+", which swallows the command when the switch comes first.
+	@param _value: Switch value.
+	@return: List of the non-blank items.
+	"""
+
+	return [i.strip() for i in _value.split(",") if len(i.strip()) > 0]
+
+def read_part_list(_file_name):
+	"""
+	Reads Digi-Key part numbers out of a file.  KiBOM generated BOM files and KiCad XML BOM files are handed off to check_bom.py, anything else is taken
+	to be one part number per line with '#' starting a comment.
+	@param _file_name: BOM or part list file.
+	@return: List of part numbers in file order.
+	"""
+
+	import check_bom
+
+	if _file_name.lower().endswith(".xml"):
+		return [l[check_bom.COL_IDX_DKPN].strip() for l in check_bom.read_bom(_file_name)]
+
+	with open(_file_name, "rt") as in_file:
+		lines = in_file.readlines()
+
+	if len(lines) > 1 and check_bom.SEP_CHAR in lines[1]:
+		return [l[check_bom.COL_IDX_DKPN].strip() for l in check_bom.read_bom(_file_name)]
+
+	ret = []
+
+	for l in lines:
+		l = l.split("#")[0].strip()
+
+		if len(l) > 0:
+			ret.append(l)
+
+	return ret
+
+def part_needs_fetch(_id, _ttl, _locale=None):
+	"""
+	@param _id: Digi-Key part number.
+	@param _ttl: Maximum age of a cached result in seconds.
+	@param _locale: (language, currency).  Defaults to LOCALE.
+	@return: True if the part is missing from the parts cache, is too old, or can't be read.  False for known-bad part numbers.
+	"""
+
+	e = cached_part_entry(part_cache_key(_id, _locale))
+
+	if e is None and known_bad_part(_id) is not None:
+		return False
+
+	return e is None or time.time() - e[PK_TS] > _ttl or part_cache_entry_data(e) is None
+
+def load_prefetch_progress():
+	"""
+	Loads the progress of an interrupted PREFETCH.
+	@return: Prefetch progress map.
+	"""
+
+	ret = {}
+
+	try:
+		with open(get_prefetch_file_name(), "rt") as pf_file:
+			ret = json.load(pf_file)
+	except Exception, e:
+		# Sink it quietly; nothing to resume
+		pass
+
+	ret.setdefault(PF_PENDING, [])
+	ret.setdefault(PF_FAILED, {})
+
+	return ret
+
+def save_prefetch_progress(_progress):
+	"""
+	Saves the prefetch progress.  If nothing is pending the progress file is removed.
+	@param _progress: Prefetch progress map.
+	@return: Nothing
+	"""
+
+	try:
+		if len(_progress[PF_PENDING]) < 1:
+			if os.path.exists(get_prefetch_file_name()):
+				os.remove(get_prefetch_file_name())
+			return
+
+		with open(get_prefetch_file_name(), "wt") as pf_file:
+			json.dump(_progress, pf_file, indent=4, sort_keys=True)
+	except Exception, e:
+		print >> sys.stderr, "Failed to save prefetch progress: " + str(e)
+
+	return
+
+def prefetch_parts(_files, _workers=PREFETCH_DEFAULT_WORKERS, _ttl=PART_CACHE_TTL, _per_minute=None, _per_day=None):
+	"""
+	Fetches every part in the given BOMs/part lists that is missing or stale in the parts cache.
+	The fetching is done by background worker threads that share the refresh scheduler's call budget and pace themselves using the recorded rate limit.
+	Whatever is left over from an interrupted run is picked up first.
+	@param _files: BOM or part list files.  May be empty to just resume.
+	@param _workers: Number of worker threads.
+	@param _ttl: Maximum age of a cached result in seconds.
+	@param _per_minute: Override for the per-minute call budget.
+	@param _per_day: Override for the per-day call budget.
+	@return: Tuple of (parts fetched, parts failed)
+	"""
+
+	progress = load_prefetch_progress()
+
+	pending = []
+	seen = set()
+
+	for pn in progress[PF_PENDING] + [pn for f in _files for pn in read_part_list(f)]:
+		if part_cache_key(pn) in seen or not part_needs_fetch(pn, _ttl):
+			continue
+		seen.add(part_cache_key(pn))
+		pending.append(pn)
+
+	progress[PF_PENDING] = pending
+	progress[PF_FAILED] = {}
+	save_prefetch_progress(progress)
+
+	if len(pending) < 1:
+		print "Nothing to prefetch."
+		return (0, 0)
+
+	per_minute, per_day = get_refresh_budget()
+
+	if _per_minute is not None:
+		per_minute = _per_minute
+	if _per_day is not None:
+		per_day = _per_day
+
+	state = load_refresh_state()
+	budget_lock = threading.Lock()
+	stop = threading.Event()
+	work = Queue.Queue()
+	done = set()
+	failed = {}
+
+	for pn in pending:
+		work.put(pn)
+
+	def take_budget():
+		while not stop.is_set():
+			with budget_lock:
+				wait = max(refresh_budget_wait(state, per_minute, per_day), quota_pace_delay())
+
+				if wait <= 0:
+					state[RK_CALLS].append(time.time())
+					return True
+
+			stop.wait(min(wait, 1))
+
+		return False
+
+	def worker():
+		while not stop.is_set():
+			try:
+				pn = work.get_nowait()
+			except Queue.Empty:
+				return
+
+			if not take_budget():
+				return
+
+			try:
+				lookup_part_data_shared(pn, 1, _ttl, time.time())
+
+				with budget_lock:
+					done.add(pn)
+			except RuntimeError, e:
+				with budget_lock:
+					failed[pn] = str(e)
+
+	def checkpoint():
+		with budget_lock:
+			progress[PF_PENDING] = [pn for pn in pending if pn not in done and pn not in failed]
+			progress[PF_FAILED] = dict(failed)
+			save_refresh_state(state)
+
+		save_parts_cache()
+		save_price_history()
+		save_prefetch_progress(progress)
+
+	threads = [threading.Thread(target=worker) for i in range(max(_workers, 1))]
+
+	for t in threads:
+		t.daemon = True
+		t.start()
+
+	start = time.time()
+	last_report = start
+	last_save = 0
+
+	try:
+		while len([t for t in threads if t.is_alive()]) > 0:
+			time.sleep(0.25)
+
+			finished = len(done) + len(failed)
+
+			if finished - last_save >= PREFETCH_SAVE_EVERY:
+				checkpoint()
+				last_save = finished
+
+			if time.time() - last_report >= PREFETCH_REPORT_INTERVAL:
+				rate = len(done) / (time.time() - start)
+				print "Prefetch: %d/%d fetched, %d failed, %.2f parts/s" % (len(done), len(pending), len(failed), rate)
+				sys.stdout.flush()
+				last_report = time.time()
+	except KeyboardInterrupt:
+		stop.set()
+		print >> sys.stderr, "Interrupted.  Run PREFETCH again to resume."
+
+		for t in threads:
+			t.join(5)
+	finally:
+		checkpoint()
+
+	print "Prefetch: %d/%d fetched, %d failed in %.1f seconds." % (len(done), len(pending), len(failed), time.time() - start)
+
+	for pn in sorted(failed.keys()):
+		print >> sys.stderr, "Failed to prefetch [%s]: %s" % (pn, failed[pn])
+
+	return (len(done), len(failed))
+
+def locale_pricing(_parts, _locales, _workers=PREFETCH_DEFAULT_WORKERS, _ttl=PART_CACHE_TTL):
+	"""
+	Looks up every part in every locale, all at once with worker threads, and merges the pricing of each part into one result.
+	Parts already cached in a locale cost nothing; remote calls are paced using the recorded rate limit.
+	@param _parts: Digi-Key part numbers.
+	@param _locales: (language, currency) tuples.
+	@param _workers: Number of worker threads.
+	@param _ttl: Maximum age of a cached result in seconds.
+	@return: List, in _parts order, of the part as found in the first locale that had it with LOCALE_PRICE_FIELDS moved into a LocalePricing map keyed
+	by 'language/currency'.  Lookups that failed are listed in a LocaleErrors map.  Just the DigiKeyPartNumber and LocaleErrors if it failed everywhere.
+	"""
+
+	work = Queue.Queue()
+	found = {}
+	errors = {}
+	lock = threading.Lock()
+
+	for i in range(len(_parts)):
+		for locale in _locales:
+			work.put((i, locale))
+
+	def worker():
+		while True:
+			try:
+				i, locale = work.get_nowait()
+			except Queue.Empty:
+				return
+
+			try:
+				if part_needs_fetch(_parts[i], _ttl, locale):
+					pace_api_calls()
 
-	if not GLOBAL_CONTEXT.has_key(CK_API_CLIENT_ID):
-		raise ValueError("State/config file is missing the API_CLIENT_ID key.  This is part of the API configuration on the Digi-Key API portal.")
+				part = get_cached_part_data(_parts[i], 1, _ttl, locale)["Parts"][0]
 
-	if not GLOBAL_CONTEXT.has_key(CK_API_SECRET):
-		raise ValueError("State/config file is missing the API_SECRET key.  This is part of the API configuration on the Digi-Key API portal.")
+				with lock:
+					found[(i, locale)] = part
+			except (RuntimeError, IndexError, KeyError), e:
+				with lock:
+					errors[(i, locale)] = str(e)
 
-	if not GLOBAL_CONTEXT.has_key(CK_API_REDIRECT):
-		raise ValueError("State/config file is missing the API_REDIRECT_URI key.  This is part of the API configuration on the Digi-Key API portal.")
+	threads = [threading.Thread(target=worker) for i in range(max(_workers, 1))]
 
-	if not GLOBAL_CONTEXT.has_key(CK_LOGIN_NAME):
-		raise ValueError("State/config file is missing the LOGIN_NAME key.  This is the login name of your Digi-Key account that you use to buy parts.")
+	for t in threads:
+		t.daemon = True
+		t.start()
 
-	if not GLOBAL_CONTEXT.has_key(CK_LOGIN_PASSWORD):
-		raise ValueError("State/config file is missing the LOGIN_PASSWORD key.  This is the password of your Digi-Key account that you use to buy parts.")
+	for t in threads:
+		t.join()
 
+	ret = []
 
-	if not GLOBAL_CONTEXT.has_key(CK_CONTEXT):
-		raise ValueError("State/config file is missing the CONTEXT.  This means that your file is corrupt/incomplete.  Please read documentation in this source file.")
+	for i in range(len(_parts)):
+		merged = None
+		pricing = {}
+		failed = {}
 
+		for locale in _locales:
+			name = "%s/%s" % locale
 
-	if not GLOBAL_CONTEXT.has_key(CK_DEBUG):
-		GLOBAL_CONTEXT[CK_DEBUG] = "FALSE"
+			if (i, locale) not in found:
+				failed[name] = errors.get((i, locale), "Not found.")
+				continue
 
-	if GLOBAL_CONTEXT[CK_DEBUG] == "TRUE":
-		DEBUG_FLAG = True
-	else:
-		DEBUG_FLAG = False
+			part = found[(i, locale)]
 
-	if DEBUG_FLAG:
-		print "Successfully loaded application state/config."
+			if merged is None:
+				merged = dict([(k, v) for k, v in part.items() if k not in LOCALE_PRICE_FIELDS])
 
-	return
+			pricing[name] = dict([(k, part[k]) for k in LOCALE_PRICE_FIELDS if k in part])
 
+		if merged is None:
+			merged = {"DigiKeyPartNumber": _parts[i].strip()}
+		else:
+			merged["LocalePricing"] = pricing
 
-def create_api_auth_refresh_parms(_client_id, _api_secret, _refresh_token):
-	"""
-	Creates the request parameters necessary to refresh an authentication token.
-	@param _client_id: Client ID magic string from the API setup.
-	@param _api_secret: Super secret API secret from the API setup that you are never allowed to see past the initial creation of the application.
-	@param _refresh_token: Last valid refresh token.  This is an important magic string.  This is usually stored in the application state/configuration.
-	@return: A map of parameters that may be useful in refreshing the auth token.
-	"""
+		if len(failed) > 0:
+			merged["LocaleErrors"] = failed
 
-	ret = {}
-	ret["refresh_token"] = _refresh_token
-	ret["grant_type"] = "refresh_token"
-	ret["client_id"] = _client_id
-	ret["client_secret"] = _api_secret
+		ret.append(merged)
 
 	return ret
 
-def create_api_call_headers(_client_id, _auth_token):
+class DigiKeyClient(object):
 	"""
-	Creates the necessary headers to invoke an API call.
-	@param _client_id: Client ID magic string.
-	@param _auth_token: Authentication token magic string.  This is usually stored in the application state/configuration.
-	@return: A map of headers.
+	Self-contained API client for programs that use dkapia as a library.  Owns its configuration and tokens, HTTP sessions, MemoryCache, negative cache,
+	and ParameterDictionary instead of using the module globals, so several clients with different configurations can live in one process and each
+	can be used from any number of threads.  Errors are raised, never turned into exits.  The state/config file, if there is one, is only written to
+	save new tokens and rate limit information; the parts cache file is not used.
 	"""
 
-	ret = {}
-	ret["accept"] = "application/json"
-	#ret["x-digikey-locale-language"] = "en"
-	#ret["x-digikey-locale-currency"] = "usd"
-	ret["authorization"] = str(_auth_token)
-	ret["content-type"] = "application/json"
-	ret["x-ibm-client-id"] = str(_client_id)
+	def __init__(self, _config, _state_file=None, _memory_bytes=MEMORY_CACHE_DEFAULT_BYTES, _debug=False):
+		"""
+		@param _config: Credential map laid out like the top level of the state/config file: API_CLIENT_ID, API_SECRET, and CONTEXT, plus API_REDIRECT_URI,
+		LOGIN_NAME, and LOGIN_PASSWORD if the client may have to authenticate from scratch, and optionally SSO_HOST.  Copied.  Nothing missing from it is
+		taken from the module's state/config file.
+		@param _state_file: State/config file to save new tokens to, and to pick up tokens refreshed by other processes from.  None to keep them in memory.
+		@param _memory_bytes: Size of the client's MemoryCache.
+		@param _debug: Print what's going on.
+		@raise ValueError: The configuration is missing the client ID or secret.
+		"""
+
+		if CK_API_CLIENT_ID not in _config or CK_API_SECRET not in _config:
+			raise ValueError("A client needs an API_CLIENT_ID and an API_SECRET.")
+
+		self.config = json.loads(json.dumps(_config))
+		self.config.setdefault(CK_CONTEXT, {})
+		self.config.pop(CK_CREDENTIALS, None)
+		self.state_file = _state_file
+		self.debug = _debug
+		self.locale = normalize_locale((self.config.get(CK_LOCALE_LANGUAGE, API_DEFAULT_LOCALE[0]), self.config.get(CK_LOCALE_CURRENCY, API_DEFAULT_LOCALE[1])))
+
+		self.token_lock = threading.RLock()
+		self.file_lock = None
+
+		if _state_file is not None:
+			self.file_lock = StateFileLock(os.path.splitext(_state_file)[0] + ".lock")
+
+		self.sessions = threading.local()
+		self.memory = memory_cache.MemoryCache(_memory_bytes)
+		self.negative = {}
+		self.negative_lock = threading.Lock()
+		self.parametrics = ParameterDictionary()
+		self.flights = {}
+		self.flights_lock = threading.Lock()
+		return
 
-	return ret
+	@classmethod
+	def from_state_file(cls, _file_name=None, _cred=0, **_kwargs):
+		"""
+		Makes a client out of a state/config file.
+		@param _file_name: State/config file.  Defaults to the one in the home directory.
+		@param _cred: Credential to use: 0 for the top level of the file, 1 and up for the CREDENTIALS entries.  Settings a CREDENTIALS entry doesn't have
+		are taken from the top level.
+		@param _kwargs: Passed on to the constructor.
+		@raise Exception: Passes along any exceptions from reading or parsing the file.
+		@return: The client.
+		"""
+
+		if _file_name is None:
+			_file_name = get_context_file_name()
+
+		with open(_file_name, "rt") as ctx_file:
+			root = json.load(ctx_file)
+
+		if _cred == 0:
+			config = root
+		else:
+			config = dict([(k, v) for k, v in root.items() if k not in (CK_CONTEXT, CK_CREDENTIALS)])
+			config.update(root.get(CK_CREDENTIALS, [])[_cred - 1])
 
-def create_api_part_search(_id, _qty):
-	"""
-	Creates the map containing the pertinent part search parameters.
-	@param _id: Digi-Key part ID.
-	@param _qty: Part quantity.  Should probably be more than zero.
-	@return: A map of the parameters.
-	"""
-	ret = {}
-	ret["Keywords"] = _id
-	ret["RecordCount"] = _qty
+		return cls(config, _file_name, **_kwargs)
 
-	return ret
+	def session(self):
+		"""
+		@return: This thread's HTTP session.  Sessions keep connections alive but aren't meant to be shared between threads.
+		"""
 
-def create_auth_magic_url_one():
-	"""
-	Cobbles together a URL for the first step of the authentication magic
-	@see: https://api-portal.digikey.com/node/188
-	@return: A URL with the magic bits specified in the application configuration
-	"""
+		if getattr(self.sessions, "session", None) is None:
+			self.sessions.session = requests.Session()
 
-	return SSO_HOST + "/as/authorization.oauth2?response_type=code&client_id=" + GLOBAL_CONTEXT[CK_API_CLIENT_ID] + "&redirect_uri=" + GLOBAL_CONTEXT[CK_API_REDIRECT]
+		return self.sessions.session
 
-def create_auth_magic_url_two(_code):
-	"""
-	Cobbles together a URL for the second step of the authentication magic.
-	@see: https://api-portal.digikey.com/node/188
-	@return: A URL with the magic bits specified in the application configuration combined with magic bits produced by authentication magic step one.
-	"""
+	def access_token(self):
+		"""
+		@return: The current access token, refreshed first if it is missing or about to expire.
+		@raise PartLookupError: Kind LF_AUTH if there is no way to get one.
+		"""
 
-	# For V1
-	# V2 expects everything to be moved out of the request and into the body
-	# return SSO_HOST + "/as/token.oauth2?grant_type=authorization_code&code=" + _code + "&client_id=" + GLOBAL_CONTEXT[CK_API_CLIENT_ID] + "&client_secret=" + GLOBAL_CONTEXT[CK_API_SECRET] + "&redirect_uri=" + GLOBAL_CONTEXT[CK_API_REDIRECT]
+		with self.token_lock:
+			token = self.config[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK)
 
-	return SSO_HOST + "/as/token.oauth2"
+			if token is not None and not auth_token_expired(self.config):
+				return token
 
-def invoke_auth_magic_one():
-	"""
-	Performs the first step of the authentication magic.
-	@see: https://api-portal.digikey.com/node/188
-	@return: Magic code to be used in step two of the authentication.
-	"""
+		self.refresh_token(token)
 
-	if DEBUG_FLAG:
-		print "Trying to perform first stage of magic: invoking a redirect so user has chance to approve us."
+		return self.config[CK_CONTEXT][CK_CONTEXT_ACC_TOK]
 
-	https_session = requests.Session()
-	magic_string = create_auth_magic_url_one()
-	r = https_session.post(magic_string)
+	def refresh_token(self, _seen_token):
+		"""
+		Single-flight token refresh, like refresh_auth_token_shared: only the first thread to come in with a given stale token refreshes it, and with a
+		state file tokens another process refreshed in the meantime are adopted instead.
+		@param _seen_token: The access token the caller found expired or rejected.
+		@raise PartLookupError: Kind LF_AUTH if the refresh failed.
+		@return: Nothing
+		"""
 
-	if r.status_code != 200:
-		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT START " + ("*" * 10)
-		print >> sys.stderr, "Failed in the first sub-step of the authentication magic step one."
-		print >> sys.stderr, "Response code: " + r.status_code
-		dump_response_headers(r, sys.stderr)
-		print >> sys.stderr, r.text
-		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT END " + ("*" * 10)
-		raise RuntimeError("Failed to get new tokens in authentication magic step one.  See program output for details.")
+		with self.token_lock:
+			if self.config[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK) != _seen_token:
+				return
 
-	html_parser = MyHTMLParser()
-	html_parser.feed(r.text)
+			if self.file_lock is None:
+				self.refresh_token_now()
+				return
 
-	if DEBUG_FLAG:
-		print "Trying to perform second stage of magic: fudging login via form."
+			with self.file_lock:
+				if self.adopt_newer_tokens() and self.config[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK) != _seen_token:
+					return
 
-	https_session.headers.update({"Referer": magic_string, "Content-Type": "application/x-www-form-urlencoded"})
+				self.refresh_token_now()
+				self.save_state()
 
-	r = https_session.post(SSO_HOST + html_parser.form_action, data={"pf.username": GLOBAL_CONTEXT[CK_LOGIN_NAME], "pf.pass":GLOBAL_CONTEXT[CK_LOGIN_PASSWORD], "pf.ok":"clicked"}, allow_redirects=False)
+		return
 
-	#
-	# XXX I guess here there could be another response.  If the session is expired there might be another clickthrough dialog.
-	#
-	if r.status_code != 302:
-		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT START " + ("*" * 10)
-		print >> sys.stderr, "Failed in the second sub-step of the authentication magic step one."
-		print >> sys.stderr, "Response code: " + r.status_code
-		dump_response_headers(r, sys.stderr)
-		print >> sys.stderr, r.text
-		print >> sys.stderr, ("*" * 10) + " ERROR OUTPUT END " + ("*" * 10)
-		raise RuntimeError("Failed to get new tokens in authentication magic step one.  See program output for details.")
+	def refresh_token_now(self):
+		"""
+		Trades the refresh token for new tokens, or goes through the new authentication magic if there isn't one.  Must be called with the token lock held.
+		@raise PartLookupError: Kind LF_AUTH if it didn't work.
+		@return: Nothing
+		"""
 
-	magic_code = None
+		cookie_file = None
 
-	try:
-		#
-		# What do you mean "robust"?
-		#
-		# On success the redirect header will look something like this:
-		# Location: https://localhost?code=<MAGIC BEANS>
-		#
-		# We extract the code parameter because that's really all we care about
-		#
+		if self.state_file is not None:
+			# Next to the state file, so a client of the home directory state file shares the SSO session with the command line
+			cookie_file = os.path.join(os.path.dirname(os.path.abspath(self.state_file)), SSO_COOKIE_FILE)
 
-		magic_code = r.headers["Location"].split("?")[1].split("=")[1]
-	except Exception, e:
-		print >> sys.stderr, "Failed to extract code from the 'Location' response header: " + str(e)
-		dump_response_headers(r, sys.stderr)
-		raise RuntimeError("Failed to get new tokens in authentication magic step one.  See program output for details.")
+		try:
+			renew_tokens(self.session(), self.auth_settings(), self.config[CK_CONTEXT], cookie_file, self.file_lock, self.debug)
+		except KeyError, e:
+			raise PartLookupError(LF_AUTH, "The client's configuration has no %s, which getting tokens needs." % e.args[0])
+		except (requests.exceptions.RequestException, RuntimeError, ValueError), e:
+			raise PartLookupError(LF_AUTH, "Failed to get tokens: " + str(e))
 
-	if magic_code is None:
-		raise RuntimeError("Failed to get new tokens in authentication magic step one.  Magic code seems to be None even though everything went well.")
+		if self.debug:
+			print "Refreshed the tokens of " + self.config[CK_API_CLIENT_ID]
 
-	if DEBUG_FLAG:
-		print "If we got this far we probably have a new code."
-		print "Code: " + str(magic_code)
+		return
 
-	return magic_code
+	def auth_settings(self):
+		"""
+		@return: Auth settings map (see credential_auth_settings) made from the client's own configuration only.  Settings it doesn't have are left out,
+		never taken from the module's state/config file.
+		"""
 
-def invoke_auth_magic_two(_code):
-	"""
-	Performs the second step of the authentication magic.  Here we get the real-real authentication token and a refresh token.
-	@param _code: Magic code from step one of the authentication process.
-	@see: https://api-portal.digikey.com/node/188
+		ret = dict([(k, self.config[k]) for k in (CK_API_CLIENT_ID, CK_API_SECRET, CK_API_REDIRECT, CK_LOGIN_NAME, CK_LOGIN_PASSWORD) if k in self.config])
+		ret[CK_SSO_HOST] = self.config.get(CK_SSO_HOST, SSO_DEFAULT_HOST).rstrip("/")
 
-	"""
-	if DEBUG_FLAG:
-		print "Trying to collect more magic beans."
+		return ret
 
-	global GLOBAL_CONTEXT
+	def state_file_credential(self, _root):
+		"""
+		@param _root: Parsed state/config file.
+		@return: The credential map in it with our client ID, or None.
+		"""
 
-	magic_string = create_auth_magic_url_two(_code)
+		for cred in [_root] + _root.get(CK_CREDENTIALS, []):
+			if cred.get(CK_API_CLIENT_ID) == self.config[CK_API_CLIENT_ID]:
+				return cred
 
-	if DEBUG_FLAG:
-		print "Magic URL: " + magic_string
+		return None
 
-	post_data = {}
+	def adopt_newer_tokens(self):
+		"""
+		Takes the tokens in the state file if they are newer than ours.  Must be called with the file lock held.
+		@return: True if they were.
+		"""
 
-	post_data["code"] = _code
-	post_data["client_id"] = GLOBAL_CONTEXT[CK_API_CLIENT_ID]
-	post_data["client_secret"] = GLOBAL_CONTEXT[CK_API_SECRET]
-	post_data["redirect_uri"] = GLOBAL_CONTEXT[CK_API_REDIRECT]
-	post_data["grant_type"] = "authorization_code"
+		try:
+			with open(self.state_file, "rt") as ctx_file:
+				cred = self.state_file_credential(json.load(ctx_file))
+		except Exception, e:
+			return False
 
-	r = requests.post(magic_string,data = post_data)
+		if cred is None:
+			return False
 
-	if r.status_code < 200 or r.status_code >= 300:
-		print >> sys.stderr, "Failed to get new tokens in authentication magic step two"
-		print >> sys.stderr, "Response code: " + str(r.status_code)
-		dump_response_headers(r, sys.stderr)
-		print >> sys.stderr, "Response text: "
-		print >> sys.stderr, r.text
+		return adopt_context_tokens(self.config[CK_CONTEXT], cred.get(CK_CONTEXT, {}))
 
-		raise RuntimeError("Failed to get new tokens in authentication magic step two.  See program output for details.")
+	def save_state(self):
+		"""
+		Writes our tokens and rate limit information to our entry in the state file.  Everything else in the file is left as it is.
+		@return: Nothing
+		"""
 
-	d = json.loads(r.text)
+		if self.state_file is None:
+			return
 
-	GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_ACC_TOK] = d["access_token"]
-	GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_REF_TOK] = d["refresh_token"]
+		with self.file_lock:
+			try:
+				with open(self.state_file, "rt") as ctx_file:
+					root = json.load(ctx_file)
 
-	if DEBUG_FLAG:
-		print "We should have enough magic beans to grow the bean stalk so that we can climb INTO THE CLOUD."
+				cred = self.state_file_credential(root)
 
-	return
+				if cred is None:
+					return
 
-def new_auth():
-	"""
-	Performs the new authentication song and dance.  Waves the dead chicken in the air in just the right way.
-	@see: https://api-portal.digikey.com/node/188
-	"""
-	magic_code = invoke_auth_magic_one()
-	invoke_auth_magic_two(magic_code)
+				ctx = cred.setdefault(CK_CONTEXT, {})
 
-	return
+				for k in (CK_CONTEXT_REF_TOK, CK_CONTEXT_ACC_TOK, CK_CONTEXT_EXP, CK_CONTEXT_TS, CK_CONTEXT_RATE_LIMIT):
+					if k in self.config[CK_CONTEXT]:
+						ctx[k] = self.config[CK_CONTEXT][k]
 
+				write_state_file(self.state_file, root)
+			except (IOError, OSError, ValueError), e:
+				print >> sys.stderr, "Failed to save state/config file: " + str(e)
 
-def refresh_auth_token():
-	"""
-	Refreshes the authentication token.  This should be done less than every 24 hours unless you want to jump through hoops in getting another auth token.
-	All of the necessary information is retreived from the application state/configuration.
-	@return: Nothing
-	"""
+		return
 
-	global GLOBAL_CONTEXT
+	def search(self, _search, _locale=None):
+		"""
+		Makes a search API call.  A rejected token is refreshed and the call retried once.
+		@param _search: Search parameter map as made by create_api_part_search or create_api_keyword_search.
+		@param _locale: (language, currency) to ask for.  Defaults to the client's locale.
+		@raise PartLookupError: See get_part_data.
+		@return: Search results in a fully formed Python object.
+		"""
 
-	if CK_CONTEXT_REF_TOK not in GLOBAL_CONTEXT[CK_CONTEXT]:
-		# We don't have a refresh token so lets be robust and make one!
-		if DEBUG_FLAG:
-			print CK_CONTEXT_REF_TOK + " is missing.  Will try to perform new authentication magic."
-			return new_auth()
-	else:
-		if DEBUG_FLAG:
-			print CK_CONTEXT_REF_TOK + " exists."
+		locale = normalize_locale(_locale or self.locale)
+		payload = json.dumps(_search)
 
-	d = create_api_auth_refresh_parms(GLOBAL_CONTEXT[CK_API_CLIENT_ID], GLOBAL_CONTEXT[CK_API_SECRET], GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_REF_TOK])
-	r = requests.post(SSO_HOST + "/as/token.oauth2", data=d)
+		for attempt in (1, 2):
+			token = self.access_token()
+			head = create_api_call_headers(self.config[CK_API_CLIENT_ID], token, locale)
 
-	jo = r.json();
+			try:
+				with phase_profile.phase("http"):
+					r = self.session().post(API_PART_SEARCH_URI, data=payload, headers=head)
+			except requests.exceptions.RequestException, e:
+				raise PartLookupError(LF_TRANSIENT, "Remote call failed: " + str(e))
 
-	if r.status_code >= 200 and r.status_code < 300:
-		# Everything honky-dory
-		GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_REF_TOK] = jo["refresh_token"]
-		GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_ACC_TOK] = jo["access_token"]
-		GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_EXP] = jo["expires_in"]
-		GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_TS] = datetime.datetime.now().isoformat()
-	else:
-		# Uh oh number 2
-		print >> sys.stderr, "Failed to refresh token: " + str(jo)
-		raise RuntimeError("Failed to refresh token: " + str(jo))
+			if r.status_code != 401 or attempt == 2:
+				break
 
-	return
+			self.refresh_token(token)
 
+		rl = parse_rate_limit(r)
 
-def dump_request_headers(r, _target=sys.stdout):
-	"""
-	Dumps the response headers in a relatively useful fasion
-	@param r: Response object
-	@param _target: Where to dump the information.  Should be a file descriptor type object.
-	"""
+		if rl is not None:
+			with self.token_lock:
+				self.config[CK_CONTEXT][CK_CONTEXT_RATE_LIMIT] = rl
 
-	print >> _target, "\n" + ("*" * 10) + " REQUEST HEADERS START " + ("*" * 10)
+		if r.status_code < 200 or r.status_code >= 300:
+			raise PartLookupError(classify_lookup_failure(r.status_code), "Remote call failed.  Code: %s Body: %s" % (str(r.status_code), r.text))
 
-	for h in r.request.headers.keys():
-		print >> _target, h + ": " + r.request.headers[h]
-	print >> _target, ("*" * 10) + " REQUEST HEADERS END " + ("*" * 10) + "\n"
+		with phase_profile.phase("json.loads"):
+			body = json.loads(r.text)
 
-	return
+		self.parametrics.learn(body.get("Parts", []))
 
-def dump_response_headers(r, _target=sys.stdout):
-	"""
-	Dumps the response headers in a relatively useful fasion
-	@param r: Response object
-	@param _target: Where to dump the information.  Should be a file descriptor type object.
-	"""
+		return body
 
-	print >> _target, "\n" + ("*" * 10) + " RESPONSE HEADERS START " + ("*" * 10)
+	def get_part_data(self, _id, _qty=1, _locale=None):
+		"""
+		Same as the module's get_part_data, with this client.
+		"""
 
-	for h in r.headers.keys():
-		print >> _target, h + ": " + r.headers[h]
-	print >> _target, ("*" * 10) + " RESPONSE HEADERS END " + ("*" * 10) + "\n"
+		return self.search(create_api_part_search(_id.strip(), int(_qty)), _locale)
 
-	return
+	def lookup_part_data(self, _id, _qty=1, _locale=None):
+		"""
+		Same as the module's lookup_part_data, with this client's negative cache.
+		"""
 
-def get_part_data(_id, _qty):
-	"""
-	@raise RuntimeError: Raises a RuntimeError if the response code is not 2xx.  The search can fail for any number of reasons including an invalid part number.  A malformed request, auth error, an invalid search, they all return code 4xx.
-	@return: Search results in a fully formed Python object.
-	"""
+		try:
+			d = self.get_part_data(_id, _qty, _locale)
 
-	head = create_api_call_headers(GLOBAL_CONTEXT[CK_API_CLIENT_ID], GLOBAL_CONTEXT[CK_CONTEXT][CK_CONTEXT_ACC_TOK])
+			if len(d.get("Parts", [])) < 1:
+				raise PartLookupError(LF_NO_RESULTS, "No parts found for [%s]." % _id.strip())
+		except PartLookupError, e:
+			if e.kind in LF_PERMANENT:
+				with self.negative_lock:
+					self.negative[part_number_key(_id)] = {NK_TS: time.time(), NK_KIND: e.kind, NK_REASON: e.reason}
+			raise
 
-	payload = json.dumps(create_api_part_search(_id.strip(), int(_qty)))
+		with self.negative_lock:
+			self.negative.pop(part_number_key(_id), None)
 
-	r = requests.post(API_PART_SEARCH_URI, data=payload, headers=head)
+		return d
 
-	if DEBUG_FLAG:
-		dump_response_headers(r)
-		dump_request_headers(r)
+	def get_cached_part_data(self, _id, _qty=1, _ttl=PART_CACHE_TTL, _locale=None):
+		"""
+		Same as the module's get_cached_part_data, with this client's MemoryCache standing in for the parts cache.  Threads that ask for a part that is
+		already being looked up wait for that lookup and share its result.  Counts other than PART_CACHE_COUNT aren't cached.
+		@raise PartLookupError: See lookup_part_data.  Known-bad part numbers fail right away without a remote call.
+		@return: Search results in a fully formed Python object.  Shared; don't change it.
+		"""
 
+		locale = normalize_locale(_locale or self.locale)
+		key = part_cache_key(_id, locale)
+		cached = int(_qty) == PART_CACHE_COUNT
 
-	if r.status_code < 200 or r.status_code >= 300:
+		if _ttl > 0:
+			d = self.memory.get(key, _ttl) if cached else None
 
-		reason_guess = "Don't know why."
+			if d is not None:
+				return d
 
-		if r.status_code == 429:
-			reason_guess = "Rate Limit Exceeded."
+			with self.negative_lock:
+				n = self.negative.get(part_number_key(_id))
 
-		raise RuntimeError("Remote call failed. Best guess: %s Code: %s Body: %s" % (reason_guess,str(r.status_code),r.text))
+			if n is not None and time.time() - n[NK_TS] <= NEGATIVE_CACHE_TTL:
+				raise PartLookupError(n[NK_KIND], "Known bad part number (cached): " + n[NK_REASON])
 
-	body = json.loads(r.text)
+		if not cached:
+			return self.lookup_part_data(_id, _qty, locale)
 
-	if DEBUG_FLAG:
-		print "\n" + ("*" * 10) + " RESULT START " + ("*" * 10)
-		print json.dumps(body, indent=4)
-		print ("*" * 10) + " RESULT END " + ("*" * 10) + "\n"
+		with self.flights_lock:
+			f = self.flights.get(key)
+			leader = f is None
 
-	return body
+			if leader:
+				f = PartFlight()
+				self.flights[key] = f
 
-def search_for_part(_part, _count, _compact):
-	d = None
+		if not leader:
+			f.event.wait()
 
-	ind = 2
-	seps = (', ', ': ')
+			if f.error is not None:
+				raise f.error
 
-	if _compact:
-		ind = None
-		seps = (',', ':')
+			return f.data
 
-	try:
-		d = get_part_data(_part, _count)
-	except RuntimeError,e:
-		#
-		# This could be thrown by anything and everything.  We'll assume that just means that no results were found.
-		#
-		print >>sys.stderr,"Failed to search for part [%s]: %s " % (_part,str(e))
-		sys.exit(-1)
+		try:
+			f.data = self.lookup_part_data(_id, _qty, locale)
+			self.memory.put(key, f.data)
+		except Exception, e:
+			f.error = e
+			raise
+		finally:
+			with self.flights_lock:
+				self.flights.pop(key, None)
 
-	global PARAMETRICS_CACHE
-	for i in d["Parts"][0]["Parameters"]:
-		parm_text = i["Parameter"]
-		parm_id = str(i["ParameterId"])
+			f.event.set()
 
-		if parm_id not in PARAMETRICS_CACHE.keys():
-			PARAMETRICS_CACHE[parm_id] = parm_text
+		return f.data
 
-	if len(d["Parts"]) == 1:
-		d = d["Parts"][0]
+	def search_for_part(self, _id, _qty=1, _remove=(), _ttl=PART_CACHE_TTL, _locale=None):
+		"""
+		@param _remove: Sections to remove from the result, e.g. MediaLinks; see SECTION_FLAGS.
+		@return: The part, or the whole search result if it found more than one, as a Python object of its own.
+		@raise PartLookupError: See get_cached_part_data.
+		"""
+
+		d = self.get_cached_part_data(_id, _qty, _ttl, _locale)
+
+		if len(d["Parts"]) == 1:
+			d = d["Parts"][0]
+
+		return remove_sections(d, _remove)
+
+	def iter_keyword_search(self, _keywords, _limit=None, _page_size=KEYWORD_PAGE_SIZE, _locale=None):
+		"""
+		Generator that yields the parts of a keyword search one at a time, a page at a time.
+		@raise PartLookupError: See get_part_data.
+		"""
+
+		start = 0
+
+		while _limit is None or start < _limit:
+			count = _page_size
+
+			if _limit is not None:
+				count = min(count, _limit - start)
 
-	if CMD_ARGS.rmMl:
-		d.pop("MediaLinks",None)
-	if CMD_ARGS.rmPp:
-		d.pop("PrimaryPhoto",None)
-	if CMD_ARGS.rmPd:
-		d.pop("PrimaryDatasheet",None)
+			body = self.search(create_api_keyword_search(_keywords, start, count), _locale)
+			parts = body.get("Parts", [])
 
-	return json.dumps(d, indent=ind, ensure_ascii=True, separators=seps)
+			for p in parts:
+				yield p
+
+			start = start + len(parts)
+			total = body.get("Results", body.get("ProductsCount"))
+
+			if len(parts) < count or (total is not None and start >= int(total)):
+				return
 
 def dbg_1():
 	pass
@@ -593,19 +4538,33 @@ def setup_argparse():
 	parser.add_argument("-rmMl", action="store_true", help="Remove MediaLinks section from the results.")
 	parser.add_argument("-rmPp", action="store_true", help="Remove PrimaryPhoto section from the results.")
 	parser.add_argument("-rmPd", action="store_true", help="Remove PrimaryDatasheet section from the results.")
-	parser.add_argument("CMD", choices=["INVOKE_M1", "INVOKE_M2", "STR_M1", "STR_M2", "AUTH_NEW", "AUTH_REFRESH", "PART_SEARCH", "DBG1"], help="Main command.")
+	parser.add_argument("-nc", action="store_true", help="Bypass the parts cache and always query Digi-Key.")
+	parser.add_argument("-limit", help="Maximum number of results for KEYWORD_SEARCH (all of them if omitted) and LOCAL_SEARCH (%d if omitted)." % LOCAL_SEARCH_LIMIT, type=int)
+	parser.add_argument("-days", help="Only look at the last this many days of history for HIST_TREND and HIST_MINMAX.  All of it if omitted.", type=float)
+	parser.add_argument("-fuzzy", action="store_true", help="LOCAL_SEARCH also lists substring and look-alike matches when there are enough prefix matches.")
+	parser.add_argument("-pace", action="store_true", help="Pace remote calls using the recorded rate limit.  Meant for batch runs that invoke PART_SEARCH in a loop.")
+	parser.add_argument("-perMin", help="Per-minute call budget for REFRESH, REFRESH_LOOP, and PREFETCH.  Overrides the state/config file.", type=int)
+	parser.add_argument("-perDay", help="Per-day call budget for REFRESH, REFRESH_LOOP, and PREFETCH.  Overrides the state/config file.", type=int)
+	parser.add_argument("-I", help="BOM or part list files for PREFETCH and LOCALE_PRICING, comma separated.", type=comma_list, default=[])
+	parser.add_argument("-locale", help="Language to look parts up in, e.g. de.  Overrides LOCALE_LANGUAGE in the state/config file.")
+	parser.add_argument("-currency", help="Currency to look parts up in, e.g. eur.  Overrides LOCALE_CURRENCY in the state/config file.")
+	parser.add_argument("-locales", help="Locales for LOCALE_PRICING as language/currency, comma separated, e.g. en/usd,de/eur,en/gbp.", type=comma_list, default=[])
+	parser.add_argument("-cred", help="Index of the credential that AUTH_NEW, AUTH_REFRESH, STR_M1, INVOKE_M1, and INVOKE_M2 work on.  0, the default, is the top level of the state/config file; 1 and up are the CREDENTIALS entries.", default=0, type=int)
+	parser.add_argument("-j", help="Number of worker threads for PREFETCH and LOCALE_PRICING.  Defaults to %d." % PREFETCH_DEFAULT_WORKERS, default=PREFETCH_DEFAULT_WORKERS, type=int)
+	parser.add_argument("CMD", choices=["INVOKE_M1", "INVOKE_M2", "STR_M1", "STR_M2", "AUTH_NEW", "AUTH_REFRESH", "PART_SEARCH", "KEYWORD_SEARCH", "REFRESH", "REFRESH_LOOP", "QUOTA", "CACHE_TRAIN_DICT", "CACHE_EXPORT", "CACHE_IMPORT", "PREFETCH", "NEG_LIST", "NEG_CLEAR", "PARAMS", "LOCALE_PRICING", "LOCAL_SEARCH", "INDEX_REBUILD", "HIST_TREND", "HIST_MINMAX", "HIST_CHANGE", "SSO_CLEAR", "AUTH_KEEPER", "AUTH_KEEPER_LOOP", "DBG1"], help="Main command.")
+	parser.add_argument("-snapshot", help="Cache snapshot (see CACHE_EXPORT) to mount read-only.  Parts in it are used unless the local cache has a newer copy.  Defaults to $" + SNAPSHOT_ENV + ".", default=os.environ.get(SNAPSHOT_ENV))
 	parser.add_argument("-dbgInFile", help="Input file for debug purposes.")
+	parser.add_argument("--profile", action="store_true", help="Time the phases of the run and print a breakdown to stderr at the end.")
+	parser.add_argument("--profile-dump", help="With --profile, also profile the whole run with cProfile and dump the pstats to this file.")
 
 	return parser
 
-def process_commands():
+def process_commands(args):
 	global DEBUG_FLAG
 	global DBG_IN_FILE
-	global CMD_ARGS
+	global LOCALE
 
-	parser = setup_argparse()
-	args = parser.parse_args()
-	CMD_ARGS = args
+	remove = [section for flag, section in SECTION_FLAGS if getattr(args, flag)]
 
 	if args.D:
 		DEBUG_FLAG = True
@@ -619,29 +4578,128 @@ def process_commands():
 	if args.dbgInFile:
 		DBG_IN_FILE = args.dbgInFile
 
+	if args.locale or args.currency:
+		LOCALE = normalize_locale((args.locale or LOCALE[0], args.currency or LOCALE[1]))
+
 	if args.CMD == "AUTH_REFRESH":
-		refresh_auth_token()
+		cred = get_credential(args.cred)
+
+		with phase_profile.phase("auth"):
+			refresh_auth_token_shared(cred[CK_CONTEXT].get(CK_CONTEXT_ACC_TOK), cred)
 	elif args.CMD == "AUTH_NEW":
-		new_auth()
+		with phase_profile.phase("auth"):
+			new_auth(get_credential(args.cred))
+	elif args.CMD == "AUTH_KEEPER":
+		failed = keep_auth_tokens(False)
+
+		print keeper_to_string()
+
+		if failed > 0:
+			# The keeper saved the state itself; a timer should see the failure
+			sys.exit(-1)
+	elif args.CMD == "AUTH_KEEPER_LOOP":
+		keep_auth_tokens(True)
 	elif args.CMD == "STR_M1":
-		print create_auth_magic_url_one()
+		print create_auth_magic_url_one(get_credential(args.cred))
 	elif args.CMD == "STR_M2":
 		if args.P == None:
 			print >> sys.stderr, "Must specify the 'code' that was provided by the site in response to magic string 1."
 		else:
 			print create_auth_magic_url_two(args.P)
 	elif args.CMD == "INVOKE_M1":
-		print invoke_auth_magic_one()
+		print invoke_auth_magic_one(get_credential(args.cred))
 	elif args.CMD == "INVOKE_M2":
 		if args.P == None:
 			print >> sys.stderr, "Must specify the 'code' that was provided by the site in response to magic string 1."
 		else:
-			invoke_auth_magic_two(args.P)
+			invoke_auth_magic_two(args.P, get_credential(args.cred))
 	elif args.CMD == "PART_SEARCH":
 		if args.P == None:
 			print >> sys.stderr, "Must specify Digi-Key part number using the -P parameter when the command is PART_SEARCH."
 		else:
-			print search_for_part(args.P, args.C, args.Jc)
+			ttl = PART_CACHE_TTL
+
+			if args.nc:
+				ttl = 0
+
+			try:
+				print search_for_part(args.P, args.C, args.Jc, ttl, args.pace, remove)
+			except RuntimeError, e:
+				#
+				# This could be thrown by anything and everything.  We'll assume that just means that no results were found.
+				#
+				print >>sys.stderr,"Failed to search for part [%s]: %s " % (args.P,str(e))
+
+				# We're not going through the normal save on the way out; remember the failure, and the rate limit for -pace, for next time
+				save_global_context()
+				save_negative_cache()
+				sys.exit(-1)
+	elif args.CMD == "KEYWORD_SEARCH":
+		if args.P == None:
+			print >> sys.stderr, "Must specify the search keywords using the -P parameter when the command is KEYWORD_SEARCH."
+		else:
+			keyword_search(args.P, args.limit, args.Jc, remove)
+	elif args.CMD == "REFRESH":
+		print "Refreshed %d parts." % refresh_parts(False, args.perMin, args.perDay)
+	elif args.CMD == "REFRESH_LOOP":
+		refresh_parts(True, args.perMin, args.perDay)
+	elif args.CMD == "QUOTA":
+		print quota_to_string()
+	elif args.CMD == "PREFETCH":
+		prefetch_parts(args.I, args.j, PART_CACHE_TTL, args.perMin, args.perDay)
+	elif args.CMD == "LOCALE_PRICING":
+		parts = [pn for f in args.I for pn in read_part_list(f)]
+
+		if args.P != None:
+			parts = parts + [pn for pn in args.P.split(",") if len(pn.strip()) > 0]
+
+		if len(parts) < 1 or len(args.locales) < 1:
+			print >> sys.stderr, "Must specify part numbers using -P and/or -I, and locales using -locales, when the command is LOCALE_PRICING."
+		else:
+			ttl = PART_CACHE_TTL
+
+			if args.nc:
+				ttl = 0
+
+			for merged in locale_pricing(parts, [parse_locale(l) for l in args.locales], args.j, ttl):
+				with phase_profile.phase("json.dumps"):
+					print json.dumps(merged, ensure_ascii=True, separators=(',', ':'))
+	elif args.CMD == "LOCAL_SEARCH":
+		if args.P == None:
+			print >> sys.stderr, "Must specify a part number or a piece of one using the -P parameter when the command is LOCAL_SEARCH."
+		else:
+			local_search(args.P, args.limit or LOCAL_SEARCH_LIMIT, args.fuzzy)
+	elif args.CMD == "INDEX_REBUILD":
+		print "Indexed %d parts." % rebuild_part_index()
+	elif args.CMD in ("HIST_TREND", "HIST_MINMAX", "HIST_CHANGE"):
+		print history_to_string(args.CMD, args.P, args.days)
+	elif args.CMD == "PARAMS":
+		if args.P == None:
+			print parameters_to_string(None)
+		else:
+			print parameters_to_string(int(args.P))
+	elif args.CMD == "NEG_LIST":
+		print negative_cache_to_string()
+	elif args.CMD == "NEG_CLEAR":
+		if args.P == None:
+			for k in NEGATIVE_CACHE.keys():
+				forget_bad_part(k)
+		else:
+			forget_bad_part(part_number_key(args.P))
+	elif args.CMD == "CACHE_EXPORT":
+		if args.P == None:
+			print >> sys.stderr, "Must specify the snapshot file using the -P parameter when the command is CACHE_EXPORT."
+		else:
+			print "Exported %d parts." % export_cache_snapshot(args.P)
+	elif args.CMD == "CACHE_IMPORT":
+		if args.P == None:
+			print >> sys.stderr, "Must specify the snapshot file using the -P parameter when the command is CACHE_IMPORT."
+		else:
+			print "Imported %d of %d parts; the rest were older than the local copies." % import_cache_snapshot(args.P)
+	elif args.CMD == "CACHE_TRAIN_DICT":
+		print "Trained a %d byte compression dictionary." % train_zdict()
+	elif args.CMD == "SSO_CLEAR":
+		clear_sso_cookies()
 	elif args.CMD == "DBG1":
 		dbg_1()
 	else:
@@ -649,21 +4707,39 @@ def process_commands():
 
 
 def main():
+	args = setup_argparse().parse_args()
+
+	if args.profile:
+		phase_profile.start(args.profile_dump)
+
+	try:
+		run(args)
+	finally:
+		phase_profile.report()
+
+def run(args):
 	#
 	# We always load the state/config
 	#
-	try:
-		load_global_context();
-	except ValueError, e:
-		print >> sys.stderr, "Failed to load state/config file: " + str(e)
-		return
+	with phase_profile.phase("state load"):
+		try:
+			load_global_context();
+		except ValueError, e:
+			print >> sys.stderr, "Failed to load state/config file: " + str(e)
+			return
 
-	load_parametrics_cache()
+		load_parametrics_cache()
+		load_zdict()
+		load_parts_cache()
+		load_negative_cache()
+
+		if args.snapshot:
+			mount_cache_snapshot(args.snapshot)
 	#
 	# Do magic
 	#
 	try:
-		process_commands()
+		process_commands(args)
 	except Exception, e:
 		#
 		# Magic failed
@@ -676,13 +4752,21 @@ def main():
 	#
 	# We only save the state if nothing threw and exception
 	#
-	try:
-		save_global_context();
-	except ValueError, e:
-		print >> sys.stderr, "Failed to load state/config file: " + str(e)
-		return
+	with phase_profile.phase("state save"):
+		try:
+			save_global_context();
+		except ValueError, e:
+			print >> sys.stderr, "Failed to load state/config file: " + str(e)
+			return
 
-	save_parametrics_cache()
+		save_parametrics_cache()
+		save_parts_cache()
+		save_negative_cache()
+		save_part_index()
+		save_price_history()
+
+	if DEBUG_FLAG:
+		print "Memory cache: " + MEMORY_CACHE.to_string()
 
 if __name__ == '__main__':
 	main()
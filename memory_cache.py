@@ -0,0 +1,202 @@
+#===============================================================================
+#
+#  Copyright 2017 VIDAS SIMKUS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#===============================================================================
+
+#===============================================================================
+#
+# In-memory LRU cache of decoded search results, bounded by an approximate
+# number of bytes rather than a number of entries: one part with a hundred
+# parameters and a long pricing table is worth many small ones.  Sits in front
+# of the parts cache, which keeps results compressed, so that a long-lived
+# process that uses dkapia as a library serves its hot parts without decoding
+# them every time and without holding on to every part it ever saw.
+#
+#===============================================================================
+
+import collections
+import json
+import threading
+import time
+
+# Counter names, see MemoryCache.stats
+MC_HITS = "HITS"
+MC_MISSES = "MISSES"
+MC_EVICTIONS = "EVICTIONS"
+MC_EXPIRATIONS = "EXPIRATIONS"
+
+# Entry tuple indexes
+ME_VALUE = 0
+ME_SIZE = 1
+ME_TS = 2
+ME_EXPIRES = 3
+
+def approximate_size(_value):
+	"""
+	@return: Length of the compact JSON form of a value.  The Python objects take a few times that but it grows the same way.
+	"""
+
+	return len(json.dumps(_value, separators=(',', ':')))
+
+class MemoryCache(object):
+	"""
+	Least recently used entries are evicted once the sizes of the entries add up to more than max_bytes.  An entry bigger than max_bytes is not kept at
+	all.  Thread safe.
+	"""
+
+	def __init__(self, _max_bytes, _ttl=None):
+		"""
+		@param _max_bytes: Size budget in approximate bytes, see approximate_size.  Zero turns the cache off.
+		@param _ttl: Default time to live of an entry in seconds.  Entries live until evicted if None.
+		"""
+
+		self.max_bytes = _max_bytes
+		self.ttl = _ttl
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.bytes = 0
+		self.counters = dict([(c, 0) for c in (MC_HITS, MC_MISSES, MC_EVICTIONS, MC_EXPIRATIONS)])
+		return
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, _key, _max_age=None):
+		"""
+		@param _key: Cache key.
+		@param _max_age: Treat entries older than this many seconds as missing, on top of their time to live.  No limit if None.
+		@return: The value, or None if it isn't cached or has expired.
+		"""
+
+		now = time.time()
+
+		with self.lock:
+			e = self.entries.pop(_key, None)
+
+			if e is None:
+				self.counters[MC_MISSES] = self.counters[MC_MISSES] + 1
+				return None
+
+			if (e[ME_EXPIRES] is not None and now > e[ME_EXPIRES]) or (_max_age is not None and now - e[ME_TS] > _max_age):
+				self.bytes = self.bytes - e[ME_SIZE]
+				self.counters[MC_EXPIRATIONS] = self.counters[MC_EXPIRATIONS] + 1
+				self.counters[MC_MISSES] = self.counters[MC_MISSES] + 1
+				return None
+
+			# Back in at the most recently used end
+			self.entries[_key] = e
+			self.counters[MC_HITS] = self.counters[MC_HITS] + 1
+
+			return e[ME_VALUE]
+
+	def put(self, _key, _value, _ts=None, _ttl=None, _size=None):
+		"""
+		Adds or replaces an entry and evicts least recently used entries until the cache is within its budget.
+		@param _key: Cache key.
+		@param _value: Value.  Not copied; don't change it afterwards.
+		@param _ts: When the value was made, for get's _max_age.  Now if None.
+		@param _ttl: Time to live in seconds.  The cache's default if None.
+		@param _size: Size of the value if the caller already knows it.  Worked out with approximate_size if None.
+		@return: Nothing
+		"""
+
+		if self.max_bytes <= 0:
+			return
+
+		now = time.time()
+
+		if _size is None:
+			_size = approximate_size(_value)
+
+		if _ttl is None:
+			_ttl = self.ttl
+
+		expires = None
+
+		if _ttl is not None:
+			expires = now + _ttl
+
+		with self.lock:
+			old = self.entries.pop(_key, None)
+
+			if old is not None:
+				self.bytes = self.bytes - old[ME_SIZE]
+
+			if _size > self.max_bytes:
+				return
+
+			self.entries[_key] = (_value, _size, _ts or now, expires)
+			self.bytes = self.bytes + _size
+
+			while self.bytes > self.max_bytes:
+				k, e = self.entries.popitem(last=False)
+				self.bytes = self.bytes - e[ME_SIZE]
+				self.counters[MC_EVICTIONS] = self.counters[MC_EVICTIONS] + 1
+
+		return
+
+	def pop(self, _key):
+		"""
+		Drops an entry.
+		@return: Nothing
+		"""
+
+		with self.lock:
+			e = self.entries.pop(_key, None)
+
+			if e is not None:
+				self.bytes = self.bytes - e[ME_SIZE]
+
+		return
+
+	def clear(self):
+		"""
+		Drops every entry.  The counters are kept.
+		@return: Nothing
+		"""
+
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+
+		return
+
+	def stats(self):
+		"""
+		@return: Map of the MC_* counters plus ENTRIES, BYTES, and MAX_BYTES.
+		"""
+
+		with self.lock:
+			ret = dict(self.counters)
+			ret["ENTRIES"] = len(self.entries)
+			ret["BYTES"] = self.bytes
+			ret["MAX_BYTES"] = self.max_bytes
+
+		return ret
+
+	def to_string(self):
+		"""
+		@return: The stats on one line.
+		"""
+
+		s = self.stats()
+		lookups = s[MC_HITS] + s[MC_MISSES]
+		rate = 0.0
+
+		if lookups > 0:
+			rate = 100.0 * s[MC_HITS] / lookups
+
+		return "%d entries, %d of %d bytes; %d hits, %d misses (%.0f%% hit rate), %d evictions, %d expirations" % (s["ENTRIES"], s["BYTES"], s["MAX_BYTES"], s[MC_HITS], s[MC_MISSES], rate, s[MC_EVICTIONS], s[MC_EXPIRATIONS])
@@ -0,0 +1,375 @@
+#===============================================================================
+#
+#  Copyright 2017 VIDAS SIMKUS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#===============================================================================
+
+#===============================================================================
+#
+# Local index of every Digi-Key and manufacturer part number we have seen in
+# a search response, for finding parts from half a part number without going
+# to the network.  The index is a sorted list of (term, DKPN) pairs so that a
+# prefix search is a bisect followed by a short walk.  Every part number is
+# indexed as is and with the punctuation squeezed out, so that "rc0805fr0710k"
+# finds RC0805FR-0710KL.
+#
+#===============================================================================
+
+import bisect
+import difflib
+import re
+import threading
+
+"""
+Layout version of the JSON form.
+"""
+INDEX_VERSION = 1
+
+# JSON form keys
+IK_VERSION = "VERSION"
+IK_INFO = "INFO"
+IK_TERMS = "TERMS"
+IK_REFS = "REFS"
+
+# Per-part information kept for showing results
+II_MPN = 0
+II_MFG = 1
+II_DESC = 2
+
+# How a result matched
+MATCH_PREFIX = "prefix"
+MATCH_SUBSTRING = "substring"
+MATCH_FUZZY = "fuzzy"
+
+"""
+Minimum difflib similarity of a fuzzy match.
+"""
+FUZZY_CUTOFF = 0.6
+
+"""
+Characters part numbers are made of once compacted.  Used to spell out the one-typo variants of a query.
+"""
+TERM_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+"""
+Fuzzy matching only compares the query against the terms that sort within this many entries of it, or of its first few characters.
+Comparing it against every term would take seconds.
+"""
+FUZZY_WINDOW = 25
+
+"""
+The shortest piece of the query that is used to find fuzzy candidates.
+"""
+FUZZY_MIN_PREFIX = 3
+
+"""
+Most terms taken per typo variant of a query.
+"""
+TYPO_VARIANT_MATCHES = 500
+
+"""
+Adding more than this many terms at once re-sorts the index instead of inserting them one at a time.
+"""
+BULK_ADD = 64
+
+def normalize_term(_s):
+	"""
+	@return: Part number as indexed: stripped and upper case.
+	"""
+
+	return _s.strip().upper()
+
+def compact_term(_s):
+	"""
+	@return: Part number as indexed with everything but letters and digits squeezed out.
+	"""
+
+	return re.sub(r"[^0-9A-Z]", "", normalize_term(_s))
+
+def part_terms(_dkpn, _mpn):
+	"""
+	@return: The (term, DKPN) pairs a part is indexed under.
+	"""
+
+	ret = set()
+
+	for pn in (_dkpn, _mpn):
+		for term in (normalize_term(pn), compact_term(pn)):
+			if len(term) > 0:
+				ret.add((term, _dkpn))
+
+	return ret
+
+def part_text(_part, _field):
+	"""
+	Digs a string out of a part.  Depending on the API version some fields are plain strings and some are {"Value": ...} maps.
+	@return: The string, or an empty string if the part doesn't have it.
+	"""
+
+	v = _part.get(_field)
+
+	if isinstance(v, dict):
+		v = v.get("Value")
+
+	if v is None:
+		return u""
+
+	return unicode(v)
+
+class PartIndex(object):
+	"""
+	Sorted (term, DKPN) pairs plus a little information about each DKPN for showing results.  Thread safe; parts are added from whatever thread
+	caches them.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.entries = []
+		self.info = {}
+		self.dirty = False
+		return
+
+	def __len__(self):
+		return len(self.info)
+
+	def add_entries(self, _entries):
+		"""
+		Adds (term, DKPN) pairs that aren't already there.  Must be called with the lock held.
+		"""
+
+		if len(_entries) > BULK_ADD:
+			self.entries = sorted(set(self.entries) | set(_entries))
+			return
+
+		for e in _entries:
+			i = bisect.bisect_left(self.entries, e)
+
+			if i < len(self.entries) and self.entries[i] == e:
+				continue
+
+			self.entries.insert(i, e)
+
+		return
+
+	def add_parts(self, _parts):
+		"""
+		Indexes the parts of a search response.
+		@param _parts: List of parts.
+		@return: Nothing
+		"""
+
+		with self.lock:
+			added = set()
+
+			for part in _parts:
+				dkpn = normalize_term(part_text(part, "DigiKeyPartNumber"))
+
+				if len(dkpn) < 1:
+					continue
+
+				mpn = part_text(part, "ManufacturerPartNumber")
+				info = [mpn, part_text(part, "Manufacturer"), part_text(part, "ProductDescription")]
+
+				if self.info.get(dkpn) == info:
+					continue
+
+				self.info[dkpn] = info
+				self.dirty = True
+				added.update(part_terms(dkpn, mpn))
+
+			self.add_entries(added)
+
+		return
+
+	def prefix_matches(self, _prefix):
+		"""
+		@return: Every (term, DKPN) pair whose term starts with _prefix.  Must be called with the lock held.
+		"""
+
+		ret = []
+		i = bisect.bisect_left(self.entries, (_prefix,))
+
+		while i < len(self.entries) and self.entries[i][0].startswith(_prefix):
+			ret.append(self.entries[i])
+			i = i + 1
+
+		return ret
+
+	def typo_matches(self, _cq):
+		"""
+		Finds terms that start with the query give or take one typo: a character missing, extra, wrong, or swapped with its neighbor.
+		Every variant is a bisect into the index so this stays fast no matter how big the index is.  Must be called with the lock held.
+		@param _cq: Compacted query.
+		@return: (term, DKPN) pairs, shortest term first.
+		"""
+
+		variants = set()
+
+		for p in range(len(_cq) + 1):
+			if p < len(_cq):
+				variants.add(_cq[:p] + _cq[p + 1:])
+
+			if p < len(_cq) - 1:
+				variants.add(_cq[:p] + _cq[p + 1] + _cq[p] + _cq[p + 2:])
+
+			for c in TERM_ALPHABET:
+				variants.add(_cq[:p] + c + _cq[p:])
+
+				if p < len(_cq):
+					variants.add(_cq[:p] + c + _cq[p + 1:])
+
+		variants.discard(_cq)
+
+		ret = set()
+
+		for v in variants:
+			if len(v) < FUZZY_MIN_PREFIX:
+				continue
+
+			i = bisect.bisect_left(self.entries, (v,))
+			n = 0
+
+			while i < len(self.entries) and n < TYPO_VARIANT_MATCHES and self.entries[i][0].startswith(v):
+				ret.add(self.entries[i])
+				i = i + 1
+				n = n + 1
+
+		return sorted(ret, key=lambda e: (len(e[0]), e[0]))
+
+	def search(self, _query, _limit, _fuzzy=False):
+		"""
+		Finds parts by a piece of a Digi-Key or manufacturer part number.  Prefix matches come first, shortest term first.  If there are fewer than
+		_limit of those, or _fuzzy is set, parts whose part numbers contain the query come next, then parts whose part numbers start with the query give
+		or take a typo, then parts whose part numbers look somewhat like it.
+		@param _query: Part number or a piece of one.
+		@param _limit: Maximum number of results.
+		@param _fuzzy: Always look beyond the prefix matches.
+		@return: List of (DKPN, matched term, MATCH_* constant)
+		"""
+
+		q = normalize_term(_query)
+		cq = compact_term(_query)
+
+		if len(cq) < 1:
+			return []
+
+		ret = []
+		seen = set()
+
+		def take(_pairs, _how):
+			for term, dkpn in _pairs:
+				if len(ret) >= _limit:
+					return
+				if dkpn not in seen:
+					seen.add(dkpn)
+					ret.append((dkpn, term, _how))
+
+		with self.lock:
+			prefixed = self.prefix_matches(q)
+
+			if cq != q:
+				prefixed = prefixed + self.prefix_matches(cq)
+
+			take(sorted(prefixed, key=lambda e: (len(e[0]), e[0])), MATCH_PREFIX)
+
+			if len(ret) >= _limit and not _fuzzy:
+				return ret
+
+			take([e for e in self.entries if cq in e[0] and not e[0].startswith(cq)], MATCH_SUBSTRING)
+
+			if len(ret) >= _limit:
+				return ret
+
+			take(self.typo_matches(cq), MATCH_FUZZY)
+
+			if len(ret) >= _limit:
+				return ret
+
+			terms = {}
+
+			for n in range(len(cq), FUZZY_MIN_PREFIX - 1, -1):
+				i = bisect.bisect_left(self.entries, (cq[:n],))
+
+				for term, dkpn in self.entries[max(i - FUZZY_WINDOW, 0):i + FUZZY_WINDOW]:
+					terms.setdefault(term, dkpn)
+
+			close = difflib.get_close_matches(cq, terms.keys(), _limit * 2, FUZZY_CUTOFF)
+
+			take([(term, terms[term]) for term in close], MATCH_FUZZY)
+
+		return ret
+
+	def part_info(self, _dkpn):
+		"""
+		@return: [MPN, manufacturer, description] of the part, see II_*.  Empty strings for a part that isn't indexed.
+		"""
+
+		return self.info.get(_dkpn, [u"", u"", u""])
+
+	def to_json(self):
+		"""
+		@return: JSON-able form.  The terms are stored already sorted, each with the position of its DKPN in the sorted DKPNs, since sorting them
+		again on load would take most of the load time.
+		"""
+
+		with self.lock:
+			dkpns = sorted(self.info.keys())
+			pos = dict([(dkpns[i], i) for i in range(len(dkpns))])
+
+			ret = {}
+			ret[IK_VERSION] = INDEX_VERSION
+			ret[IK_INFO] = dict(self.info)
+			ret[IK_TERMS] = [e[0] for e in self.entries]
+			ret[IK_REFS] = [pos[e[1]] for e in self.entries]
+
+		return ret
+
+	def merge_json(self, _jo):
+		"""
+		Adds what to_json produced, from another process, to this index.  Our information about a part wins.  Does not change the dirty flag.
+		@return: Nothing
+		"""
+
+		if _jo.get(IK_VERSION) != INDEX_VERSION:
+			return
+
+		with self.lock:
+			added = set()
+
+			for dkpn, info in _jo.get(IK_INFO, {}).items():
+				if dkpn not in self.info:
+					self.info[dkpn] = info
+					added.update(part_terms(dkpn, info[II_MPN]))
+
+			self.add_entries(added)
+
+		return
+
+	def from_json(self, _jo):
+		"""
+		Loads what to_json produced.  An index of another version is ignored; it will be rebuilt.
+		@return: True if the index was loaded.
+		"""
+
+		if _jo.get(IK_VERSION) != INDEX_VERSION:
+			return False
+
+		with self.lock:
+			self.info = _jo.get(IK_INFO, {})
+			dkpns = sorted(self.info.keys())
+			self.entries = zip(_jo.get(IK_TERMS, []), [dkpns[i] for i in _jo.get(IK_REFS, [])])
+			self.dirty = False
+
+		return True
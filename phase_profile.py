@@ -0,0 +1,156 @@
+#===============================================================================
+#
+#  Copyright 2017 VIDAS SIMKUS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#===============================================================================
+
+#===============================================================================
+#
+# Phase level timing for dkapia.py and check_bom.py.  Wrap the interesting bits
+# in 'with phase_profile.phase("name"):' and call report() at the end.  When
+# profiling is not enabled a phase costs one attribute lookup and a flag check.
+#
+#===============================================================================
+
+import time
+import threading
+import sys
+
+"""
+Set by start().  Nothing is recorded unless this is true.
+"""
+ENABLED = False
+
+"""
+Phase name to [number of times entered, total seconds].
+"""
+PHASE_TIMES = {}
+
+"""
+Order in which phases were first seen.  The report is printed in this order.
+"""
+PHASE_ORDER = []
+
+PHASE_LOCK = threading.Lock()
+
+START_TIME = None
+
+PROFILER = None
+PROFILER_FILE = None
+
+class phase(object):
+	"""
+	Context manager that adds the time spent inside it to the named phase.
+	Phases may be nested; the outer phase includes the time of the inner one.
+	"""
+
+	def __init__(self, _name):
+		self.name = _name
+		self.start = None
+		return
+
+	def __enter__(self):
+		if ENABLED:
+			self.start = time.time()
+		return self
+
+	def __exit__(self, _type, _value, _tb):
+		if self.start is not None:
+			add(self.name, time.time() - self.start)
+		return False
+
+def add(_name, _seconds):
+	"""
+	Adds time to a phase directly.  For the cases where a 'with' block does not fit.
+	@param _name: Phase name.
+	@param _seconds: Time to add.
+	@return: Nothing
+	"""
+
+	if not ENABLED:
+		return
+
+	with PHASE_LOCK:
+		t = PHASE_TIMES.get(_name)
+
+		if t is None:
+			t = [0, 0.0]
+			PHASE_TIMES[_name] = t
+			PHASE_ORDER.append(_name)
+
+		t[0] = t[0] + 1
+		t[1] = t[1] + _seconds
+
+	return
+
+def start(_dump_file=None):
+	"""
+	Turns on phase timing.
+	@param _dump_file: If given, the whole run is also profiled with cProfile and the pstats are dumped to this file by report().
+	@return: Nothing
+	"""
+
+	global ENABLED
+	global START_TIME
+	global PROFILER
+	global PROFILER_FILE
+
+	ENABLED = True
+	START_TIME = time.time()
+
+	if _dump_file:
+		import cProfile
+
+		PROFILER = cProfile.Profile()
+		PROFILER_FILE = _dump_file
+		PROFILER.enable()
+
+	return
+
+def report(_target=sys.stderr):
+	"""
+	Prints the phase breakdown and dumps the cProfile stats if asked for.
+	@param _target: Where to print the table.
+	@return: Nothing
+	"""
+
+	if not ENABLED:
+		return
+
+	wall = time.time() - START_TIME
+
+	if PROFILER is not None:
+		PROFILER.disable()
+
+		try:
+			PROFILER.dump_stats(PROFILER_FILE)
+		except Exception, e:
+			print >> _target, "Failed to dump profile stats: " + str(e)
+
+	print >> _target, "\n" + ("*" * 10) + " PROFILE START " + ("*" * 10)
+	print >> _target, "%-24s %8s %12s %12s %7s" % ("Phase", "Count", "Total (ms)", "Mean (ms)", "% wall")
+
+	for n in PHASE_ORDER:
+		count, total = PHASE_TIMES[n]
+		print >> _target, "%-24s %8d %12.2f %12.3f %6.1f%%" % (n, count, total * 1000, total * 1000 / count, 100 * total / max(wall, 1e-9))
+
+	print >> _target, "%-24s %8s %12.2f" % ("Wall clock", "", wall * 1000)
+
+	if PROFILER is not None:
+		print >> _target, "cProfile stats dumped to: " + PROFILER_FILE
+
+	print >> _target, ("*" * 10) + " PROFILE END " + ("*" * 10) + "\n"
+
+	return
@@ -0,0 +1,456 @@
+#===============================================================================
+#
+#  Copyright 2017 VIDAS SIMKUS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#===============================================================================
+
+#===============================================================================
+#
+# Stock and price history.  Every time a part is fetched its QuantityAvailable
+# and the first few price tiers are appended to a binary file of fixed-width
+# records.  Each record also holds the number of the previous record of the
+# same part, so the history of one part is a walk backwards through a chain
+# rather than a scan of the whole file.  Records are read straight out of a
+# read-only mmap with struct.unpack_from, one at a time, and the queries keep
+# running totals, so nothing but the answer is ever held in memory.
+#
+# A small JSON file next to it holds the part names (a record only has the
+# number of its part) and the last record of every part.  It can lag behind
+# the binary file if a process died between the two writes; the records past
+# what it knows about are scanned to catch up.
+#
+#===============================================================================
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+"""
+Identifies a history file.
+"""
+HISTORY_MAGIC = "DKPH"
+
+"""
+Layout version of the binary file.
+"""
+HISTORY_VERSION = 1
+
+"""
+Number of price tiers kept per sample.  Parts with more tiers keep the smallest break quantities.
+"""
+HISTORY_TIERS = 4
+
+"""
+File header: magic, version, record size, number of price tiers.
+"""
+HEADER = struct.Struct("<4sIII")
+
+"""
+Record: time stamp, part number, previous record of the part plus one (0 for none), quantity available (-1 if unknown), then the break quantities
+(0 for an unused tier) and unit prices of the price tiers.
+"""
+RECORD = struct.Struct("<IIIq" + "I" * HISTORY_TIERS + "d" * HISTORY_TIERS)
+
+# Sample tuple indexes, as returned by PriceHistory.samples
+HS_TS = 0
+HS_QTY = 1
+HS_TIERS = 2
+
+# JSON side file keys
+HK_VERSION = "VERSION"
+HK_PARTS = "PARTS"
+HK_LAST = "LAST"
+HK_RECORDS = "RECORDS"
+
+"""
+Seconds in a day.  Trends are reported per day.
+"""
+DAY = 24 * 60 * 60
+
+def part_sample(_part):
+	"""
+	Pulls what the history keeps out of a part.
+	@param _part: Part as found in a search response.
+	@return: Tuple of (quantity available or -1, tuple of (break quantity, unit price) of the lowest HISTORY_TIERS tiers)
+	"""
+
+	try:
+		qty = int(_part.get("QuantityAvailable"))
+	except (TypeError, ValueError):
+		qty = -1
+
+	tiers = []
+
+	for p in _part.get("StandardPricing") or []:
+		try:
+			tiers.append((int(p["BreakQuantity"]), float(p["UnitPrice"])))
+		except (KeyError, TypeError, ValueError):
+			continue
+
+	return (qty, tuple(sorted(tiers)[:HISTORY_TIERS]))
+
+def unit_price(_sample):
+	"""
+	@return: Unit price at the smallest break quantity of a sample, or None if it has no pricing.
+	"""
+
+	if len(_sample[HS_TIERS]) < 1:
+		return None
+
+	return _sample[HS_TIERS][0][1]
+
+class PriceHistory(object):
+	"""
+	Append-only history of the stock and pricing of parts, keyed by parts cache key so that every currency has its own history.
+	New samples are buffered in memory until flush().  Nothing is read from disk until open() or flush().  Thread safe.
+	"""
+
+	def __init__(self, _file_name, _parts_file_name):
+		"""
+		@param _file_name: Binary record file.
+		@param _parts_file_name: JSON side file.
+		"""
+
+		self.file_name = _file_name
+		self.parts_file_name = _parts_file_name
+		self.lock = threading.Lock()
+		self.parts = []
+		self.ids = {}
+		self.last = []
+		self.records = 0
+		self.pending = []
+		self.map = None
+		return
+
+	def __len__(self):
+		return len(self.parts)
+
+	def open(self):
+		"""
+		Reads the history for querying.
+		@raise ValueError: The record file is not a history file or has a different layout.
+		@return: Nothing
+		"""
+
+		with self.lock:
+			self.load()
+
+		return
+
+	def load(self):
+		"""
+		(Re)reads the side file and catches up on records appended after it was written.  Must be called with the lock held.
+		@return: Nothing
+		"""
+
+		try:
+			with open(self.parts_file_name, "rt") as parts_file:
+				jo = json.load(parts_file)
+		except Exception, e:
+			jo = {}
+
+		if jo.get(HK_VERSION) == HISTORY_VERSION:
+			self.parts = jo.get(HK_PARTS, [])
+			self.last = jo.get(HK_LAST, [])
+			self.records = jo.get(HK_RECORDS, 0)
+		else:
+			self.parts = []
+			self.last = []
+			self.records = 0
+
+		self.ids = dict([(self.parts[i], i) for i in range(len(self.parts))])
+		self.open_map()
+
+		n = self.record_count()
+
+		for rn in range(self.records, n):
+			pid = RECORD.unpack_from(self.map, HEADER.size + rn * RECORD.size)[1]
+
+			# Records of parts whose names never made it to the side file are unreachable
+			if pid < len(self.last):
+				self.last[pid] = rn + 1
+
+		self.records = n
+
+		return
+
+	def open_map(self):
+		"""
+		Maps the record file, if there is anything in it.
+		@raise ValueError: The file is not a history file or has a different layout.
+		@return: Nothing
+		"""
+
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+
+		try:
+			with open(self.file_name, "rb") as hist_file:
+				if os.fstat(hist_file.fileno()).st_size <= HEADER.size:
+					return
+
+				self.map = mmap.mmap(hist_file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (IOError, OSError), e:
+			return
+
+		if HEADER.unpack_from(self.map, 0) != (HISTORY_MAGIC, HISTORY_VERSION, RECORD.size, HISTORY_TIERS):
+			self.map.close()
+			self.map = None
+			raise ValueError("%s is not a version %d price history file." % (self.file_name, HISTORY_VERSION))
+
+		return
+
+	def record_count(self):
+		"""
+		@return: Number of complete records in the mapped file.
+		"""
+
+		if self.map is None:
+			return 0
+
+		return (len(self.map) - HEADER.size) // RECORD.size
+
+	def record(self, _key, _part, _ts=None):
+		"""
+		Queues a sample of a part.
+		@param _key: Parts cache key.
+		@param _part: Part as found in a search response.
+		@param _ts: Time of the sample.  Now if omitted.
+		@return: Nothing
+		"""
+
+		qty, tiers = part_sample(_part)
+
+		with self.lock:
+			self.pending.append((int(_ts or time.time()), _key, qty, tiers))
+
+		return
+
+	def flush(self):
+		"""
+		Appends the queued samples to the record file.  Other processes may be appending too so the caller must hold a cross-process lock.
+		@return: Number of samples written.
+		"""
+
+		with self.lock:
+			if len(self.pending) < 1:
+				return 0
+
+			self.load()
+
+			pending = self.pending
+			self.pending = []
+
+			new_parts = False
+
+			for s in pending:
+				if s[1] not in self.ids:
+					self.ids[s[1]] = len(self.parts)
+					self.parts.append(s[1])
+					self.last.append(0)
+					new_parts = True
+
+			# The names go first so that the records never refer to a part the side file doesn't know
+			if new_parts:
+				self.save_parts()
+
+			base = self.records
+			out = []
+
+			for ts, key, qty, tiers in pending:
+				pid = self.ids[key]
+				breaks = [t[0] for t in tiers] + [0] * (HISTORY_TIERS - len(tiers))
+				prices = [t[1] for t in tiers] + [0.0] * (HISTORY_TIERS - len(tiers))
+
+				out.append(RECORD.pack(*([ts, pid, self.last[pid], qty] + breaks + prices)))
+				self.records = self.records + 1
+				self.last[pid] = self.records
+
+			if not os.path.exists(self.file_name):
+				open(self.file_name, "ab").close()
+
+			with open(self.file_name, "r+b") as hist_file:
+				# Whatever is past the last complete record is what was left of a write that died half way
+				size = HEADER.size + (base * RECORD.size)
+
+				if base == 0:
+					hist_file.truncate(0)
+					hist_file.write(HEADER.pack(HISTORY_MAGIC, HISTORY_VERSION, RECORD.size, HISTORY_TIERS))
+				else:
+					hist_file.truncate(size)
+					hist_file.seek(size)
+
+				hist_file.write("".join(out))
+
+			self.save_parts()
+			self.open_map()
+
+		return len(pending)
+
+	def save_parts(self):
+		"""
+		Writes the side file.  Must be called with the lock held.
+		@return: Nothing
+		"""
+
+		jo = {}
+		jo[HK_VERSION] = HISTORY_VERSION
+		jo[HK_PARTS] = self.parts
+		jo[HK_LAST] = self.last
+		jo[HK_RECORDS] = self.records
+
+		with open(self.parts_file_name + ".tmp", "wt") as parts_file:
+			json.dump(jo, parts_file, separators=(',', ':'))
+
+		os.rename(self.parts_file_name + ".tmp", self.parts_file_name)
+
+		return
+
+	def samples(self, _key, _since=0):
+		"""
+		Generator that walks the history of a part from the newest sample back.  Samples not yet flushed are not included.
+		@param _key: Parts cache key.
+		@param _since: Stop at samples older than this time stamp.
+		@return: Yields (time stamp, quantity available, tuple of (break quantity, unit price)); see HS_*.
+		"""
+
+		pid = self.ids.get(_key)
+
+		if pid is None or self.map is None:
+			return
+
+		rn = self.last[pid]
+
+		while rn > 0 and rn <= self.record_count():
+			r = RECORD.unpack_from(self.map, HEADER.size + (rn - 1) * RECORD.size)
+
+			if r[0] < _since:
+				return
+
+			tiers = tuple([(r[4 + i], r[4 + HISTORY_TIERS + i]) for i in range(HISTORY_TIERS) if r[4 + i] > 0])
+
+			yield (r[0], r[3], tiers)
+
+			rn = r[2]
+
+		return
+
+	def trend(self, _key, _since=0):
+		"""
+		Fits a straight line through the stock of a part over time.
+		@param _key: Parts cache key.
+		@param _since: Only look at samples from this time stamp on.
+		@return: None if there are no samples, otherwise a map with SAMPLES, FIRST and LAST (samples), SLOPE (stock per day, None with fewer than two
+		points in time), and DAYS_LEFT (days until the stock runs out at that rate, None unless it is falling).
+		"""
+
+		n = 0
+		m = 0
+		sx = sy = sxx = sxy = 0.0
+		first = last = None
+
+		for s in self.samples(_key, _since):
+			if last is None:
+				last = s
+
+			first = s
+			n = n + 1
+
+			if s[HS_QTY] < 0:
+				continue
+
+			# Days before the newest sample, which keeps the sums small
+			x = (s[HS_TS] - last[HS_TS]) / float(DAY)
+
+			m = m + 1
+			sx = sx + x
+			sy = sy + s[HS_QTY]
+			sxx = sxx + x * x
+			sxy = sxy + x * s[HS_QTY]
+
+		if n < 1:
+			return None
+
+		ret = {"SAMPLES": n, "FIRST": first, "LAST": last, "SLOPE": None, "DAYS_LEFT": None}
+
+		d = m * sxx - sx * sx
+
+		if m > 1 and d > 1e-12:
+			ret["SLOPE"] = (m * sxy - sx * sy) / d
+
+			if ret["SLOPE"] < 0 and last[HS_QTY] > 0:
+				ret["DAYS_LEFT"] = last[HS_QTY] / -ret["SLOPE"]
+
+		return ret
+
+	def min_max(self, _key, _since=0):
+		"""
+		@param _key: Parts cache key.
+		@param _since: Only look at samples from this time stamp on.
+		@return: None if there are no samples, otherwise a map with SAMPLES and the samples with the MIN_QTY, MAX_QTY, MIN_PRICE, and MAX_PRICE (unit
+		price at the smallest break quantity).  The newest one wins ties.  The price entries are None if no sample had pricing.
+		"""
+
+		ret = {"SAMPLES": 0, "MIN_QTY": None, "MAX_QTY": None, "MIN_PRICE": None, "MAX_PRICE": None}
+
+		for s in self.samples(_key, _since):
+			ret["SAMPLES"] = ret["SAMPLES"] + 1
+
+			if s[HS_QTY] >= 0:
+				if ret["MIN_QTY"] is None or s[HS_QTY] < ret["MIN_QTY"][HS_QTY]:
+					ret["MIN_QTY"] = s
+				if ret["MAX_QTY"] is None or s[HS_QTY] > ret["MAX_QTY"][HS_QTY]:
+					ret["MAX_QTY"] = s
+
+			p = unit_price(s)
+
+			if p is not None:
+				if ret["MIN_PRICE"] is None or p < unit_price(ret["MIN_PRICE"]):
+					ret["MIN_PRICE"] = s
+				if ret["MAX_PRICE"] is None or p > unit_price(ret["MAX_PRICE"]):
+					ret["MAX_PRICE"] = s
+
+		if ret["SAMPLES"] < 1:
+			return None
+
+		return ret
+
+	def last_change(self, _key):
+		"""
+		Finds the newest sample whose stock or pricing differs from the sample before it.  Stops there; older samples are never read.
+		@param _key: Parts cache key.
+		@return: (sample before, sample after), or None if the part has no history or never changed.
+		"""
+
+		newer = None
+
+		for s in self.samples(_key):
+			if newer is not None and (s[HS_QTY], s[HS_TIERS]) != (newer[HS_QTY], newer[HS_TIERS]):
+				return (s, newer)
+
+			newer = s
+
+		return None
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+
+		return
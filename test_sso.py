@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+#===============================================================================
+#
+#  Copyright 2017 VIDAS SIMKUS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#===============================================================================
+
+
+#===============================================================================
+#
+# Runs the SSO login of dkapia against a small stand-in SSO server on localhost.
+# Run with: python -m unittest test_sso
+#
+#===============================================================================
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+import BaseHTTPServer
+
+import dkapia
+
+REDIRECT = "https://localhost"
+LOGIN_NAME = "me"
+LOGIN_PASSWORD = "pw"
+
+"""
+Session cookie the stand-in hands out on a good login and takes as proof of a live SSO session.
+"""
+SESSION_COOKIE = "SSOSESSION=alive"
+
+class StandInSSOHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Just enough of the SSO server: the authorization step sends a client with a live session straight back with a code and everybody else to the
+	login form, and the form sets the session cookie.  Counts the hits in server.hits.
+	"""
+
+	def log_message(self, *_args):
+		return
+
+	def reply(self, _code, _body="", _headers={}):
+		self.send_response(_code)
+
+		for k, v in _headers.items():
+			self.send_header(k, v)
+
+		self.send_header("Content-Length", str(len(_body)))
+		self.end_headers()
+		self.wfile.write(_body)
+
+		return
+
+	def do_GET(self):
+		if self.path.startswith("/as/login-page"):
+			self.server.hits["form"] += 1
+			return self.reply(200, '<html><form method="post" action="/as/login"></form></html>')
+
+		return self.reply(404)
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+		if self.path.startswith("/as/authorization.oauth2"):
+			self.server.hits["auth"] += 1
+
+			if SESSION_COOKIE in (self.headers.get("Cookie") or ""):
+				return self.reply(302, "", {"Location": REDIRECT + "?code=FAST"})
+
+			return self.reply(302, "", {"Location": "/as/login-page"})
+
+		if self.path == "/as/login":
+			self.server.hits["login"] += 1
+			f = urlparse.parse_qs(body)
+
+			if f.get("pf.username") != [LOGIN_NAME] or f.get("pf.pass") != [LOGIN_PASSWORD]:
+				return self.reply(200, "Bad login")
+
+			return self.reply(302, "", {"Location": REDIRECT + "?code=SLOW", "Set-Cookie": SESSION_COOKIE + "; Path=/"})
+
+		return self.reply(404)
+
+class SSOLoginTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StandInSSOHandler)
+		self.server.hits = {"auth": 0, "form": 0, "login": 0}
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+		self.dir = tempfile.mkdtemp()
+		self.cookie_file = os.path.join(self.dir, dkapia.SSO_COOKIE_FILE)
+		self.cookie_lock = threading.Lock()
+
+		self.settings = {
+			dkapia.CK_API_CLIENT_ID: "client",
+			dkapia.CK_API_SECRET: "secret",
+			dkapia.CK_API_REDIRECT: REDIRECT,
+			dkapia.CK_LOGIN_NAME: LOGIN_NAME,
+			dkapia.CK_LOGIN_PASSWORD: LOGIN_PASSWORD,
+			dkapia.CK_SSO_HOST: "http://127.0.0.1:%d" % self.server.server_address[1],
+		}
+
+		return
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.dir)
+
+		return
+
+	def login(self):
+		return dkapia.sso_login_code(self.settings, self.cookie_file, self.cookie_lock)
+
+	def test_login_form_without_cookies(self):
+		self.assertEqual(self.login(), "SLOW")
+		self.assertEqual(self.server.hits, {"auth": 1, "form": 1, "login": 1})
+		self.assertEqual(os.stat(self.cookie_file).st_mode & 0777, 0600)
+
+	def test_saved_session_skips_login_form(self):
+		self.login()
+
+		self.assertEqual(self.login(), "FAST")
+		self.assertEqual(self.server.hits, {"auth": 2, "form": 1, "login": 1})
+
+	def test_cookie_file_readable_by_others_is_refused(self):
+		self.login()
+		os.chmod(self.cookie_file, 0644)
+
+		self.assertEqual(self.login(), "SLOW")
+		self.assertEqual(self.server.hits, {"auth": 2, "form": 2, "login": 2})
+
+	def test_missing_login_fails_before_the_server(self):
+		del self.settings[dkapia.CK_LOGIN_PASSWORD]
+
+		self.assertRaises(KeyError, self.login)
+		self.assertEqual(self.server.hits["auth"], 0)
+
+if __name__ == '__main__':
+	unittest.main()